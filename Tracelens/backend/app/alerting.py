@@ -0,0 +1,424 @@
+""" Streaming evaluation of alert thresholds.
+
+Every `AlertThreshold` watches one metric over a sliding window ("1m", "5m"
+or "1h"), optionally per model, provider or (model, provider). Windows are
+rings of WINDOW_SLOTS sub-buckets holding running counts and sums, so adding
+a trace and reading a metric are both O(1). Committed trace writes arrive
+from `app.events`; each event updates the windows it touches and
+re-evaluates only the thresholds watching them, so an alert is written and
+broadcast as soon as a breach is observed. A one-second tick expires old
+sub-buckets and resolves alerts whose metric has dropped back.
+
+Traces are placed in windows by their `created_at`, so backfills and batched
+exports count in the windows they belong to. Window state lives in memory. On
+start it is rebuilt from the last hour of `llm_traces` with one grouped query
+per window size; events arriving meanwhile are held and applied afterwards. Each process only sees
+its own writes, so with several workers set ALERT_STREAMING_ENABLED=false and
+let the leader-elected `app.scheduler` evaluate instead; both share the
+fire/resolve helpers below, which hold at most one open alert per threshold
+and group, resolve with hysteresis and honour a cooldown before re-firing.
+"""
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import case, func, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from . import bucketing, cache, events
+from .database import SessionLocal
+from .models import Alert, AlertThreshold, LLMTrace
+
+logger = logging.getLogger(__name__)
+
+WINDOWS = {"1m": 60, "5m": 300, "1h": 3600}
+DEFAULT_WINDOW = "5m"
+GROUP_BY = {
+    None: (),
+    "model": ("model",),
+    "provider": ("provider",),
+    "model_provider": ("model", "provider"),
+}
+METRICS = ("avg_latency_ms", "error_rate_pct", "total_cost_usd", "total_tokens", "requests_per_minute")
+# Ratio metrics are not evaluated on fewer requests than this
+MIN_SAMPLES = int(os.getenv("ALERT_MIN_SAMPLES", "5"))
+# A firing alert resolves once its metric is this far (percent) below the threshold
+HYSTERESIS_PCT = float(os.getenv("ALERT_HYSTERESIS_PCT", "10"))
+# After resolving, the same threshold and group do not fire again for this long
+COOLDOWN_SECONDS = float(os.getenv("ALERT_COOLDOWN_SECONDS", "300"))
+# Per-process streaming evaluation; turn off when running several workers and rely on app.scheduler
+STREAMING_ENABLED = os.getenv("ALERT_STREAMING_ENABLED", "true").lower() in ("1", "true", "yes")
+WINDOW_SLOTS = 60
+TICK_SECONDS = 1.0
+
+# Per-slot accumulators
+REQUESTS, FAILURES, LATENCY, TOKENS, COST = range(5)
+
+def metric_value(metric_name: str, totals: Sequence[float], seconds: float) -> Optional[float]:
+    """Threshold metric from per-window totals (indexed by REQUESTS..COST); None when undefined."""
+    requests = totals[REQUESTS]
+    if metric_name == "avg_latency_ms":
+        return totals[LATENCY] / requests if requests >= MIN_SAMPLES else None
+    if metric_name == "error_rate_pct":
+        return totals[FAILURES] / requests * 100.0 if requests >= MIN_SAMPLES else None
+    if metric_name == "total_cost_usd":
+        return totals[COST]
+    if metric_name == "total_tokens":
+        return totals[TOKENS]
+    if metric_name == "requests_per_minute":
+        return requests / (seconds / 60.0)
+    return None
+
+def alert_message(alert: Alert) -> dict:
+    return {
+        "type": "new_alert",
+        "data": {
+            "id": alert.id,
+            "severity": alert.severity,
+            "title": alert.title,
+            "description": alert.description,
+            "metric": alert.metric,
+            "threshold": alert.threshold,
+            "created_at": alert.created_at.isoformat(),
+            "alert_type": alert.alert_type
+        }
+    }
+
+def group_label(group_by: Optional[str], key: Tuple) -> str:
+    """Stored as Alert.group_key: "model=gpt-4o, provider=openai", or "" when ungrouped."""
+    return ", ".join(f"{name}={value}" for name, value in zip(GROUP_BY[group_by], key))
+
+def breached(value: Optional[float], threshold_value: float) -> bool:
+    return value is not None and value > threshold_value
+
+def recovered(value: Optional[float], threshold_value: float) -> bool:
+    """True once the value is HYSTERESIS_PCT below the threshold (or no longer measurable)."""
+    return value is None or value < threshold_value - abs(threshold_value) * HYSTERESIS_PCT / 100.0
+
+def open_alerts(db: Session) -> Dict[Tuple[int, str], int]:
+    """Unresolved threshold alerts by (threshold id, group key)."""
+    rows = db.query(Alert.id, Alert.threshold_id, Alert.group_key).filter(
+        Alert.threshold_id.isnot(None), Alert.resolved_at.is_(None)
+    )
+    return {(threshold_id, group_key or ""): alert_id for alert_id, threshold_id, group_key in rows}
+
+def cooling_down(db: Session, now: Optional[datetime] = None) -> set:
+    """(threshold id, group key) pairs resolved within the last COOLDOWN_SECONDS."""
+    since = (now or datetime.utcnow()) - timedelta(seconds=COOLDOWN_SECONDS)
+    rows = db.query(Alert.threshold_id, Alert.group_key).filter(
+        Alert.threshold_id.isnot(None), Alert.resolved_at >= since
+    ).distinct()
+    return {(threshold_id, group_key or "") for threshold_id, group_key in rows}
+
+def fire_alert(db: Session, threshold: Dict[str, Any], value: float, group_key: str = "",
+               check: bool = True) -> Optional[Alert]:
+    """Insert a threshold alert and queue its broadcast; the caller commits.
+
+    Returns None without writing when an alert for this threshold and group is
+    still open or was resolved within the cooldown (callers that already
+    checked pass check=False), including one opened concurrently by the other
+    evaluator.
+    """
+    key = (threshold["id"], group_key)
+    if check and (key in open_alerts(db) or key in cooling_down(db)):
+        return None
+    scope = f" ({group_key})" if group_key else ""
+    alert = Alert(
+        severity=threshold["severity"],
+        title=f"{threshold['metric_name']} threshold exceeded{scope}",
+        description=f"Current value: {value:.2f}, Threshold: {threshold['threshold_value']:.2f}, Window: {threshold['window']}",
+        metric=value,
+        threshold=threshold["threshold_value"],
+        alert_type="threshold",
+        metric_name=threshold["metric_name"],
+        threshold_id=threshold["id"],
+        group_key=group_key,
+    )
+    try:
+        with db.begin_nested():
+            db.add(alert)
+            db.flush()
+    except IntegrityError:
+        # uq_alerts_open_threshold_group: another evaluator opened it first
+        return None
+    cache.touch(db, cache.ALERTS)
+    events.record(db, events.ALERTS, [alert_message(alert)])
+    return alert
+
+def resolve_alert(db: Session, alert_id: int) -> Optional[Alert]:
+    """Mark an alert resolved unless it already is; the caller commits."""
+    alert = db.get(Alert, alert_id)
+    if alert is None or alert.resolved_at is not None:
+        return None
+    alert.resolved_at = datetime.utcnow()
+    cache.touch(db, cache.ALERTS)
+    return alert
+
+def threshold_dict(t: AlertThreshold) -> Dict[str, Any]:
+    return {
+        "id": t.id, "metric_name": t.metric_name, "threshold_value": t.threshold_value,
+        "severity": t.severity, "window": t.window or DEFAULT_WINDOW, "group_by": t.group_by,
+    }
+
+def load_thresholds(db: Session) -> List[Dict[str, Any]]:
+    """Enabled thresholds the evaluators understand, as plain dicts."""
+    return [
+        threshold_dict(t)
+        for t in db.query(AlertThreshold).filter(AlertThreshold.enabled == True)
+        if t.metric_name in METRICS and (t.window or DEFAULT_WINDOW) in WINDOWS
+    ]
+
+class SlidingWindow:
+    """Counts and sums over the last `seconds`, in WINDOW_SLOTS ring slots."""
+
+    def __init__(self, seconds: int, slots: int = WINDOW_SLOTS):
+        self.seconds = seconds
+        self.slot_seconds = seconds / slots
+        self.slots = [[0.0] * 5 for _ in range(slots)]
+        self.totals = [0.0] * 5
+        self.head: Optional[int] = None  # absolute index of the newest slot
+
+    def advance(self, now: float):
+        index = int(now // self.slot_seconds)
+        if self.head is None:
+            self.head = index
+            return
+        steps = index - self.head
+        if steps <= 0:
+            return
+        n = len(self.slots)
+        for i in range(1, min(steps, n) + 1):
+            slot = self.slots[(self.head + i) % n]
+            for field in range(5):
+                self.totals[field] -= slot[field]
+                slot[field] = 0.0
+        self.head = index
+        if steps >= n:
+            self.totals = [0.0] * 5  # drop float residue once the window is empty
+
+    def add(self, at: float, values: Sequence[float]):
+        """Add values observed at `at` (epoch seconds); older than the window is ignored."""
+        if self.head is None or at >= (self.head + 1) * self.slot_seconds:
+            self.advance(at)
+        index = int(at // self.slot_seconds)
+        if index <= self.head - len(self.slots):
+            return
+        slot = self.slots[index % len(self.slots)]
+        for field, value in enumerate(values):
+            slot[field] += value
+            self.totals[field] += value
+
+    def value(self, metric_name: str) -> Optional[float]:
+        return metric_value(metric_name, self.totals, self.seconds)
+
+def _values(row: Dict[str, Any]) -> Tuple[float, ...]:
+    return (row["requests"], row["failure_count"], row["latency_sum_ms"], row["tokens"], row["cost_usd"])
+
+class ThresholdEngine:
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.thresholds: List[Dict[str, Any]] = []
+        # (window seconds, group_by) -> group key -> window
+        self.windows: Dict[Tuple[int, Optional[str]], Dict[Tuple, SlidingWindow]] = {}
+        # (threshold id, group key) -> open alert id (None while it is being written)
+        self.firing: Dict[Tuple[int, str], Optional[int]] = {}
+        self._tick: Optional[asyncio.Task] = None
+        self._pending: set = set()
+        # Trace events that arrive while window state is being rebuilt; None when not loading
+        self._buffered: Optional[List[Dict[str, Any]]] = None
+        self._loading = asyncio.Lock()
+
+    async def start(self):
+        if not self.enabled:
+            return
+        events.bus.subscribe(self._on_event)
+        await self._load()
+        self._tick = asyncio.create_task(self._run())
+
+    async def stop(self):
+        events.bus.unsubscribe(self._on_event)
+        if self._tick is not None:
+            self._tick.cancel()
+        if self._pending:
+            await asyncio.gather(*self._pending, return_exceptions=True)
+
+    async def _load(self):
+        """Read enabled thresholds and rebuild window state from recent traces.
+
+        Traces created before the cutoff come from the database; events published while
+        it is read are held back and replayed for traces created from the cutoff on.
+        """
+        async with self._loading:
+            self._buffered = []
+            cutoff = time.time()
+            try:
+                thresholds, windows, opened = await run_in_threadpool(self._read, cutoff)
+            except BaseException:
+                self._buffered = None
+                raise
+            self.thresholds = thresholds
+            self.windows = windows
+            ids = {t["id"] for t in thresholds}
+            firing = {key: alert_id for key, alert_id in opened.items() if key[0] in ids}
+            firing.update({key: alert_id for key, alert_id in self.firing.items() if key[0] in ids and key not in firing})
+            self.firing = firing
+            buffered, self._buffered = self._buffered, None
+            for payload in buffered:
+                self._apply(payload, since=cutoff)
+
+    def _read(self, cutoff: float):
+        with SessionLocal() as db:
+            thresholds = load_thresholds(db)
+            specs = {(WINDOWS[t["window"]], t["group_by"]) for t in thresholds}
+            windows: Dict[Tuple[int, Optional[str]], Dict[Tuple, SlidingWindow]] = {spec: {} for spec in specs}
+            for seconds in sorted({seconds for seconds, _ in specs}):
+                self._replay(db, seconds, cutoff, {spec: w for spec, w in windows.items() if spec[0] == seconds})
+            # Alerts left open by a previous process (or another evaluator) can still resolve here
+            opened = open_alerts(db)
+        return thresholds, windows, opened
+
+    def _replay(self, db: Session, seconds: int, cutoff: float,
+                windows: Dict[Tuple[int, Optional[str]], Dict[Tuple, SlidingWindow]]):
+        step = max(int(seconds / WINDOW_SLOTS), 1)
+        until = datetime.utcfromtimestamp(cutoff)
+        since = until - timedelta(seconds=seconds)
+        bucket = bucketing.bucket_expr(db.get_bind().dialect.name, LLMTrace.created_at, step).label("bucket")
+        rows = db.execute(
+            select(
+                bucket, LLMTrace.model, LLMTrace.provider,
+                func.count(LLMTrace.id),
+                func.sum(case((LLMTrace.status == "failure", 1), else_=0)),
+                func.coalesce(func.sum(LLMTrace.latency_ms), 0),
+                func.coalesce(func.sum(LLMTrace.tokens), 0),
+                func.coalesce(func.sum(LLMTrace.cost_usd), 0),
+            ).where(LLMTrace.created_at >= since, LLMTrace.created_at < until)
+            .group_by(bucket, LLMTrace.model, LLMTrace.provider).order_by(bucket)
+        )
+        for at, model, provider, *values in rows:
+            row = {"model": model, "provider": provider}
+            for (_, group_by), groups in windows.items():
+                key = tuple(row[name] for name in GROUP_BY[group_by])
+                window = groups.get(key)
+                if window is None:
+                    window = groups[key] = SlidingWindow(seconds)
+                window.add(float(at), [float(v or 0) for v in values])
+
+    def _on_event(self, kind: str, payload: Any):
+        if kind == events.THRESHOLDS:
+            self._spawn(self._reload())
+            return
+        if kind != events.TRACES:
+            return
+        if self._buffered is not None:
+            self._buffered.append(payload)
+        elif self.windows:
+            self._apply(payload)
+
+    def _apply(self, payload: Dict[str, Any], since: Optional[float] = None):
+        """Add a trace event to the windows at each trace's created_at, then evaluate what it touched."""
+        now = time.time()
+        # Pure backfills (nothing inside any window) do not feed live alerting
+        if payload.get("created_to") is not None and payload["created_to"] < now - max(WINDOWS.values()):
+            return
+        touched = set()
+        for row in payload["by_second"]:
+            # Clock skew must not move a window past the present
+            at = now if row["at"] is None else min(row["at"], now)
+            if since is not None and at < since:
+                continue  # already read from the database
+            values = _values(row)
+            for spec, groups in self.windows.items():
+                key = tuple(row[name] for name in GROUP_BY[spec[1]])
+                window = groups.get(key)
+                if window is None:
+                    window = groups[key] = SlidingWindow(spec[0])
+                window.add(at, values)
+                touched.add((spec, key))
+        self._evaluate(now, touched)
+
+    def _evaluate(self, now: float, touched: Optional[set] = None):
+        for t in self.thresholds:
+            spec = (WINDOWS[t["window"]], t["group_by"])
+            for key, window in self.windows.get(spec, {}).items():
+                if touched is not None and (spec, key) not in touched:
+                    continue
+                window.advance(now)
+                value = window.value(t["metric_name"])
+                state_key = (t["id"], group_label(t["group_by"], key))
+                if state_key not in self.firing:
+                    if breached(value, t["threshold_value"]):
+                        self.firing[state_key] = None
+                        self._spawn(self._fire(t, state_key, value))
+                elif self.firing[state_key] is not None and recovered(value, t["threshold_value"]):
+                    self._spawn(self._resolve(self.firing.pop(state_key)))
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _fire(self, t: Dict[str, Any], state_key: Tuple[int, str], value: float):
+        def write() -> Optional[int]:
+            with SessionLocal() as db:
+                # Already raised by another evaluator (e.g. app.scheduler): track that alert instead
+                existing = open_alerts(db).get(state_key)
+                if existing is not None:
+                    return existing
+                # The stored row, so a threshold disabled or deleted since the windows were loaded does not fire
+                row = db.get(AlertThreshold, t["id"])
+                if row is None or not row.enabled:
+                    return None
+                alert = fire_alert(db, threshold_dict(row), value, state_key[1])
+                db.commit()
+                if alert is None:
+                    # Cooling down, or opened by the scheduler since the check above
+                    return open_alerts(db).get(state_key)
+                return alert.id
+        try:
+            alert_id = await run_in_threadpool(write)
+        except Exception:
+            alert_id = None
+            logger.exception("Failed to create alert for threshold %s", t["id"])
+        if alert_id is None:
+            # Open elsewhere or cooling down: forget the state so a later breach re-checks
+            self.firing.pop(state_key, None)
+        else:
+            self.firing[state_key] = alert_id
+
+    async def _resolve(self, alert_id: int):
+        def write():
+            with SessionLocal() as db:
+                resolve_alert(db, alert_id)
+                db.commit()
+        try:
+            await run_in_threadpool(write)
+        except Exception:
+            logger.exception("Failed to resolve alert %s", alert_id)
+
+    async def _reload(self):
+        try:
+            await self._load()
+        except Exception:
+            logger.exception("Failed to reload alert thresholds")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(TICK_SECONDS)
+            try:
+                self._evaluate(time.time())
+            except Exception:
+                logger.exception("Threshold evaluation failed")
+
+    async def evaluate(self) -> int:
+        """Evaluate every threshold now and wait for resulting writes; returns alerts created."""
+        already = set(self.firing)
+        self._evaluate(time.time())
+        started = [key for key in self.firing if key not in already]
+        if self._pending:
+            await asyncio.gather(*list(self._pending), return_exceptions=True)
+        return len([key for key in started if self.firing.get(key) is not None])
+
+engine = ThresholdEngine(enabled=STREAMING_ENABLED)
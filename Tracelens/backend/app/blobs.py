@@ -0,0 +1,307 @@
+""" Compressed, content-addressed storage for large span and trace payloads.
+
+Span prompts and outputs and trace metadata of at least BLOB_MIN_BYTES are
+moved out of their rows on ingest: the payload is stored once in `blobs`,
+keyed by the SHA-256 of its UTF-8 text and zlib-compressed, and the row keeps
+only the hash (`prompt_blob`, `output_blob`, `metadata_blob`). A system prompt
+repeated in every span of every session is stored once. Smaller values stay
+inline, where a hash would cost about as much as the text.
+
+Writers upsert every blob they reference, even one already stored, and bump
+its `used_at` when it is older than half of BLOB_REUSE_GRACE_SECONDS.
+Retention only deletes blobs unused for the whole grace period, so a writer
+reusing a blob in the same moment retention drops its last reference keeps
+it: on PostgreSQL the upsert locks the blob row until the writer commits,
+and the retention DELETE re-checks `used_at` once that lock is released.
+
+Reads resolve references only for the fields a response actually returns:
+summary span trees never touch `blobs`, while listings that include payloads
+fetch every distinct hash of the page in one query and decompress each once.
+Decompressed texts are kept in a process-wide LRU of at most BLOB_CACHE_BYTES;
+content-addressed payloads never change, so entries never go stale.
+
+Move payloads of rows written before the blob store, and report the space
+saved, with:
+
+    python -m app.blobs migrate
+    python -m app.blobs report
+"""
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+from sqlalchemy import Text, bindparam, cast, func, or_, select, update
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+from .models import AgentSpan, Blob, LLMTrace
+
+logger = logging.getLogger(__name__)
+
+MIN_BYTES = int(os.getenv("BLOB_MIN_BYTES", "256"))
+CACHE_BYTES = int(os.getenv("BLOB_CACHE_BYTES", str(16 * 1024 * 1024)))
+MIGRATE_BATCH_SIZE = int(os.getenv("BLOB_MIGRATE_BATCH_SIZE", "1000"))
+COMPRESSION_LEVEL = 6
+REUSE_GRACE_SECONDS = int(os.getenv("BLOB_REUSE_GRACE_SECONDS", "3600"))
+
+# payload column -> blob reference column, per table
+SPAN_FIELDS = {"prompt": "prompt_blob", "output": "output_blob"}
+TRACE_FIELDS = {"metadata": "metadata_blob"}
+# Columns holding JSON values, stored as their JSON text
+JSON_FIELDS = {"metadata"}
+
+# Hashes per IN (...) list
+CHUNK_SIZE = 500
+
+class TextCache:
+    """Bounded LRU of decompressed texts by hash, sized in bytes."""
+
+    def __init__(self, max_bytes: int = CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            text = self._entries.get(key)
+            if text is not None:
+                self._entries.move_to_end(key)
+            return text
+
+    def set(self, key: str, text: str):
+        if len(text) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = text
+            self.size += len(text)
+            while self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+text_cache = TextCache()
+
+def _text(field: str, value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return json.dumps(value, separators=(",", ":")) if field in JSON_FIELDS else value
+
+def _value(field: str, text: str) -> Any:
+    return json.loads(text) if field in JSON_FIELDS else text
+
+def encode(text: str) -> Dict[str, Any]:
+    """Blob row for `text`; stored uncompressed when zlib does not make it smaller."""
+    raw = text.encode("utf-8")
+    packed = zlib.compress(raw, COMPRESSION_LEVEL)
+    codec, data = ("zlib", packed) if len(packed) < len(raw) else ("raw", raw)
+    return {"hash": hashlib.sha256(raw).hexdigest(), "codec": codec, "size": len(raw), "data": data}
+
+def decode(codec: str, data: bytes) -> str:
+    return (zlib.decompress(data) if codec == "zlib" else bytes(data)).decode("utf-8")
+
+def unused_since(now: Optional[datetime] = None):
+    """Condition for blobs no writer has stored or reused within the grace period."""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=REUSE_GRACE_SECONDS)
+    used_at = Blob.__table__.c.used_at
+    return or_(used_at.is_(None), used_at < cutoff)
+
+def _store(db: Session, blobs: Dict[str, Dict[str, Any]]):
+    """Insert the blobs, or mark stored ones as used (see the module docstring)."""
+    table = Blob.__table__
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    now = datetime.utcnow()
+    stmt = insert(table)
+    # Every conflicting row is locked, updated or not; the WHERE only spares rewriting fresh ones
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["hash"],
+        set_={"used_at": stmt.excluded.used_at},
+        where=or_(table.c.used_at.is_(None), table.c.used_at < now - timedelta(seconds=REUSE_GRACE_SECONDS / 2)),
+    )
+    # Sorted, so concurrent writers lock shared blobs in the same order
+    rows = [dict(blobs[h], created_at=now, used_at=now) for h in sorted(blobs)]
+    for i in range(0, len(rows), CHUNK_SIZE):
+        db.execute(stmt, rows[i:i + CHUNK_SIZE])
+
+def externalize(db: Session, rows: Sequence[Dict[str, Any]], fields: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Copies of `rows` with large `fields` values replaced by blob references; stores the blobs.
+
+    Every copy carries every reference key (None when the value stayed inline), so the rows
+    can go into a single executemany INSERT. The caller owns the transaction.
+    """
+    blobs: Dict[str, Dict[str, Any]] = {}
+    result = []
+    for row in rows:
+        row = dict(row)
+        for field, ref in fields.items():
+            row[ref] = None
+            text = _text(field, row.get(field))
+            if text is None or len(text) < MIN_BYTES:
+                continue
+            blob = encode(text)
+            if blob["size"] < MIN_BYTES:
+                continue
+            blobs.setdefault(blob["hash"], blob)
+            row[field] = None
+            row[ref] = blob["hash"]
+        result.append(row)
+    if blobs:
+        _store(db, blobs)
+    return result
+
+def load(db: Session, hashes: Iterable[str]) -> Dict[str, str]:
+    """Decompressed text per hash, one query per CHUNK_SIZE hashes not already cached."""
+    texts: Dict[str, str] = {}
+    missing = []
+    for h in set(hashes):
+        text = text_cache.get(h)
+        if text is None:
+            missing.append(h)
+        else:
+            texts[h] = text
+    table = Blob.__table__
+    for i in range(0, len(missing), CHUNK_SIZE):
+        rows = db.execute(
+            select(table.c.hash, table.c.codec, table.c.data).where(table.c.hash.in_(missing[i:i + CHUNK_SIZE]))
+        )
+        for h, codec, data in rows:
+            texts[h] = text = decode(codec, data)
+            text_cache.set(h, text)
+    return texts
+
+def resolve(db: Session, rows: Sequence[Dict[str, Any]], fields: Dict[str, str]):
+    """Fill `fields` of dict rows from their blob references, in place, and drop the reference keys."""
+    present = {field: ref for field, ref in fields.items() if any(ref in row for row in rows)}
+    texts = load(db, (row[ref] for row in rows for ref in present.values() if row.get(ref)))
+    for row in rows:
+        for field, ref in present.items():
+            h = row.pop(ref, None)
+            if h is not None and h in texts:
+                row[field] = _value(field, texts[h])
+
+def resolve_objects(db: Session, objects: Sequence[Any], fields: Dict[str, str]) -> Sequence[Any]:
+    """Same as `resolve` for ORM instances; they are not marked as modified."""
+    if not objects:
+        return objects
+    table = type(objects[0]).__table__
+    mapper = type(objects[0]).__mapper__
+    keys = {field: mapper.get_property_by_column(table.c[field]).key for field in fields}
+    texts = load(db, (getattr(obj, ref) for obj in objects for ref in fields.values() if getattr(obj, ref)))
+    for obj in objects:
+        for field, ref in fields.items():
+            h = getattr(obj, ref)
+            if h is not None and h in texts:
+                set_committed_value(obj, keys[field], _value(field, texts[h]))
+    return objects
+
+def migrate(db: Session, batch_size: int = MIGRATE_BATCH_SIZE) -> Dict[str, int]:
+    """Move large inline payloads of existing rows into blobs, committing every `batch_size` rows.
+
+    Rows are walked in id order and already-referenced payloads are skipped, so an interrupted
+    run can simply be started again. Returns the number of rows changed per table.
+    """
+    moved = {}
+    for model, fields in ((AgentSpan, SPAN_FIELDS), (LLMTrace, TRACE_FIELDS)):
+        table = model.__table__
+        pending = or_(*(table.c[field].is_not(None) & table.c[ref].is_(None) for field, ref in fields.items()))
+        stmt = update(table).where(table.c.id == bindparam("row_id")).values(
+            {table.c[name]: bindparam(name) for field, ref in fields.items() for name in (field, ref)}
+        )
+        last_id, count = 0, 0
+        while True:
+            rows = db.execute(
+                select(table.c.id, *(table.c[field] for field in fields), *(table.c[ref] for ref in fields.values()))
+                .where(table.c.id > last_id, pending)
+                .order_by(table.c.id)
+                .limit(batch_size)
+            ).mappings().all()
+            if not rows:
+                break
+            last_id = rows[-1]["id"]
+            changed = []
+            inputs = [{field: row[field] for field in fields} for row in rows]
+            for original, row in zip(rows, externalize(db, inputs, fields)):
+                if not any(row[ref] for ref in fields.values()):
+                    continue
+                values = {"row_id": original["id"]}
+                for field, ref in fields.items():
+                    moved_here = row[ref] is not None
+                    values[field] = None if moved_here else original[field]
+                    values[ref] = row[ref] if moved_here else original[ref]
+                changed.append(values)
+            if changed:
+                db.execute(stmt, changed)
+            db.commit()
+            count += len(changed)
+            logger.info("Moved payloads of %d %s rows into blobs (up to id %d)", count, table.name, last_id)
+        moved[table.name] = count
+    return moved
+
+def report(db: Session) -> Dict[str, Any]:
+    """Bytes referenced by rows versus bytes stored in `blobs`, and what remains inline."""
+    blob = Blob.__table__
+    referenced, inline = {}, {}
+    for model, fields in ((AgentSpan, SPAN_FIELDS), (LLMTrace, TRACE_FIELDS)):
+        table = model.__table__
+        for field, ref in fields.items():
+            rows, size = db.execute(
+                select(func.count(), func.coalesce(func.sum(blob.c.size), 0))
+                .select_from(table.join(blob, table.c[ref] == blob.c.hash))
+            ).one()
+            referenced[f"{table.name}.{field}"] = {"rows": rows, "bytes": size}
+            inline[f"{table.name}.{field}"] = db.execute(
+                select(func.coalesce(func.sum(func.length(cast(table.c[field], Text))), 0)).where(table.c[ref].is_(None))
+            ).scalar()
+    blobs, unique_bytes, stored_bytes = db.execute(
+        select(func.count(), func.coalesce(func.sum(blob.c.size), 0), func.coalesce(func.sum(func.length(blob.c.data)), 0))
+    ).one()
+    logical = sum(r["bytes"] for r in referenced.values())
+    return {
+        "referenced": referenced,
+        "inline_bytes": inline,
+        "blobs": blobs,
+        "logical_bytes": logical,
+        "unique_bytes": unique_bytes,
+        "stored_bytes": stored_bytes,
+        "saved_bytes": logical - stored_bytes,
+        "saved_pct": (logical - stored_bytes) / logical * 100.0 if logical else 0.0,
+        "dedup_ratio": logical / unique_bytes if unique_bytes else 0.0,
+        "compression_ratio": unique_bytes / stored_bytes if stored_bytes else 0.0,
+    }
+
+def _print_report(r: Dict[str, Any]):
+    for name, ref in r["referenced"].items():
+        print(f"{name:28s} {ref['rows']:10d} rows in blobs  {ref['bytes']:14d} bytes  "
+              f"{r['inline_bytes'][name]:14d} bytes inline")
+    print(f"{r['blobs']} blobs: {r['logical_bytes']} bytes referenced, {r['unique_bytes']} unique, "
+          f"{r['stored_bytes']} stored")
+    print(f"saved {r['saved_bytes']} bytes ({r['saved_pct']:.1f}%); dedup {r['dedup_ratio']:.1f}x, "
+          f"compression {r['compression_ratio']:.1f}x")
+
+if __name__ == "__main__":
+    from .database import SessionLocal
+    command = sys.argv[1:]
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    with SessionLocal() as db:
+        if command == ["migrate"]:
+            moved = migrate(db)
+            print(", ".join(f"{name}: {count} rows" for name, count in moved.items()))
+            _print_report(report(db))
+        elif command == ["report"]:
+            _print_report(report(db))
+        else:
+            sys.exit("usage: python -m app.blobs migrate|report")
@@ -0,0 +1,165 @@
+""" Backend-neutral time bucketing for metric time series.
+
+Buckets are fixed-width intervals aligned to the Unix epoch (UTC). The SQL
+bucket expression yields the bucket start as epoch seconds on every supported
+dialect, so grouping works the same on SQLite and PostgreSQL. The step is
+chosen from a ladder so that a range never produces more than MAX_POINTS
+buckets, or can be given explicitly ("30s", "5m", "1h", "1d", "1w").
+
+Series cover whole buckets: the first bucket starts at or before the
+requested start and the last one runs to its end, past the requested end,
+whether it is read from raw traces or from rollups. Minute- and hour-multiple
+steps are served from the rollup tables and latency sketches; other requests
+aggregate raw traces.
+"""
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import Integer, cast, func, select
+from sqlalchemy.orm import Session
+from . import percentiles, rollups
+from .models import LLMTrace, TraceRollupHour, TraceRollupMinute
+from .sketch import DDSketch
+
+MAX_POINTS = int(os.getenv("TIMESERIES_MAX_POINTS", "1000"))
+
+STEP_LADDER = [60, 300, 900, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400, 7 * 86400]
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+
+METRICS = {
+    # metric name -> raw column
+    "latency_ms": LLMTrace.latency_ms,
+    "tokens": LLMTrace.tokens,
+    "cost_usd": LLMTrace.cost_usd,
+    "requests": LLMTrace.id,
+}
+AGGREGATIONS = ("avg", "sum", "count", "min", "max", "p95")
+
+_EPOCH = datetime(1970, 1, 1)
+
+def parse_step(value: str) -> int:
+    """Parse a step like "90s", "5m" or "1h" into seconds."""
+    match = re.fullmatch(r"\s*(\d+)\s*([smhdw])\s*", value or "")
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"Invalid step: {value!r} (expected e.g. 30s, 5m, 1h, 1d)")
+    return int(match.group(1)) * UNITS[match.group(2)]
+
+def choose_step(start: datetime, end: datetime, max_points: int = MAX_POINTS) -> int:
+    """Smallest ladder step that keeps the range within `max_points` buckets."""
+    span = max((end - start).total_seconds(), 1)
+    for step in STEP_LADDER:
+        if span / step < max_points:
+            return step
+    return STEP_LADDER[-1] * int(span // (STEP_LADDER[-1] * max_points) + 1)
+
+def point_count(start: datetime, end: datetime, step: int) -> int:
+    return (to_epoch(end) // step) - (to_epoch(start) // step) + 1
+
+def to_epoch(ts: datetime) -> int:
+    return int((ts - _EPOCH).total_seconds())
+
+def from_epoch(seconds: int) -> datetime:
+    return _EPOCH + timedelta(seconds=int(seconds))
+
+def floor_epoch(ts: datetime, step: int) -> int:
+    epoch = to_epoch(ts)
+    return epoch - epoch % step
+
+def bucket_starts(start: datetime, end: datetime, step: int) -> List[int]:
+    """Epoch seconds of every bucket intersecting [start, end]."""
+    return list(range(floor_epoch(start, step), floor_epoch(end, step) + 1, step))
+
+def bucket_expr(dialect: str, column, step: int):
+    """SQL expression for the epoch second at which `column`'s bucket starts."""
+    if dialect == "postgresql":
+        return func.floor(func.extract("epoch", column) / step) * step
+    if dialect == "sqlite":
+        # Floor division of integer operands (epochs here are positive)
+        return cast(func.strftime("%s", column), Integer) // step * step
+    raise NotImplementedError(f"Time bucketing is not implemented for {dialect}")
+
+def _rollup_value(r, metric_name: str, aggregation: str):
+    """Aggregate over rollup rows equivalent to the raw aggregation, or None if rollups can't express it."""
+    if metric_name == "requests" or aggregation == "count":
+        return func.sum(r.request_count)
+    sums = {"latency_ms": r.latency_sum, "tokens": r.tokens_sum, "cost_usd": r.cost_sum}
+    if aggregation == "sum":
+        return func.sum(sums[metric_name])
+    if aggregation == "avg":
+        return func.sum(sums[metric_name]) / func.sum(r.request_count)
+    if metric_name == "latency_ms" and aggregation == "min":
+        return func.min(r.latency_min)
+    if metric_name == "latency_ms" and aggregation == "max":
+        return func.max(r.latency_max)
+    return None
+
+def _raw_value(metric_name: str, aggregation: str):
+    column = METRICS[metric_name]
+    if metric_name == "requests" or aggregation == "count":
+        return func.count(column)
+    return {"avg": func.avg, "sum": func.sum, "min": func.min, "max": func.max}[aggregation](column)
+
+def _sketch_granularity(step: int) -> Optional[str]:
+    for name, seconds in reversed(list(rollups.SKETCH_GRANULARITIES.items())):
+        if step % seconds == 0:
+            return name
+    return None
+
+def timeseries(db: Session, metric_name: str, aggregation: str, start: datetime, end: datetime, step: int) -> Dict[int, float]:
+    """Aggregate `metric_name` into the `step`-second buckets intersecting [start, end]; returns {bucket epoch: value}."""
+    dialect = db.get_bind().dialect.name
+    # Whole buckets: raw traces, rollup buckets and sketches all in [lower, upper)
+    lower = from_epoch(floor_epoch(start, step))
+    upper = from_epoch(floor_epoch(end, step) + step)
+    use_rollups = rollups.supported(db) and step % 60 == 0
+
+    if aggregation == "p95" and metric_name != "requests":
+        if use_rollups and metric_name == "latency_ms":
+            granularity = _sketch_granularity(step)
+            merged: Dict[int, DDSketch] = {}
+            for bucket, sketch in rollups.sketch_series(db, lower, upper, granularity).items():
+                merged.setdefault(floor_epoch(bucket, step), DDSketch(sketch.relative_accuracy)).merge(sketch)
+            return {epoch: sketch.quantile(0.95) for epoch, sketch in merged.items()}
+        column = METRICS[metric_name]
+        bucket = bucket_expr(dialect, LLMTrace.created_at, step).label("bucket")
+        window = (LLMTrace.created_at >= lower, LLMTrace.created_at < upper)
+        if percentiles.supports_native(db):
+            rows = db.execute(
+                select(bucket, *percentiles.native_columns(column, (0.95,))).where(*window).group_by(bucket)
+            )
+            return {int(b): v for b, v in rows}
+        # Stream values in bucket order through one sketch at a time
+        result: Dict[int, float] = {}
+        current, sketch = None, None
+        rows = db.execute(
+            select(bucket, column).where(*window, column.isnot(None)).order_by(bucket),
+            execution_options={"yield_per": 10000},
+        )
+        for b, value in rows:
+            if b != current:
+                if sketch is not None:
+                    result[int(current)] = sketch.quantile(0.95)
+                current, sketch = b, DDSketch()
+            sketch.add(value)
+        if sketch is not None:
+            result[int(current)] = sketch.quantile(0.95)
+        return result
+
+    if use_rollups:
+        r = TraceRollupHour if step % 3600 == 0 else TraceRollupMinute
+        value = _rollup_value(r, metric_name, aggregation)
+        if value is not None:
+            bucket = bucket_expr(dialect, r.bucket, step).label("bucket")
+            rows = db.execute(
+                select(bucket, value).where(r.bucket >= lower, r.bucket < upper).group_by(bucket)
+            )
+            return {int(b): v for b, v in rows}
+
+    bucket = bucket_expr(dialect, LLMTrace.created_at, step).label("bucket")
+    rows = db.execute(
+        select(bucket, _raw_value(metric_name, aggregation))
+        .where(LLMTrace.created_at >= lower, LLMTrace.created_at < upper)
+        .group_by(bucket)
+    )
+    return {int(b): v for b, v in rows}
@@ -0,0 +1,260 @@
+""" Result cache for the dashboard summary endpoints.
+
+Entries are keyed on the endpoint name and its query parameters and carry
+tags naming the tables they were computed from ("traces", "spans",
+"sessions", "alerts"). Write paths call `touch(db, *tags)` before committing;
+once the transaction commits, every entry with one of those tags is marked
+stale. A stale or expired entry is still served for up to
+CACHE_STALE_SECONDS while a single background refresh recomputes it, and
+concurrent misses for the same key wait for one computation instead of each
+running the query.
+
+Backends are chosen with CACHE_BACKEND: "memory" (default, an in-process LRU
+bounded by CACHE_MAX_ENTRIES) or "none" to disable caching.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, FrozenSet, Iterable, Optional, Tuple
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from .database import ReadSessionLocal
+
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "memory").lower()
+MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+TTL_SECONDS = float(os.getenv("CACHE_TTL_SECONDS", "10"))
+STALE_SECONDS = float(os.getenv("CACHE_STALE_SECONDS", "60"))
+
+TRACES, SPANS, SESSIONS, ALERTS = "traces", "spans", "sessions", "alerts"
+
+Key = Tuple[Any, ...]
+
+@dataclass
+class Entry:
+    value: Any
+    tags: FrozenSet[str]
+    expires_at: float
+    stale: bool = False
+
+    def fresh(self, now: float) -> bool:
+        return not self.stale and now < self.expires_at
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    stale_hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    invalidations: int = 0
+    evictions: int = 0
+    errors: int = 0
+    by_name: Dict[str, Dict[str, int]] = field(default_factory=dict)
+
+    def count(self, name: str, outcome: str):
+        setattr(self, outcome, getattr(self, outcome) + 1)
+        counts = self.by_name.setdefault(name, {"hits": 0, "stale_hits": 0, "misses": 0})
+        if outcome in counts:
+            counts[outcome] += 1
+
+class MemoryBackend:
+    """Bounded LRU of entries; callers hold the cache lock."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Key, Entry]" = OrderedDict()
+
+    def get(self, key: Key) -> Optional[Entry]:
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        return entry
+
+    def set(self, key: Key, entry: Entry) -> int:
+        """Store `entry`; returns the number of entries evicted to make room."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        return evicted
+
+    def mark_stale(self, tags: FrozenSet[str]) -> int:
+        marked = 0
+        for entry in self._entries.values():
+            if not entry.stale and entry.tags & tags:
+                entry.stale = True
+                marked += 1
+        return marked
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+class NullBackend:
+    max_entries = 0
+
+    def get(self, key: Key) -> Optional[Entry]:
+        return None
+
+    def set(self, key: Key, entry: Entry) -> int:
+        return 0
+
+    def mark_stale(self, tags: FrozenSet[str]) -> int:
+        return 0
+
+    def clear(self):
+        pass
+
+    def __len__(self) -> int:
+        return 0
+
+BACKENDS = {"memory": MemoryBackend, "none": NullBackend}
+
+class ResultCache:
+    def __init__(self, backend=None, session_factory=ReadSessionLocal):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.session_factory = session_factory
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._inflight: Dict[Key, Future] = {}
+        # Bumped on every invalidation; a computation that raced one is stored as stale
+        self._generations: Dict[str, int] = {}
+        self._refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="cache-refresh")
+
+    @classmethod
+    def from_env(cls) -> "ResultCache":
+        if CACHE_BACKEND not in BACKENDS:
+            raise ValueError(f"Unknown CACHE_BACKEND: {CACHE_BACKEND} (expected one of {', '.join(BACKENDS)})")
+        return cls(BACKENDS[CACHE_BACKEND]())
+
+    @property
+    def enabled(self) -> bool:
+        return not isinstance(self.backend, NullBackend)
+
+    def _lookup(self, name: str, params: Dict[str, Any], compute: Callable[[Session], Any], tags: FrozenSet[str],
+                ttl: float, stale_ttl: float) -> Tuple[Key, Any, Optional[Future], bool]:
+        """(key, cached value, None, False) on a hit, else (key, None, future of the result, whether to compute it)."""
+        key = (name,) + tuple(sorted(params.items()))
+        now = time.monotonic()
+        with self._lock:
+            entry = self.backend.get(key)
+            if entry is not None and entry.fresh(now):
+                self.stats.count(name, "hits")
+                return key, entry.value, None, False
+            if entry is not None and stale_ttl > 0 and now < entry.expires_at + stale_ttl:
+                self.stats.count(name, "stale_hits")
+                if key not in self._inflight:
+                    self._inflight[key] = future = Future()
+                    self._refresher.submit(self._refresh, key, tags, compute, ttl, future)
+                return key, entry.value, None, False
+            self.stats.count(name, "misses")
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                self._inflight[key] = future = Future()
+        return key, None, future, leader
+
+    def get_or_compute(self, db: Session, name: str, params: Dict[str, Any], compute: Callable[[Session], Any],
+                       tags: Iterable[str], ttl: float = TTL_SECONDS, stale_ttl: float = STALE_SECONDS) -> Any:
+        """Cached `compute(db)` for this endpoint and parameter set; `stale_ttl=0` never serves stale data."""
+        if not self.enabled:
+            return compute(db)
+        tags = frozenset(tags)
+        key, value, future, leader = self._lookup(name, params, compute, tags, ttl, stale_ttl)
+        if future is None:
+            return value
+        if leader:
+            self._compute(key, tags, compute, ttl, future, db)
+        return future.result()
+
+    async def get_or_compute_async(self, db: AsyncSession, name: str, params: Dict[str, Any],
+                                   compute: Callable[[Session], Any], tags: Iterable[str],
+                                   ttl: float = TTL_SECONDS, stale_ttl: float = STALE_SECONDS) -> Any:
+        """`get_or_compute` for async sessions: waiting for another computation does not block the event loop."""
+        if not self.enabled:
+            return await db.run_sync(compute)
+        tags = frozenset(tags)
+        key, value, future, leader = self._lookup(name, params, compute, tags, ttl, stale_ttl)
+        if future is None:
+            return value
+        if leader:
+            await db.run_sync(lambda session: self._compute(key, tags, compute, ttl, future, session))
+        return await asyncio.wrap_future(future)
+
+    def _refresh(self, key: Key, tags: FrozenSet[str], compute, ttl: float, future: Future):
+        with self.session_factory() as db:
+            self._compute(key, tags, compute, ttl, future, db)
+        with self._lock:
+            self.stats.refreshes += 1
+
+    def _compute(self, key: Key, tags: FrozenSet[str], compute, ttl: float, future: Future, db: Session):
+        with self._lock:
+            generations = {tag: self._generations.get(tag, 0) for tag in tags}
+        try:
+            value = compute(db)
+        except Exception as e:
+            with self._lock:
+                self.stats.errors += 1
+                self._inflight.pop(key, None)
+            future.set_exception(e)
+            return
+        with self._lock:
+            raced = any(self._generations.get(tag, 0) != gen for tag, gen in generations.items())
+            self.stats.evictions += self.backend.set(key, Entry(value, tags, time.monotonic() + ttl, stale=raced))
+            self._inflight.pop(key, None)
+        future.set_result(value)
+
+    def invalidate(self, *tags: str):
+        """Mark every entry computed from any of `tags` stale."""
+        tags = frozenset(tags)
+        with self._lock:
+            for tag in tags:
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            self.stats.invalidations += self.backend.mark_stale(tags)
+
+    def clear(self):
+        with self._lock:
+            self.backend.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            s = self.stats
+            lookups = s.hits + s.stale_hits + s.misses
+            return {
+                "backend": CACHE_BACKEND if self.enabled else "none",
+                "entries": len(self.backend),
+                "max_entries": self.backend.max_entries,
+                "hits": s.hits,
+                "stale_hits": s.stale_hits,
+                "misses": s.misses,
+                "hit_rate_pct": ((s.hits + s.stale_hits) / lookups * 100.0) if lookups else 0.0,
+                "refreshes": s.refreshes,
+                "invalidations": s.invalidations,
+                "evictions": s.evictions,
+                "errors": s.errors,
+                "by_endpoint": {name: dict(counts) for name, counts in s.by_name.items()},
+            }
+
+result_cache = ResultCache.from_env()
+
+def touch(db: Session, *tags: str):
+    """Record that this transaction writes `tags`; entries are invalidated when it commits."""
+    db.info.setdefault("cache_tags", set()).update(tags)
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session: Session):
+    tags = session.info.pop("cache_tags", None)
+    if tags:
+        result_cache.invalidate(*tags)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session):
+    session.info.pop("cache_tags", None)
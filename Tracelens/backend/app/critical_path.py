@@ -0,0 +1,208 @@
+""" Self time and critical path of agent sessions.
+
+A span's self time is its duration minus the union of its children's
+intervals (clipped to the span), i.e. the time no child was running. The
+critical path is the chain of spans that determined the session's duration:
+walking back from the end of each span, the child that finished last before
+the cursor is on the path, the cursor moves to that child's start, and so on
+until the span's start; the gaps between chosen children are time the parent
+itself contributed. Spans without a (known) parent are treated as children
+of one virtual root covering the whole session.
+
+Intervals are `started_at`..`ended_at`, falling back to `created_at` and
+`latency_ms` when a span did not report them. Both passes visit each span
+once after its children are sorted, so a session of n spans costs
+O(n log n) at worst and one query to read.
+
+Results are written to `agent_spans.self_time_ms` / `critical_time_ms` (the
+span's own contribution to the path, NULL when it is not on it) and
+`agent_sessions.critical_path_ms` when a session is completed or failed,
+and again in the same transaction when spans are added to a finished
+session. Only those write paths store results: readers compute running
+sessions, and finished ones stored before this existed, in memory.
+"""
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.orm import Session
+from .models import AgentSession, AgentSpan
+
+FINISHED = ("completed", "failed")
+
+_EPOCH = datetime(1970, 1, 1)
+
+def _ms(ts: datetime) -> float:
+    return (ts - _EPOCH).total_seconds() * 1000.0
+
+def _interval(row: Dict[str, Any]) -> Tuple[float, float]:
+    start = row["started_at"] or row["created_at"]
+    end = row["ended_at"] or start + timedelta(milliseconds=row["latency_ms"] or 0.0)
+    start, end = _ms(start), _ms(end)
+    return start, max(start, end)
+
+def compute(rows: Sequence[Dict[str, Any]]) -> Tuple[Dict[int, float], Dict[int, float]]:
+    """(self time per span id, critical-path contribution per span id on the path), in milliseconds.
+
+    `rows` need id, parent_id, started_at, ended_at, created_at and latency_ms.
+    """
+    spans = {row["id"]: _interval(row) for row in rows}
+    children: Dict[Optional[int], List[int]] = {}
+    for row in rows:
+        parent = row["parent_id"] if row["parent_id"] in spans and row["parent_id"] != row["id"] else None
+        children.setdefault(parent, []).append(row["id"])
+    # By effective start: spans without started_at start at created_at
+    for ids in children.values():
+        ids.sort(key=lambda c: (spans[c][0], c))
+
+    self_times = {}
+    for span_id, (start, end) in spans.items():
+        covered, reach = 0.0, start
+        # Children are in start order, so overlapping intervals merge in one pass
+        for child in children.get(span_id, ()):
+            child_start, child_end = spans[child]
+            child_start, child_end = max(child_start, reach), min(child_end, end)
+            if child_end > child_start:
+                covered += child_end - child_start
+                reach = child_end
+        self_times[span_id] = end - start - covered
+
+    critical: Dict[int, float] = {}
+    roots = children.get(None, [])
+    if not roots:
+        return self_times, critical
+    # (span id or None for the virtual root, window start, window end)
+    stack = [(None, min(spans[r][0] for r in roots), max(spans[r][1] for r in roots))]
+    while stack:
+        span_id, low, cursor = stack.pop()
+        own = 0.0
+        for child in sorted(children.get(span_id, ()), key=lambda c: spans[c][1], reverse=True):
+            if cursor <= low:
+                break
+            child_start, child_end = spans[child]
+            if child_start >= cursor:
+                continue
+            child_end = min(child_end, cursor)
+            if child_end <= low:
+                break
+            own += cursor - child_end
+            cursor = max(child_start, low)
+            stack.append((child, cursor, child_end))
+        if span_id is not None:
+            critical[span_id] = own + max(cursor - low, 0.0)
+    return self_times, critical
+
+def _rows(db: Session, session_id: int, *columns) -> List[Dict[str, Any]]:
+    table = AgentSpan.__table__
+    return [dict(row) for row in db.execute(
+        select(table.c.id, table.c.parent_id, table.c.started_at, table.c.ended_at, table.c.created_at, table.c.latency_ms, *columns)
+        .where(table.c.session_id == session_id)
+        .order_by(func.coalesce(table.c.started_at, table.c.created_at), table.c.id)
+    ).mappings()]
+
+def materialize(db: Session, session_id: int) -> float:
+    """Compute and store self times and the critical path of one session; returns its length in ms.
+
+    The caller owns the transaction.
+    """
+    self_times, critical = compute(_rows(db, session_id))
+    spans = AgentSpan.__table__
+    if self_times:
+        db.execute(
+            update(spans).where(spans.c.id == bindparam("_id")).values(
+                self_time_ms=bindparam("_self"), critical_time_ms=bindparam("_critical"),
+            ),
+            [{"_id": span_id, "_self": value, "_critical": critical.get(span_id)} for span_id, value in self_times.items()],
+        )
+    total = sum(critical.values())
+    sessions = AgentSession.__table__
+    db.execute(update(sessions).where(sessions.c.id == session_id).values(critical_path_ms=total))
+    return total
+
+def refresh(db: Session, session_ids: Iterable[Optional[int]]):
+    """Recompute the stored paths of the finished sessions among `session_ids`, after new spans (caller commits)."""
+    ids = sorted({i for i in session_ids if i is not None})
+    if not ids:
+        return
+    sessions = AgentSession.__table__
+    finished = db.execute(
+        select(sessions.c.id).where(sessions.c.id.in_(ids), sessions.c.status.in_(FINISHED)).order_by(sessions.c.id)
+    ).scalars().all()
+    for session_id in finished:
+        materialize(db, session_id)
+
+def _compute_path(db: Session, session: AgentSession) -> Tuple[float, List[Dict[str, Any]]]:
+    """(length, spans on the path in start order) computed in memory, nothing stored."""
+    table = AgentSpan.__table__
+    rows = _rows(db, session.id, table.c.name, table.c.span_type, table.c.status)
+    self_times, critical = compute(rows)
+    spans = [
+        dict(row, self_time_ms=self_times[row["id"]], critical_time_ms=critical[row["id"]])
+        for row in rows if row["id"] in critical
+    ]
+    return sum(critical.values()), spans
+
+def top_spans(db: Session, session: AgentSession, top: int) -> Optional[Dict[str, Any]]:
+    """Length of a finished session's critical path and the spans contributing most to it; None while running."""
+    if session.status not in FINISHED:
+        return None
+    if session.critical_path_ms is None:
+        total, spans = _compute_path(db, session)
+    else:
+        table = AgentSpan.__table__
+        total = session.critical_path_ms
+        spans = [dict(row) for row in db.execute(
+            select(table.c.id, table.c.name, table.c.span_type, table.c.self_time_ms, table.c.critical_time_ms)
+            .where(table.c.session_id == session.id, table.c.critical_time_ms.is_not(None))
+            .order_by(table.c.critical_time_ms.desc(), table.c.id).limit(top)
+        ).mappings()]
+    spans = sorted(spans, key=lambda span: (-span["critical_time_ms"], span["id"]))[:top]
+    return {
+        "total_ms": total,
+        "top_spans": [
+            {
+                "span_id": span["id"],
+                "span_name": span["name"],
+                "span_type": span["span_type"],
+                "self_time_ms": span["self_time_ms"],
+                "critical_time_ms": span["critical_time_ms"],
+            }
+            for span in spans
+        ],
+    }
+
+def path(db: Session, session: AgentSession) -> Dict[str, Any]:
+    """The session's critical path, spans in start order; read from the stored values when there are any."""
+    table = AgentSpan.__table__
+    stored = session.status in FINISHED and session.critical_path_ms is not None
+    if stored:
+        rows = db.execute(
+            select(
+                table.c.id, table.c.name, table.c.span_type, table.c.status, table.c.started_at, table.c.ended_at,
+                table.c.self_time_ms, table.c.critical_time_ms,
+            ).where(table.c.session_id == session.id, table.c.critical_time_ms.is_not(None))
+            .order_by(func.coalesce(table.c.started_at, table.c.created_at), table.c.id)
+        ).mappings().all()
+        spans = [dict(row) for row in rows]
+        total = session.critical_path_ms
+    else:
+        # Running sessions are computed on every request and not stored
+        total, spans = _compute_path(db, session)
+    return {
+        "session_id": session.id,
+        "status": session.status,
+        "materialized": stored,
+        "critical_path_ms": total,
+        "spans": [
+            {
+                "span_id": span["id"],
+                "span_name": span["name"],
+                "span_type": span["span_type"],
+                "status": span["status"],
+                "started_at": span["started_at"].isoformat() if span["started_at"] else None,
+                "ended_at": span["ended_at"].isoformat() if span["ended_at"] else None,
+                "self_time_ms": span["self_time_ms"],
+                "critical_time_ms": span["critical_time_ms"],
+            }
+            for span in spans
+        ],
+    }
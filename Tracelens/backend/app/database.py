@@ -1,23 +1,180 @@
-from sqlalchemy import create_engine
+""" Engines and sessions.
+
+Writes go to DATABASE_URL. Reads from GET endpoints go to a separate
+read-only engine: DATABASE_READ_URL when set (e.g. a PostgreSQL replica),
+otherwise a second connection pool on the same SQLite file, opened with
+`query_only`, or the primary engine itself on PostgreSQL. Under WAL a SQLite
+reader works from its own snapshot, so dashboard queries never wait for
+ingestion to commit and vice versa.
+
+SQLite connections get the SQLITE_* pragmas below on connect; pooled
+servers (PostgreSQL) get the DB_POOL_* settings.
+"""
+from fastapi import Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from typing import Any, Callable, Dict, Optional, TypeVar
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./aiobs.db")
+# Unset: SQLite reads use a second pool on the same file; other databases read from the primary
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_BYTES = int(os.getenv("SQLITE_MMAP_BYTES", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", str(64 * 1024)))
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "20"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT_SECONDS", "30"))
+POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE_SECONDS", "1800"))
+POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+
+READ_METHODS = ("GET", "HEAD")
+
+def _is_sqlite(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+def _is_memory(url: str) -> bool:
+    return make_url(url).database in (None, "", ":memory:")
+
+def engine_options(url: str) -> Dict[str, Any]:
+    """create_engine keyword arguments for `url`: pool settings, or SQLite's thread check."""
+    if _is_sqlite(url):
+        # File databases pool connections like a server; in-memory ones keep SQLAlchemy's single-connection pool
+        options: Dict[str, Any] = {"connect_args": {"check_same_thread": False}}
+        if not _is_memory(url):
+            options.update(pool_size=POOL_SIZE, max_overflow=POOL_MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT)
+        return options
+    return {
+        "pool_size": POOL_SIZE,
+        "max_overflow": POOL_MAX_OVERFLOW,
+        "pool_timeout": POOL_TIMEOUT,
+        "pool_recycle": POOL_RECYCLE,
+        "pool_pre_ping": POOL_PRE_PING,
+    }
+
+def sqlite_pragmas(read_only: bool = False) -> Dict[str, Any]:
+    pragmas = {
+        "journal_mode": SQLITE_JOURNAL_MODE,
+        "synchronous": SQLITE_SYNCHRONOUS,
+        "busy_timeout": SQLITE_BUSY_TIMEOUT_MS,
+        "mmap_size": SQLITE_MMAP_BYTES,
+        # Negative cache_size is in KiB rather than pages
+        "cache_size": -SQLITE_CACHE_KB,
+    }
+    if read_only:
+        pragmas["query_only"] = "ON"
+    return pragmas
+
+def configure_sqlite(engine: Engine, read_only: bool = False):
+    """Apply the SQLite pragmas to every new connection of `engine` (sync, or an async engine's sync_engine)."""
+    pragmas = sqlite_pragmas(read_only)
+
+    @event.listens_for(engine, "connect")
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute(f"PRAGMA {name}={value}")
+        finally:
+            cursor.close()
+
+def make_engine(url: str, read_only: bool = False) -> Engine:
+    engine = create_engine(url, echo=False, future=True, **engine_options(url))
+    if _is_sqlite(url):
+        configure_sqlite(engine, read_only)
+    return engine
+
+# Async drivers for the same database; the sync engine stays for migrations, CLIs and background jobs
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+psycopg"}
 
-connect_args = {}
-if DATABASE_URL.startswith("sqlite"):
-    connect_args = {"check_same_thread": False}
+def async_url(url: str) -> str:
+    """DATABASE_URL with its driver swapped for the async one (aiosqlite, psycopg 3 in async mode)."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if parsed.get_driver_name() in ("aiosqlite", "asyncpg") or backend not in ASYNC_DRIVERS:
+        return url
+    return parsed.set(drivername=ASYNC_DRIVERS[backend]).render_as_string(hide_password=False)
 
-engine = create_engine(DATABASE_URL, echo=False, future=True, connect_args=connect_args)
+def make_async_engine(url: str, read_only: bool = False):
+    options = engine_options(url)
+    if _is_sqlite(url):
+        options.pop("connect_args")
+        if not _is_memory(url):
+            # aiosqlite opens a connection (and thread) per checkout by default; pool them instead
+            options["poolclass"] = AsyncAdaptedQueuePool
+    engine = create_async_engine(url, echo=False, **options)
+    if _is_sqlite(url):
+        configure_sqlite(engine.sync_engine, read_only)
+    return engine
+
+def _read_url(url: Optional[str], primary: str) -> Optional[str]:
+    """URL of the read engine, or None to read from the primary engine."""
+    if url:
+        return url
+    return primary if _is_sqlite(primary) and not _is_memory(primary) else None
+
+engine = make_engine(DATABASE_URL)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, future=True)
 Base = declarative_base()
 
+_sync_read_url = _read_url(DATABASE_READ_URL, DATABASE_URL)
+read_engine = make_engine(_sync_read_url, read_only=True) if _sync_read_url else engine
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine, future=True)
+
+# Set ASYNC_DATABASE_URL / ASYNC_DATABASE_READ_URL to pick another async driver, e.g. postgresql+asyncpg://...
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or async_url(DATABASE_URL)
+ASYNC_DATABASE_READ_URL = os.getenv("ASYNC_DATABASE_READ_URL") or (
+    async_url(DATABASE_READ_URL) if DATABASE_READ_URL else None
+)
+
+async_engine = make_async_engine(ASYNC_DATABASE_URL)
+_async_read_url = _read_url(ASYNC_DATABASE_READ_URL, ASYNC_DATABASE_URL)
+async_read_engine = make_async_engine(_async_read_url, read_only=True) if _async_read_url else async_engine
+# Objects stay loaded after commit: expired attributes cannot be lazy-loaded outside the session's greenlet
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+AsyncReadSessionLocal = async_sessionmaker(async_read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
         db.close()
+
+async def get_async_db(request: Request):
+    """Session for a route: GET and HEAD requests read from the read engine, everything else writes to the primary."""
+    factory = AsyncReadSessionLocal if request.method in READ_METHODS else AsyncSessionLocal
+    async with factory() as db:
+        yield db
+
+T = TypeVar("T")
+
+def _call_in_session(factory: sessionmaker, fn: Callable[..., T], args: tuple) -> T:
+    with factory() as db:
+        return fn(db, *args)
+
+async def run_in_session(factory: sessionmaker, fn: Callable[..., T], *args) -> T:
+    """Call `fn(db, *args)` with a new sync session from `factory` on a worker thread.
+
+    For work that is mostly Python rather than waiting on the database (compressing
+    payloads, mapping OTLP spans, computing critical paths): AsyncSession.run_sync
+    runs its function on the event loop thread and would stall every other request.
+    """
+    return await run_in_threadpool(_call_in_session, factory, fn, args)
+
+async def dispose_engines():
+    for target in {async_engine, async_read_engine}:
+        await target.dispose()
+    for target in {engine, read_engine}:
+        target.dispose()
@@ -0,0 +1,135 @@
+""" In-process bus for ingestion events.
+
+Write paths call `record(db, kind, payload)` before committing; the payloads
+are published once the transaction commits (and discarded on rollback), so
+subscribers never see writes that did not land. Publishing is thread-safe:
+writes run in the threadpool or the write buffer, and each subscriber
+callback is scheduled onto the event loop it subscribed from.
+
+Trace payloads are pre-aggregated with `trace_delta` on the writing thread so
+that subscribers only merge a few numbers per commit, whatever the batch size.
+"""
+import asyncio
+import logging
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Sequence, Tuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger(__name__)
+
+# Event kinds. Payloads: TRACES a `trace_delta`, SPANS/SESSIONS a row count, ALERTS a list of
+# alert messages, THRESHOLDS the id of a created/updated/deleted alert threshold
+TRACES, SPANS, SESSIONS, ALERTS, THRESHOLDS = "traces", "spans", "sessions", "alerts", "thresholds"
+
+Callback = Callable[[str, Any], None]
+
+_EPOCH = datetime(1970, 1, 1)
+
+TRACE_SUMS = ("requests", "success_count", "failure_count", "latency_sum_ms", "tokens",
+              "input_tokens", "output_tokens", "cost_usd")
+
+def trace_delta(rows: Sequence[Dict[str, Any]]) -> Dict[str, Any]:
+    """Totals of new trace rows, overall, per (model, provider) and per (created_at second, model, provider)."""
+    total = dict.fromkeys(TRACE_SUMS, 0)
+    models: Dict[Tuple[Any, Any], Dict[str, Any]] = {}
+    seconds: Dict[Tuple[Any, Any, Any], Dict[str, Any]] = {}
+    # Span of created_at (epoch seconds) so consumers can tell backfills from live traffic
+    stamps = [(row["created_at"] - _EPOCH).total_seconds() for row in rows if row.get("created_at")]
+    total["created_from"] = min(stamps) if stamps else None
+    total["created_to"] = max(stamps) if stamps else None
+    for row in rows:
+        key = (row.get("model"), row.get("provider"))
+        m = models.get(key)
+        if m is None:
+            m = models[key] = {"model": key[0], "provider": key[1], **dict.fromkeys(TRACE_SUMS, 0)}
+        at = int((row["created_at"] - _EPOCH).total_seconds()) if row.get("created_at") else None
+        per_second = seconds.get(key + (at,))
+        if per_second is None:
+            per_second = seconds[key + (at,)] = {"at": at, "model": key[0], "provider": key[1], **dict.fromkeys(TRACE_SUMS, 0)}
+        status = row.get("status")
+        values = {
+            "requests": 1,
+            "success_count": 1 if status == "success" else 0,
+            "failure_count": 1 if status == "failure" else 0,
+            "latency_sum_ms": row.get("latency_ms") or 0.0,
+            "tokens": row.get("tokens") or 0,
+            "input_tokens": row.get("input_tokens") or 0,
+            "output_tokens": row.get("output_tokens") or 0,
+            "cost_usd": row.get("cost_usd") or 0.0,
+        }
+        for name, value in values.items():
+            total[name] += value
+            m[name] += value
+            per_second[name] += value
+    total["models"] = list(models.values())
+    total["by_second"] = list(seconds.values())
+    return total
+
+def merge_trace_delta(into: Dict[str, Any], delta: Dict[str, Any]) -> Dict[str, Any]:
+    """Add `delta` (from `trace_delta`) into the accumulated delta `into` (without `by_second`)."""
+    if not into:
+        into.update(dict.fromkeys(TRACE_SUMS, 0), models=[], created_from=None, created_to=None)
+    for name in TRACE_SUMS:
+        into[name] += delta[name]
+    if delta.get("created_from") is not None:
+        into["created_from"] = min(filter(None, (into["created_from"], delta["created_from"])))
+        into["created_to"] = max(filter(None, (into["created_to"], delta["created_to"])))
+    models = {(m["model"], m["provider"]): m for m in into["models"]}
+    for m in delta["models"]:
+        current = models.get((m["model"], m["provider"]))
+        if current is None:
+            into["models"].append(dict(m))
+        else:
+            for name in TRACE_SUMS:
+                current[name] += m[name]
+    return into
+
+class EventBus:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: List[Tuple[Callback, asyncio.AbstractEventLoop]] = []
+
+    def subscribe(self, callback: Callback):
+        """Register `callback(kind, payload)`; it runs on the calling coroutine's event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._subscribers.append((callback, loop))
+
+    def unsubscribe(self, callback: Callback):
+        with self._lock:
+            self._subscribers = [(cb, loop) for cb, loop in self._subscribers if cb != callback]
+
+    def publish(self, kind: str, payload: Any):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback, loop in subscribers:
+            try:
+                loop.call_soon_threadsafe(callback, kind, payload)
+            except RuntimeError:
+                # Loop closed (e.g. during shutdown)
+                self.unsubscribe(callback)
+
+    @property
+    def active(self) -> bool:
+        return bool(self._subscribers)
+
+bus = EventBus()
+
+def record(db: Session, kind: str, payload: Any):
+    """Queue an event for publication when this session's transaction commits."""
+    if bus.active:
+        db.info.setdefault("pending_events", []).append((kind, payload))
+
+@event.listens_for(Session, "after_commit")
+def _publish_after_commit(session: Session):
+    for kind, payload in session.info.pop("pending_events", ()):
+        try:
+            bus.publish(kind, payload)
+        except Exception:
+            logger.exception("Failed to publish %s event", kind)
+
+@event.listens_for(Session, "after_rollback")
+def _discard_on_rollback(session: Session):
+    session.info.pop("pending_events", None)
@@ -0,0 +1,91 @@
+""" Bulk write paths shared by the ingestion endpoints. """
+import os
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session
+from . import blobs, cache, critical_path, events, rollups, session_totals
+from .models import LLMTrace, AgentSession, AgentSpan
+from .schemas import LLMTraceCreate, AgentSessionCreate, AgentSpanCreate
+
+# Upper bound on items accepted by a single batch request
+MAX_BATCH_ITEMS = int(os.getenv("INGEST_MAX_BATCH_ITEMS", "5000"))
+
+def trace_row(payload: LLMTraceCreate, created_at: Optional[datetime] = None) -> Dict[str, Any]:
+    return dict(payload.model_dump(), created_at=created_at or datetime.utcnow())
+
+def span_row(payload: AgentSpanCreate, created_at: Optional[datetime] = None) -> Dict[str, Any]:
+    return dict(payload.model_dump(), created_at=created_at or datetime.utcnow())
+
+def session_row(payload: AgentSessionCreate, started_at: Optional[datetime] = None) -> Dict[str, Any]:
+    return dict(payload.model_dump(), started_at=started_at or datetime.utcnow())
+
+def _insert_returning_ids(db: Session, table, rows: Sequence[Dict[str, Any]]) -> List[int]:
+    if not rows:
+        return []
+    stmt = insert(table).returning(table.c.id, sort_by_parameter_order=True)
+    return list(db.execute(stmt, list(rows)).scalars())
+
+def _session_updates(db: Session) -> Dict[str, Any]:
+    return db.info.setdefault("session_updates", {"totals": {}, "paths": set()})
+
+@event.listens_for(Session, "before_commit")
+def _write_session_updates(db: Session):
+    """Update the sessions a transaction's spans and traces belong to, last and in id order.
+
+    Every ingest transaction then locks rollup rows before session rows, whichever of
+    spans and traces it wrote first, so concurrent writers cannot deadlock on the two.
+    """
+    pending = db.info.pop("session_updates", None)
+    if pending:
+        session_totals.write(db, pending["totals"])
+        critical_path.refresh(db, pending["paths"])
+
+@event.listens_for(Session, "after_rollback")
+def _discard_session_updates(db: Session):
+    db.info.pop("session_updates", None)
+
+def insert_trace_rows(db: Session, rows: Sequence[Dict[str, Any]]) -> List[int]:
+    """Insert prepared trace rows with a single multi-row INSERT ... RETURNING id.
+
+    The caller owns the transaction, which also covers the rollup updates; the
+    session totals are updated when it commits. Ids are returned in the order of
+    `rows`. Large payloads are stored in `blobs` and referenced from the inserted
+    rows; `rows` are not modified.
+    """
+    ids = _insert_returning_ids(db, LLMTrace.__table__, blobs.externalize(db, rows, blobs.TRACE_FIELDS))
+    rollups.apply_trace_rows(db, rows)
+    session_totals.add(_session_updates(db)["totals"], trace_rows=rows)
+    cache.touch(db, cache.TRACES)
+    if events.bus.active:
+        events.record(db, events.TRACES, events.trace_delta(rows))
+    return ids
+
+def insert_span_rows(db: Session, rows: Sequence[Dict[str, Any]]) -> List[int]:
+    """Insert prepared span rows; same contract as `insert_trace_rows`.
+
+    Finished sessions receiving spans get their critical path recomputed when the
+    transaction commits, so parents linked after the insert are taken into account.
+    """
+    updates = _session_updates(db)
+    session_totals.add(updates["totals"], span_rows=rows)
+    updates["paths"].update(row["session_id"] for row in rows if row.get("session_id") is not None)
+    cache.touch(db, cache.SPANS)
+    if events.bus.active:
+        events.record(db, events.SPANS, len(rows))
+    return _insert_returning_ids(db, AgentSpan.__table__, blobs.externalize(db, rows, blobs.SPAN_FIELDS))
+
+def insert_session_rows(db: Session, rows: Sequence[Dict[str, Any]]) -> List[int]:
+    """Insert prepared session rows; same contract as `insert_trace_rows`."""
+    cache.touch(db, cache.SESSIONS)
+    if events.bus.active:
+        events.record(db, events.SESSIONS, len(rows))
+    return _insert_returning_ids(db, AgentSession.__table__, rows)
+
+def insert_traces(db: Session, payloads: Sequence[LLMTraceCreate]) -> List[int]:
+    now = datetime.utcnow()
+    return insert_trace_rows(db, [trace_row(p, now) for p in payloads])
+
+def insert_spans(db: Session, payloads: Sequence[AgentSpanCreate]) -> List[int]:
+    now = datetime.utcnow()
+    return insert_span_rows(db, [span_row(p, now) for p in payloads])
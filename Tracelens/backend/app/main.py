@@ -1,14 +1,39 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from .database import Base, engine
-from .routers import metrics, traces, agents, alerts
+from . import alerting, migrations, partitions, retention, rollups, scheduler
+from .database import SessionLocal, dispose_engines, engine
+from .pagination import NEXT_CURSOR_HEADER
+from .routers import metrics, traces, agents, alerts, ingest, otlp
+from .write_buffer import write_buffer
 
-Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    with SessionLocal() as db:
+        rollups.ensure_built(db)
+    await write_buffer.start()
+    await alerting.engine.start()
+    await scheduler.scheduler.start()
+    await partitions.job.start()
+    await retention.job.start()
+    await rollups.job.start()
+    yield
+    # Drain buffered writes before the process exits
+    await write_buffer.stop()
+    await alerting.engine.stop()
+    await scheduler.scheduler.stop()
+    await rollups.job.stop()
+    await retention.job.stop()
+    await partitions.job.stop()
+    await dispose_engines()
 
 app = FastAPI(
     title="AI Observability API", 
     version="0.1.0",
-    description="Comprehensive AI observability platform for LLM tracking and agent workflow monitoring"
+    description="Comprehensive AI observability platform for LLM tracking and agent workflow monitoring",
+    lifespan=lifespan,
 )
 
 app.add_middleware(
@@ -17,12 +42,15 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
 app.include_router(metrics.router)
 app.include_router(traces.router)
 app.include_router(agents.router)
 app.include_router(alerts.router)
+app.include_router(ingest.router)
+app.include_router(otlp.router)
 
 @app.get("/health")
 def health():
@@ -0,0 +1,193 @@
+""" Versioned schema migrations.
+
+`create_all` only creates missing tables: it never adds a column or an index
+to a table that already exists. Schema changes are therefore applied here as
+numbered steps, each recorded in `schema_migrations` once it has run. Steps
+are idempotent (they check the live schema first), so databases created by
+an older `create_all` and databases created from scratch converge on the same
+schema. The app upgrades on startup; to run or inspect migrations by hand:
+
+    python -m app.migrations upgrade
+    python -m app.migrations status
+"""
+import logging
+import sys
+from datetime import datetime
+from typing import Callable, List, Tuple
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, bindparam, func, inspect, select, text, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import IntegrityError
+from .database import Base
+from . import models  # noqa: F401  (registers every table on Base.metadata)
+
+logger = logging.getLogger(__name__)
+
+schema_migrations = Table(
+    "schema_migrations", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("name", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+# Serializes concurrent upgrades from several workers on PostgreSQL
+LOCK_KEY = 72150002
+
+def _create_tables(conn: Connection, *names: str):
+    Base.metadata.create_all(conn, tables=[Base.metadata.tables[name] for name in names])
+
+def _add_columns(conn: Connection, table_name: str, *column_names: str):
+    """ALTER TABLE ... ADD COLUMN for model columns the live table lacks (without constraints)."""
+    existing = {c["name"] for c in inspect(conn).get_columns(table_name)}
+    table = Base.metadata.tables[table_name]
+    for name in column_names:
+        if name in existing:
+            continue
+        quote = conn.dialect.identifier_preparer.quote
+        column_type = table.c[name].type.compile(dialect=conn.dialect)
+        conn.execute(text(f"ALTER TABLE {quote(table_name)} ADD COLUMN {quote(name)} {column_type}"))
+
+def _create_indexes(conn: Connection, *names: str):
+    wanted = set(names)
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name in wanted:
+                index.create(conn, checkfirst=True)
+                wanted.discard(index.name)
+    if wanted:
+        raise LookupError(f"Indexes not declared on the models: {', '.join(sorted(wanted))}")
+
+def _threshold_alert_identity(conn: Connection):
+    _add_columns(conn, "alerts", "threshold_id", "group_key")
+    _create_indexes(conn, "ix_alerts_threshold_id")
+    _create_tables(conn, "scheduler_leases")
+    # Resolve duplicates raised before the index existed, keeping the oldest open alert of each group
+    conn.execute(text(
+        "UPDATE alerts SET resolved_at = :now WHERE resolved_at IS NULL AND threshold_id IS NOT NULL"
+        " AND id NOT IN (SELECT min(id) FROM alerts WHERE resolved_at IS NULL AND threshold_id IS NOT NULL"
+        " GROUP BY threshold_id, group_key)"
+    ), {"now": datetime.utcnow()})
+    _create_indexes(conn, "uq_alerts_open_threshold_group")
+
+def _critical_path(conn: Connection):
+    _add_columns(conn, "agent_spans", "self_time_ms", "critical_time_ms")
+    _add_columns(conn, "agent_sessions", "critical_path_ms")
+
+def _retention(conn: Connection):
+    _create_tables(conn, "agent_span_rollups_day")
+    _create_indexes(
+        conn,
+        "ix_llm_traces_span_id", "ix_llm_traces_metadata_blob",
+        "ix_agent_spans_prompt_blob", "ix_agent_spans_output_blob",
+        "ix_alerts_trace_id", "ix_alerts_span_id",
+    )
+
+def _blob_store(conn: Connection):
+    _create_tables(conn, "blobs")
+    _add_columns(conn, "agent_spans", "prompt_blob", "output_blob")
+    _add_columns(conn, "llm_traces", "metadata_blob")
+
+def _blob_used_at(conn: Connection):
+    _add_columns(conn, "blobs", "used_at")
+    _create_indexes(conn, "ix_blobs_used_at")
+
+def _otel_span_ids(conn: Connection, batch_size: int = 1000):
+    _add_columns(conn, "agent_spans", "otel_span_id", "otel_parent_span_id")
+    _create_indexes(conn, "ix_agent_spans_trace_id_otel_span_id")
+    # Spans received over OTLP before this step carry the ids in their metadata only
+    table = Base.metadata.tables["agent_spans"]
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(table.c.id, table.c["metadata"])
+            .where(table.c.id > last_id, table.c.trace_id.isnot(None), table.c.otel_span_id.is_(None))
+            .order_by(table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            return
+        last_id = rows[-1].id
+        ids = []
+        for span_id, metadata in rows:
+            otel = (metadata or {}).get("otel") or {}
+            if otel.get("span_id"):
+                ids.append({"_id": span_id, "_span": otel["span_id"], "_parent": otel.get("parent_span_id")})
+        if ids:
+            conn.execute(
+                update(table).where(table.c.id == bindparam("_id"))
+                .values(otel_span_id=bindparam("_span"), otel_parent_span_id=bindparam("_parent")),
+                ids,
+            )
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "baseline tables", lambda conn: Base.metadata.create_all(conn)),
+    (2, "alert threshold window and group_by", lambda conn: _add_columns(conn, "alert_thresholds", "window", "group_by")),
+    (3, "threshold alert identity and scheduler leases", _threshold_alert_identity),
+    (4, "keyset pagination indexes", lambda conn: _create_indexes(
+        conn, "ix_llm_traces_created_at_id", "ix_agent_sessions_started_at_id", "ix_alerts_created_at_id",
+    )),
+    (5, "composite indexes for filtered listings", lambda conn: _create_indexes(
+        conn,
+        "ix_agent_spans_session_id_created_at",
+        "ix_llm_traces_status_created_at",
+        "ix_llm_traces_model_provider_created_at",
+        "ix_llm_traces_session_id",
+        "ix_alerts_metric_name_acknowledged_created_at",
+        "ix_alerts_severity_acknowledged",
+        "ix_agent_sessions_status_started_at",
+    )),
+    (6, "span tree indexes", lambda conn: _create_indexes(
+        conn, "ix_agent_spans_parent_id", "ix_agent_spans_session_id_parent_id",
+    )),
+    # Existing payloads are moved by `python -m app.blobs migrate`, not on startup
+    (7, "blob store for span and trace payloads", _blob_store),
+    (8, "session trace pages", lambda conn: _create_indexes(conn, "ix_llm_traces_session_id_created_at_id")),
+    (9, "span self time and session critical path", _critical_path),
+    (10, "retention: span history and reference indexes", _retention),
+    (11, "blob reuse time", _blob_used_at),
+    # Partitions themselves are created by app.partitions when TRACE_PARTITIONING is set
+    (12, "trace partition catalog", lambda conn: _create_tables(conn, "trace_partitions")),
+    (13, "OTLP span ids", _otel_span_ids),
+]
+
+def applied_versions(conn: Connection) -> set:
+    schema_migrations.create(conn, checkfirst=True)
+    return set(conn.execute(select(schema_migrations.c.version)).scalars())
+
+def upgrade(engine: Engine) -> List[int]:
+    """Apply every pending migration, one transaction each; returns the versions applied."""
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if version in done:
+            continue
+        try:
+            with engine.begin() as conn:
+                if conn.dialect.name == "postgresql":
+                    conn.execute(select(func.pg_advisory_xact_lock(LOCK_KEY)))
+                    if version in applied_versions(conn):
+                        continue
+                step(conn)
+                conn.execute(schema_migrations.insert().values(version=version, name=name, applied_at=datetime.utcnow()))
+        except IntegrityError:
+            # Another worker recorded this version first
+            continue
+        logger.info("Applied migration %d: %s", version, name)
+        applied.append(version)
+    return applied
+
+def status(engine: Engine) -> List[Tuple[int, str, bool]]:
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    return [(version, name, version in done) for version, name, _ in MIGRATIONS]
+
+if __name__ == "__main__":
+    from .database import engine
+    command = sys.argv[1:]
+    if command == ["upgrade"]:
+        versions = upgrade(engine)
+        print(f"Applied {len(versions)} migration(s)" + (f": {', '.join(map(str, versions))}" if versions else ""))
+    elif command == ["status"]:
+        for version, name, done in status(engine):
+            print(f"{version:4d}  {'applied' if done else 'pending':8s}  {name}")
+    else:
+        sys.exit("usage: python -m app.migrations upgrade|status")
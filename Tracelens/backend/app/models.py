@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, JSON
+from sqlalchemy import Column, Integer, String, Float, DateTime, ForeignKey, Boolean, Text, JSON, LargeBinary, UniqueConstraint, Index, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from .database import Base
@@ -27,7 +27,20 @@ class LLMTrace(Base):
     endpoint = Column(String, nullable=True)
     temperature = Column(Float, nullable=True)
     max_tokens = Column(Integer, nullable=True)
-    metadata = Column(JSON, nullable=True)  # Store additional context
+    metadata_ = Column("metadata", JSON, nullable=True)  # Store additional context; `metadata` is reserved by declarative
+    metadata_blob = Column(String(64), ForeignKey("blobs.hash"), nullable=True)  # set instead of metadata when large
+    # Keyset pagination order (see app.pagination)
+    __table_args__ = (
+        Index("ix_llm_traces_created_at_id", "created_at", "id"),
+        Index("ix_llm_traces_status_created_at", "status", "created_at"),
+        Index("ix_llm_traces_model_provider_created_at", "model", "provider", "created_at"),
+        Index("ix_llm_traces_session_id", "session_id"),
+        Index("ix_llm_traces_session_id_created_at_id", "session_id", "created_at", "id"),
+        # Reference lookups when retention deletes spans and blobs
+        Index("ix_llm_traces_span_id", "span_id"),
+        Index("ix_llm_traces_metadata_blob", "metadata_blob",
+              postgresql_where=text("metadata_blob IS NOT NULL"), sqlite_where=text("metadata_blob IS NOT NULL")),
+    )
 
 class AgentSession(Base):
     __tablename__ = "agent_sessions"
@@ -41,7 +54,12 @@ class AgentSession(Base):
     total_tokens = Column(Integer, default=0)
     total_cost_usd = Column(Float, default=0.0)
     error_message = Column(Text, nullable=True)
-    metadata = Column(JSON, nullable=True)
+    metadata_ = Column("metadata", JSON, nullable=True)
+    critical_path_ms = Column(Float, nullable=True)  # set when completed/failed, see app.critical_path
+    __table_args__ = (
+        Index("ix_agent_sessions_started_at_id", "started_at", "id"),
+        Index("ix_agent_sessions_status_started_at", "status", "started_at"),
+    )
 
     spans = relationship("AgentSpan", back_populates="session", cascade="all, delete-orphan")
 
@@ -68,8 +86,28 @@ class AgentSpan(Base):
     provider_used = Column(String, nullable=True)
     tool_calls = Column(JSON, nullable=True)  # Store tool call details
     reasoning_steps = Column(JSON, nullable=True)  # Store chain-of-thought steps
-    metadata = Column(JSON, nullable=True)
+    metadata_ = Column("metadata", JSON, nullable=True)
     trace_id = Column(String, nullable=True, index=True)  # For distributed tracing
+    # Large prompts/outputs live in `blobs` (see app.blobs); the text column is then NULL
+    prompt_blob = Column(String(64), ForeignKey("blobs.hash"), nullable=True)
+    output_blob = Column(String(64), ForeignKey("blobs.hash"), nullable=True)
+    # Time no child was running, and this span's share of the session's critical path (NULL when off it)
+    self_time_ms = Column(Float, nullable=True)
+    critical_time_ms = Column(Float, nullable=True)
+    # OTLP ids of spans received on /v1/traces, so spans exported in separate requests find their parents
+    otel_span_id = Column(String, nullable=True)
+    otel_parent_span_id = Column(String, nullable=True)
+    __table_args__ = (
+        Index("ix_agent_spans_session_id_created_at", "session_id", "created_at"),
+        Index("ix_agent_spans_trace_id_otel_span_id", "trace_id", "otel_span_id"),
+        # Child and root lookups for span trees
+        Index("ix_agent_spans_parent_id", "parent_id"),
+        Index("ix_agent_spans_session_id_parent_id", "session_id", "parent_id"),
+        Index("ix_agent_spans_prompt_blob", "prompt_blob",
+              postgresql_where=text("prompt_blob IS NOT NULL"), sqlite_where=text("prompt_blob IS NOT NULL")),
+        Index("ix_agent_spans_output_blob", "output_blob",
+              postgresql_where=text("output_blob IS NOT NULL"), sqlite_where=text("output_blob IS NOT NULL")),
+    )
 
     session = relationship("AgentSession", back_populates="spans")
     parent = relationship("AgentSpan", remote_side=[id])
@@ -93,8 +131,23 @@ class Alert(Base):
     session_id = Column(Integer, ForeignKey("agent_sessions.id"), nullable=True)
     span_id = Column(Integer, ForeignKey("agent_spans.id"), nullable=True)
     trace_id = Column(Integer, ForeignKey("llm_traces.id"), nullable=True)
-    metadata = Column(JSON, nullable=True)
+    metadata_ = Column("metadata", JSON, nullable=True)
     resolved_at = Column(DateTime, nullable=True)
+    # Set on threshold alerts: the rule that fired and the group it fired for ("" when ungrouped)
+    threshold_id = Column(Integer, ForeignKey("alert_thresholds.id", ondelete="SET NULL"), nullable=True, index=True)
+    group_key = Column(String, nullable=True)
+    __table_args__ = (
+        Index("ix_alerts_created_at_id", "created_at", "id"),
+        Index("ix_alerts_metric_name_acknowledged_created_at", "metric_name", "acknowledged", "created_at"),
+        # Covers the by-severity summary
+        Index("ix_alerts_severity_acknowledged", "severity", "acknowledged"),
+        # At most one open alert per threshold and group, whichever evaluator raises it
+        Index("uq_alerts_open_threshold_group", "threshold_id", "group_key", unique=True,
+              postgresql_where=text("resolved_at IS NULL AND threshold_id IS NOT NULL"),
+              sqlite_where=text("resolved_at IS NULL AND threshold_id IS NOT NULL")),
+        Index("ix_alerts_trace_id", "trace_id"),
+        Index("ix_alerts_span_id", "span_id"),
+    )
 
 class AlertThreshold(Base):
     __tablename__ = "alert_thresholds"
@@ -106,3 +159,96 @@ class AlertThreshold(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     description = Column(Text, nullable=True)
+    window = Column(String, default="5m")  # sliding window: 1m | 5m | 1h
+    group_by = Column(String, nullable=True)  # None | model | provider | model_provider
+
+class TraceRollupColumns:
+    """Pre-aggregated LLM trace metrics for one (bucket, model, provider, status)"""
+    id = Column(Integer, primary_key=True)
+    bucket = Column(DateTime, nullable=False)  # start of the time bucket (UTC); indexed by the unique key
+    model = Column(String, nullable=False, default="")     # "" stands in for NULL so the unique key holds
+    provider = Column(String, nullable=False, default="")
+    status = Column(String, nullable=False, default="")
+    request_count = Column(Integer, default=0)
+    latency_sum = Column(Float, default=0.0)
+    latency_min = Column(Float, nullable=True)
+    latency_max = Column(Float, nullable=True)
+    tokens_sum = Column(Integer, default=0)
+    input_tokens_sum = Column(Integer, default=0)
+    output_tokens_sum = Column(Integer, default=0)
+    cost_sum = Column(Float, default=0.0)
+
+class TraceRollupMinute(TraceRollupColumns, Base):
+    __tablename__ = "llm_trace_rollups_minute"
+    __table_args__ = (UniqueConstraint("bucket", "model", "provider", "status", name="uq_llm_trace_rollups_minute_key"),)
+
+class TraceRollupHour(TraceRollupColumns, Base):
+    __tablename__ = "llm_trace_rollups_hour"
+    __table_args__ = (UniqueConstraint("bucket", "model", "provider", "status", name="uq_llm_trace_rollups_hour_key"),)
+
+class SpanRollupDay(Base):
+    """Daily aggregates of agent spans removed by retention (see app.retention)"""
+    __tablename__ = "agent_span_rollups_day"
+    id = Column(Integer, primary_key=True)
+    bucket = Column(DateTime, nullable=False)  # start of the UTC day
+    span_type = Column(String, nullable=False, default="")  # "" stands in for NULL so the unique key holds
+    name = Column(String, nullable=False, default="")
+    status = Column(String, nullable=False, default="")
+    span_count = Column(Integer, default=0)
+    latency_sum = Column(Float, default=0.0)
+    latency_max = Column(Float, nullable=True)
+    tokens_sum = Column(Integer, default=0)
+    cost_sum = Column(Float, default=0.0)
+    __table_args__ = (UniqueConstraint("bucket", "span_type", "name", "status", name="uq_agent_span_rollups_day_key"),)
+
+class TracePartition(Base):
+    """One time range of `llm_traces` stored as its own partition (see app.partitions)"""
+    __tablename__ = "trace_partitions"
+    name = Column(String, primary_key=True)  # PostgreSQL partition table, or SQLite schema the file is attached as
+    range_start = Column(DateTime, nullable=True)  # NULL: unbounded (an existing table converted into the first partition)
+    range_end = Column(DateTime, nullable=False)  # exclusive
+    path = Column(String, nullable=True)  # SQLite database file
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class LatencySketch(Base):
+    """Serialized DDSketch of trace latencies for one (granularity, bucket, model, provider)"""
+    __tablename__ = "latency_sketches"
+    id = Column(Integer, primary_key=True)
+    granularity = Column(String, nullable=False)  # minute | hour | day
+    bucket = Column(DateTime, nullable=False)
+    model = Column(String, nullable=False, default="")
+    provider = Column(String, nullable=False, default="")
+    request_count = Column(Integer, default=0)
+    sketch = Column(LargeBinary, nullable=False)
+    __table_args__ = (UniqueConstraint("granularity", "bucket", "model", "provider", name="uq_latency_sketches_key"),)
+
+class LatencySketchDelta(Base):
+    """Minute sketch written by one ingest transaction, not yet folded into latency_sketches"""
+    __tablename__ = "latency_sketch_deltas"
+    id = Column(Integer, primary_key=True)
+    bucket = Column(DateTime, nullable=False)
+    model = Column(String, nullable=False, default="")
+    provider = Column(String, nullable=False, default="")
+    request_count = Column(Integer, default=0)
+    sketch = Column(LargeBinary, nullable=False)
+    __table_args__ = (Index("ix_latency_sketch_deltas_bucket", "bucket"),)
+
+class SchedulerLease(Base):
+    """Leader lease for background jobs on databases without advisory locks"""
+    __tablename__ = "scheduler_leases"
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+class Blob(Base):
+    """Compressed payload shared by every row whose content hashes to `hash`"""
+    __tablename__ = "blobs"
+    hash = Column(String(64), primary_key=True)  # SHA-256 hex of the uncompressed UTF-8 text
+    codec = Column(String, nullable=False, default="zlib")  # zlib | raw
+    size = Column(Integer, nullable=False)  # uncompressed bytes
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    # Last time a writer stored or reused this blob; retention spares recently used blobs
+    used_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (Index("ix_blobs_used_at", "used_at"),)
@@ -0,0 +1,363 @@
+""" OTLP trace decoding and mapping onto AgentSpan / LLMTrace rows.
+
+Both OTLP/HTTP encodings are normalized to the OTLP/JSON shape (camelCase keys,
+hex-encoded ids) before mapping. GenAI semantic-convention attributes
+(`gen_ai.*`) fill the model, provider, token and prompt columns; spans that
+describe a model call additionally produce an LLMTrace row.
+
+Spans of one OTLP trace may arrive in any order and across export requests:
+parents are linked by OTLP span id whichever of the two is stored first, and
+a root arriving after its children updates the session created for them.
+"""
+import base64
+import json
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from sqlalchemy import bindparam, case, func, select, update
+from sqlalchemy.orm import Session
+from . import cache
+from .ingest import insert_session_rows, insert_span_rows, insert_trace_rows
+from .models import AgentSession, AgentSpan
+
+PROTOBUF = "application/x-protobuf"
+
+STATUS_ERROR = (2, "STATUS_CODE_ERROR")
+LLM_OPERATIONS = {"chat", "text_completion", "generate_content", "embeddings"}
+SPAN_TYPES_BY_OPERATION = {
+    "execute_tool": "tool",
+    "invoke_agent": "agent",
+    "create_agent": "agent",
+}
+
+class OTLPDecodeError(ValueError):
+    pass
+
+def decode_request(body: bytes, content_type: str) -> Dict[str, Any]:
+    """Decode an ExportTraceServiceRequest body into its OTLP/JSON dict form."""
+    if content_type.startswith(PROTOBUF):
+        try:
+            from google.protobuf.json_format import MessageToDict
+            from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceRequest
+        except ImportError:
+            raise OTLPDecodeError("Protobuf encoding requires the opentelemetry-proto package")
+        try:
+            message = ExportTraceServiceRequest.FromString(body)
+        except Exception as e:
+            raise OTLPDecodeError(f"Invalid protobuf payload: {e}")
+        data = MessageToDict(message)
+        # The protobuf JSON mapping renders bytes as base64; OTLP/JSON uses hex
+        for resource_spans in data.get("resourceSpans", []):
+            for scope_spans in resource_spans.get("scopeSpans", []):
+                for span in scope_spans.get("spans", []):
+                    for key in ("traceId", "spanId", "parentSpanId"):
+                        if span.get(key):
+                            span[key] = base64.b64decode(span[key]).hex()
+        return data
+    try:
+        data = json.loads(body)
+    except ValueError as e:
+        raise OTLPDecodeError(f"Invalid JSON payload: {e}")
+    if not isinstance(data, dict):
+        raise OTLPDecodeError("Payload must be a JSON object")
+    return data
+
+def encode_response(content_type: str, rejected_spans: int = 0, error_message: str = "") -> Tuple[bytes, str]:
+    """Build an ExportTraceServiceResponse in the encoding of the request."""
+    if content_type.startswith(PROTOBUF):
+        from opentelemetry.proto.collector.trace.v1.trace_service_pb2 import ExportTraceServiceResponse
+        message = ExportTraceServiceResponse()
+        if rejected_spans:
+            message.partial_success.rejected_spans = rejected_spans
+            message.partial_success.error_message = error_message
+        return message.SerializeToString(), PROTOBUF
+    body = {}
+    if rejected_spans:
+        body["partialSuccess"] = {"rejectedSpans": rejected_spans, "errorMessage": error_message}
+    return json.dumps(body).encode(), "application/json"
+
+def _any_value(value: Dict[str, Any]) -> Any:
+    if "stringValue" in value:
+        return value["stringValue"]
+    if "intValue" in value:
+        return int(value["intValue"])
+    if "doubleValue" in value:
+        return float(value["doubleValue"])
+    if "boolValue" in value:
+        return bool(value["boolValue"])
+    if "arrayValue" in value:
+        return [_any_value(v) for v in value["arrayValue"].get("values", [])]
+    if "kvlistValue" in value:
+        return _attributes(value["kvlistValue"].get("values", []))
+    if "bytesValue" in value:
+        return value["bytesValue"]
+    return None
+
+def _attributes(items: List[Dict[str, Any]]) -> Dict[str, Any]:
+    return {item["key"]: _any_value(item.get("value", {})) for item in items or [] if "key" in item}
+
+def _timestamp(nanos: Any) -> Optional[datetime]:
+    if not nanos or int(nanos) == 0:
+        return None
+    return datetime.fromtimestamp(int(nanos) / 1e9, tz=timezone.utc).replace(tzinfo=None)
+
+def _text(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return value if isinstance(value, str) else json.dumps(value)
+
+def _int(value: Any) -> int:
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+def _pop_first(attrs: Dict[str, Any], *keys: str) -> Any:
+    """Remove all of `keys` from `attrs`, returning the value of the first one present."""
+    values = [attrs.pop(key) for key in keys if key in attrs]
+    return values[0] if values else None
+
+def iter_spans(request: Dict[str, Any]) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Yield (resource attributes, span) pairs from a decoded export request."""
+    for resource_spans in request.get("resourceSpans", []):
+        resource = _attributes(resource_spans.get("resource", {}).get("attributes", []))
+        for scope_spans in resource_spans.get("scopeSpans", []):
+            for span in scope_spans.get("spans", []):
+                yield resource, span
+
+def map_span(resource: Dict[str, Any], span: Dict[str, Any]) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+    """Map one OTLP span onto an AgentSpan row and, for model calls, an LLMTrace row.
+
+    `session_id` and `parent_id` are left for the caller to resolve.
+    """
+    attrs = _attributes(span.get("attributes", []))
+    started_at = _timestamp(span.get("startTimeUnixNano"))
+    ended_at = _timestamp(span.get("endTimeUnixNano"))
+    if not span.get("traceId") or not span.get("spanId") or started_at is None:
+        raise ValueError("span is missing traceId, spanId or startTimeUnixNano")
+    latency_ms = (int(span["endTimeUnixNano"]) - int(span["startTimeUnixNano"])) / 1e6 if ended_at else 0.0
+
+    status = span.get("status", {})
+    failed = status.get("code") in STATUS_ERROR
+    operation = attrs.get("gen_ai.operation.name")
+    provider = attrs.get("gen_ai.provider.name") or attrs.get("gen_ai.system")
+    model = attrs.get("gen_ai.response.model") or attrs.get("gen_ai.request.model")
+    input_tokens = _int(attrs.get("gen_ai.usage.input_tokens", attrs.get("gen_ai.usage.prompt_tokens")))
+    output_tokens = _int(attrs.get("gen_ai.usage.output_tokens", attrs.get("gen_ai.usage.completion_tokens")))
+    cost = float(attrs.get("gen_ai.usage.cost") or 0.0)
+
+    span_type = attrs.get("tracelens.span.type")
+    if not span_type:
+        if operation in LLM_OPERATIONS or (operation is None and model and provider):
+            span_type = "llm_call"
+        elif operation in SPAN_TYPES_BY_OPERATION:
+            span_type = SPAN_TYPES_BY_OPERATION[operation]
+        else:
+            span_type = "tool" if span.get("parentSpanId") else "agent"
+
+    tool_calls = None
+    if attrs.get("gen_ai.tool.name"):
+        tool_calls = {"tool_name": attrs["gen_ai.tool.name"], "call_id": attrs.get("gen_ai.tool.call.id")}
+
+    # Payloads go to the prompt/output columns (and blobs when large), not into the metadata
+    prompt = _pop_first(attrs, "gen_ai.prompt", "gen_ai.input.messages")
+    output = _pop_first(attrs, "gen_ai.completion", "gen_ai.output.messages")
+
+    span_row = {
+        "session_id": None,
+        "parent_id": None,
+        "span_type": span_type,
+        "name": span.get("name") or operation or "span",
+        "status": "failure" if failed else "success",
+        "latency_ms": latency_ms,
+        "prompt": _text(prompt),
+        "output": _text(output),
+        "error": status.get("message") if failed else None,
+        "started_at": started_at,
+        "ended_at": ended_at,
+        "tokens_used": input_tokens + output_tokens,
+        "cost_usd": cost,
+        "model_used": model,
+        "provider_used": provider,
+        "tool_calls": tool_calls,
+        "reasoning_steps": None,
+        "metadata": {
+            "otel": {
+                "span_id": span["spanId"],
+                "parent_span_id": span.get("parentSpanId") or None,
+                "kind": span.get("kind"),
+                "service_name": resource.get("service.name"),
+            },
+            "attributes": attrs,
+        },
+        "trace_id": span["traceId"],
+        "otel_span_id": span["spanId"],
+        "otel_parent_span_id": span.get("parentSpanId") or None,
+        "created_at": started_at,
+    }
+
+    trace_row = None
+    if span_type == "llm_call" and model:
+        trace_row = {
+            "model": model,
+            "provider": provider or "unknown",
+            "latency_ms": latency_ms,
+            "tokens": input_tokens + output_tokens,
+            "cost_usd": cost,
+            "status": span_row["status"],
+            "session_id": None,
+            "span_id": None,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "prompt_tokens": input_tokens,
+            "completion_tokens": output_tokens,
+            "error_message": span_row["error"],
+            "request_id": attrs.get("gen_ai.response.id"),
+            "user_id": attrs.get("enduser.id") or attrs.get("user.id"),
+            "endpoint": attrs.get("server.address"),
+            "temperature": attrs.get("gen_ai.request.temperature"),
+            "max_tokens": attrs.get("gen_ai.request.max_tokens"),
+            "metadata": {"otel": {"trace_id": span["traceId"], "span_id": span["spanId"]}},
+            "created_at": started_at,
+        }
+    return span_row, trace_row
+
+def _existing_sessions(db: Session, trace_ids: List[str]) -> Dict[str, int]:
+    rows = db.execute(
+        select(AgentSpan.trace_id, func.min(AgentSpan.session_id))
+        .where(AgentSpan.trace_id.in_(trace_ids))
+        .group_by(AgentSpan.trace_id)
+    ).all()
+    return {trace_id: session_id for trace_id, session_id in rows}
+
+def _existing_span_ids(db: Session, wanted: set) -> Dict[Tuple[str, str], int]:
+    """Find spans exported by earlier requests, keyed by (trace id, OTLP span id)."""
+    table = AgentSpan.__table__
+    rows = db.execute(
+        select(table.c.trace_id, table.c.otel_span_id, table.c.id).where(
+            table.c.trace_id.in_(sorted({trace_id for trace_id, _ in wanted})),
+            table.c.otel_span_id.in_(sorted({span_id for _, span_id in wanted})),
+        )
+    )
+    return {(trace_id, otel_span_id): span_id for trace_id, otel_span_id, span_id in rows
+            if (trace_id, otel_span_id) in wanted}
+
+def _stored_orphans(db: Session, parents: set) -> List[Tuple[int, str, str]]:
+    """(id, trace id, OTLP parent span id) of stored spans still waiting for one of `parents`."""
+    table = AgentSpan.__table__
+    rows = db.execute(
+        select(table.c.id, table.c.trace_id, table.c.otel_parent_span_id).where(
+            table.c.trace_id.in_(sorted({trace_id for trace_id, _ in parents})),
+            table.c.otel_parent_span_id.in_(sorted({span_id for _, span_id in parents})),
+            table.c.parent_id.is_(None),
+        )
+    )
+    return [row for row in rows if (row[1], row[2]) in parents]
+
+def _session_status(root: Optional[Dict[str, Any]]) -> str:
+    if root is not None and root["ended_at"]:
+        return "failed" if root["status"] == "failure" else "completed"
+    return "running"
+
+def _update_sessions(db: Session, roots: Dict[int, Dict[str, Any]]):
+    """Give sessions created from earlier exports the name, status and end of their root span."""
+    table = AgentSession.__table__
+    for session_id, root in sorted(roots.items()):
+        db.execute(
+            update(table).where(table.c.id == session_id).values(
+                title=root["name"],
+                status=_session_status(root),
+                ended_at=root["ended_at"],
+                started_at=case((table.c.started_at > root["started_at"], root["started_at"]),
+                                else_=table.c.started_at),
+            )
+        )
+    cache.touch(db, cache.SESSIONS)
+
+def ingest_export_request(db: Session, request: Dict[str, Any]) -> Tuple[int, int, List[str]]:
+    """Write every span of one export request in a single transaction.
+
+    Returns (accepted spans, LLM traces written, rejection messages). The caller commits.
+    """
+    spans, traces, errors = [], [], []
+    roots: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+    first_seen: Dict[str, Tuple[Dict[str, Any], Dict[str, Any]]] = {}
+    users: Dict[str, str] = {}
+    for resource, span in iter_spans(request):
+        try:
+            span_row, trace_row = map_span(resource, span)
+        except (ValueError, TypeError, KeyError) as e:
+            errors.append(str(e))
+            continue
+        attrs = span_row["metadata"]["attributes"]
+        if attrs.get("tracelens.session_id") is not None:
+            span_row["session_id"] = _int(attrs["tracelens.session_id"])
+        spans.append(span_row)
+        traces.append(trace_row)
+        trace_id = span_row["trace_id"]
+        if trace_id not in first_seen or span_row["started_at"] < first_seen[trace_id][1]["started_at"]:
+            first_seen[trace_id] = (resource, span_row)
+        if trace_row and trace_row["user_id"]:
+            users.setdefault(trace_id, trace_row["user_id"])
+        if not span.get("parentSpanId"):
+            roots[span_row["trace_id"]] = (resource, span_row)
+    if not spans:
+        return 0, 0, errors
+
+    # One session per OTLP trace, reusing the session of spans exported earlier
+    trace_ids = sorted({row["trace_id"] for row in spans if row["session_id"] is None})
+    sessions = _existing_sessions(db, trace_ids) if trace_ids else {}
+    # Roots arriving after their children finish the session those created
+    late_roots = {sessions[t]: roots[t][1] for t in trace_ids if t in sessions and t in roots}
+    if late_roots:
+        _update_sessions(db, late_roots)
+    new_trace_ids = [t for t in trace_ids if t not in sessions]
+    if new_trace_ids:
+        session_rows = []
+        for trace_id in new_trace_ids:
+            resource, earliest = first_seen[trace_id]
+            root = roots.get(trace_id, (None, None))[1]
+            session_rows.append({
+                "user_id": users.get(trace_id),
+                "title": root["name"] if root else (resource.get("service.name") or trace_id),
+                "status": _session_status(root),
+                "started_at": earliest["started_at"],
+                "ended_at": root["ended_at"] if root else None,
+                "metadata": {"otel": {"trace_id": trace_id, "service_name": resource.get("service.name")}},
+            })
+        new_ids = insert_session_rows(db, session_rows)
+        sessions.update(zip(new_trace_ids, new_ids))
+    for row in spans:
+        if row["session_id"] is None:
+            row["session_id"] = sessions[row["trace_id"]]
+
+    # Spans of earlier exports whose parent is in this one; looked up before the insert adds more
+    orphans = _stored_orphans(db, {(row["trace_id"], row["otel_span_id"]) for row in spans})
+    span_ids = insert_span_rows(db, spans)
+    by_otel_id = {(row["trace_id"], row["otel_span_id"]): span_id for row, span_id in zip(spans, span_ids)}
+
+    # Parents are linked after the insert so spans may arrive in any order
+    wanted = {(row["trace_id"], row["otel_parent_span_id"]) for row in spans if row["otel_parent_span_id"]}
+    missing = wanted - by_otel_id.keys()
+    if missing:
+        by_otel_id.update(_existing_span_ids(db, missing))
+    links = []
+    for row, span_id in zip(spans, span_ids):
+        parent = by_otel_id.get((row["trace_id"], row["otel_parent_span_id"]))
+        if parent is not None:
+            links.append({"_id": span_id, "_parent": parent})
+    for span_id, trace_id, otel_parent_span_id in orphans:
+        links.append({"_id": span_id, "_parent": by_otel_id[(trace_id, otel_parent_span_id)]})
+    if links:
+        table = AgentSpan.__table__
+        db.execute(
+            update(table).where(table.c.id == bindparam("_id")).values(parent_id=bindparam("_parent")),
+            links,
+        )
+
+    trace_rows = []
+    for row, span_id, trace_row in zip(spans, span_ids, traces):
+        if trace_row is not None:
+            trace_row.update(session_id=row["session_id"], span_id=span_id)
+            trace_rows.append(trace_row)
+    insert_trace_rows(db, trace_rows)
+    return len(spans), len(trace_rows), errors
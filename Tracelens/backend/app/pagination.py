@@ -0,0 +1,49 @@
+""" Keyset pagination for newest-first listings.
+
+Pages are ordered by (timestamp, id) descending and continue from an opaque
+cursor encoding the last row's key, so every page is one index range scan of
+`limit + 1` rows however deep the client has paged, and rows inserted while
+paging neither shift nor repeat later pages. The next cursor is returned in
+the `X-Next-Cursor` response header (absent on the last page) so list
+responses keep their shape; `offset` still works for older clients.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+from fastapi import HTTPException, Response
+from sqlalchemy import tuple_
+from sqlalchemy.orm import Query
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+def encode_cursor(ts: datetime, row_id: int) -> str:
+    raw = json.dumps([ts.isoformat(), row_id], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        ts, row_id = json.loads(raw)
+        return datetime.fromisoformat(ts), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def paginate(q: Query, ts_column, id_column, response: Response, limit: int,
+             offset: int = 0, cursor: Optional[str] = None) -> List:
+    """Newest-first page of `q` after `cursor` (or at `offset`); sets the next cursor header."""
+    if cursor:
+        ts, row_id = decode_cursor(cursor)
+        # Row-value comparison: a single range on the (timestamp, id) index
+        q = q.filter(tuple_(ts_column, id_column) < tuple_(ts, row_id))
+    q = q.order_by(ts_column.desc(), id_column.desc())
+    if offset and not cursor:
+        q = q.offset(offset)
+    rows = q.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            getattr(last, ts_column.key), getattr(last, id_column.key)
+        )
+    return rows
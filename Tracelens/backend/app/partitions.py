@@ -0,0 +1,554 @@
+""" Time-partitioned storage for `llm_traces` (optional).
+
+With TRACE_PARTITIONING=day or week, traces are kept in one partition per
+period: time-bounded queries read only the partitions their `created_at`
+range overlaps, and retention drops a whole expired partition instead of
+deleting its rows one chunk at a time.
+
+PostgreSQL: `llm_traces` becomes a declarative table partitioned by RANGE
+(created_at). The existing table is attached as its first partition, covering
+everything up to the end of the current period, so converting does not copy
+rows. An empty table is converted on startup; a populated one by hand with
+`python -m app.partitions convert` (it takes an exclusive lock while the
+(id, created_at) primary key is built). The planner then prunes partitions
+for `created_at` bounds, plan-time or at execution for bind parameters. A
+foreign key cannot reference a partitioned table by `id` alone, so the one
+from `alerts.trace_id` is dropped; retention still clears it.
+
+SQLite has no partitioned tables, so partitions are database files
+(TRACE_PARTITION_DIR, next to the database by default) attached to every
+connection. New rows are written to `llm_traces` in the main file as before;
+the rows of a period are moved into that period's file once the period after
+it is over too, so the current and previous periods, which the alert scheduler
+reads, stay in the main file. Read-engine connections see a temporary
+`llm_traces` view over the main table and every file, so API reads are
+unchanged. SQLite pushes a `created_at` bound into each file's index, so a
+file outside the window costs one index probe and no data pages. SQLite
+attaches at most 10 databases per connection: beyond TRACE_PARTITION_MAX_FILES
+files, older periods stay in the main file until retention drops a file, so
+prefer week periods with long retention.
+
+Upcoming partitions are created ahead (TRACE_PARTITIONS_AHEAD periods on
+PostgreSQL; on SQLite a period's file is created when its rows are moved,
+since new rows never go to files). A background job does this every
+TRACE_PARTITION_INTERVAL_SECONDS, elected like the alert scheduler, and
+`app.retention` drops partitions whose whole range has expired. By hand:
+
+    python -m app.partitions convert     # PostgreSQL: partition an existing llm_traces
+    python -m app.partitions maintain    # create upcoming partitions / move closed periods
+    python -m app.partitions list
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import Column, Index, MetaData, Table, delete, event, exists, func, insert, select, text, union_all, update
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+from . import cache, database, scheduler
+from .database import SessionLocal
+from .models import Alert, LLMTrace, TracePartition
+
+logger = logging.getLogger(__name__)
+
+PERIODS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+PERIOD = os.getenv("TRACE_PARTITIONING", "").lower()
+if PERIOD and PERIOD not in PERIODS:
+    raise ValueError(f"Unknown TRACE_PARTITIONING: {PERIOD} (expected one of {', '.join(PERIODS)})")
+ENABLED = bool(PERIOD)
+AHEAD = int(os.getenv("TRACE_PARTITIONS_AHEAD", "3"))
+INTERVAL_SECONDS = float(os.getenv("TRACE_PARTITION_INTERVAL_SECONDS", "3600"))
+# Rows per transaction when moving a period into its SQLite file
+CHUNK_SIZE = int(os.getenv("TRACE_PARTITION_CHUNK_SIZE", "5000"))
+PARTITION_DIR = os.getenv("TRACE_PARTITION_DIR")
+# SQLite's default SQLITE_MAX_ATTACHED; raise only for a build compiled with a higher limit
+MAX_FILES = int(os.getenv("TRACE_PARTITION_MAX_FILES", "10"))
+
+LEASE_NAME = "trace_partitions"
+ADVISORY_LOCK_KEY = 72150004
+
+DEFAULT_PARTITION = "llm_traces_default"
+LEGACY_PARTITION = "llm_traces_legacy"
+# Keys in a pooled SQLite connection's info: {schema name: file} attached to it, and
+# whether it has the TEMP `llm_traces` view over them
+ATTACHED = "trace_partitions"
+VIEW = "trace_partitions_view"
+
+def period_start(ts: datetime) -> datetime:
+    day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday()) if PERIOD == "week" else day
+
+def period_end(ts: datetime) -> datetime:
+    """Start of the period after the one containing `ts`."""
+    return period_start(ts) + PERIODS[PERIOD]
+
+def partition_name(start: datetime) -> str:
+    return f"llm_traces_p{start:%Y%m%d}"
+
+def _is_sqlite_file(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.get_backend_name() == "sqlite" and parsed.database not in (None, "", ":memory:")
+
+def _dialect(db: Session) -> str:
+    return db.get_bind().dialect.name
+
+_metadata = MetaData()
+_tables: Dict[Tuple[str, Optional[str]], Table] = {}
+
+def _table(name: str, schema: Optional[str] = None) -> Table:
+    """A copy of `llm_traces` named `name` in `schema`, with its indexes but no foreign keys."""
+    key = (name, schema)
+    if key not in _tables:
+        source = LLMTrace.__table__
+        table = Table(name, _metadata, *(
+            Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+            for column in source.columns
+        ), schema=schema)
+        for index in source.indexes:
+            Index(index.name, *(table.c[column.name] for column in index.columns),
+                  unique=index.unique, **index.dialect_kwargs)
+        _tables[key] = table
+    return _tables[key]
+
+def _literal(ts: datetime) -> str:
+    """Timestamp literal for DDL, where bind parameters are not allowed."""
+    return f"'{ts:%Y-%m-%d %H:%M:%S}'"
+
+def catalog(db: Session) -> List[TracePartition]:
+    return db.execute(select(TracePartition).order_by(TracePartition.range_end)).scalars().all()
+
+# --- SQLite: attaching partition files ---------------------------------------
+
+def _columns_sql() -> str:
+    return ", ".join(f'"{column.name}"' for column in LLMTrace.__table__.columns)
+
+def _refresh(dbapi_connection, connection_record, read_only: bool):
+    """Attach the catalog's files to a pooled connection (and detach dropped ones) on checkout.
+
+    Read-only connections also get a TEMP view named `llm_traces` over the main table and
+    every file, which shadows the main table for unqualified names.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        try:
+            cursor.execute("SELECT name, path FROM trace_partitions WHERE path IS NOT NULL ORDER BY name")
+            wanted = {name: path for name, path in cursor.fetchall() if os.path.exists(path)}
+        except sqlite3.OperationalError:
+            # Catalog not created yet (migrations have not run)
+            wanted = {}
+        attached = connection_record.info.get(ATTACHED, {})
+        if wanted == attached:
+            return
+        if read_only:
+            cursor.execute("PRAGMA query_only=OFF")
+        try:
+            if read_only:
+                cursor.execute("DROP VIEW IF EXISTS temp.llm_traces")
+            for name in sorted(attached.keys() - wanted.keys()):
+                cursor.execute(f'DETACH DATABASE "{name}"')
+            for name in sorted(wanted.keys() - attached.keys()):
+                cursor.execute(f'ATTACH DATABASE ? AS "{name}"', (wanted[name],))
+            connection_record.info[ATTACHED] = dict(wanted)
+            connection_record.info[VIEW] = read_only and bool(wanted)
+            if read_only and wanted:
+                columns = _columns_sql()
+                arms = [f"SELECT {columns} FROM main.llm_traces"] + [
+                    f'SELECT {columns} FROM "{name}".llm_traces' for name in sorted(wanted)
+                ]
+                cursor.execute("CREATE TEMP VIEW llm_traces AS " + " UNION ALL ".join(arms))
+        finally:
+            if read_only:
+                cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+def install(target, read_only: bool = False):
+    """Keep `target`'s connections (a sync engine, or an async engine's sync_engine) attached to the partition files."""
+    @event.listens_for(target, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        _refresh(dbapi_connection, connection_record, read_only)
+
+def _attached(db: Session) -> Dict[str, str]:
+    return dict(db.connection().connection.info.get(ATTACHED, {}))
+
+def archived_tables(db: Session) -> List[Table]:
+    """`llm_traces` of every SQLite partition file attached to this session's connection."""
+    if _dialect(db) != "sqlite":
+        return []
+    return [_table("llm_traces", name) for name in sorted(_attached(db))]
+
+def all_traces(db: Session):
+    """`llm_traces` including rows moved into SQLite partition files; elsewhere the table itself.
+
+    On the write engine this is a UNION ALL over the main table and every file. Read-engine
+    connections have the TEMP view named `llm_traces`, which already covers the files.
+    """
+    tables = archived_tables(db)
+    if not tables or db.connection().connection.info.get(VIEW):
+        return LLMTrace.__table__
+    names = [column.name for column in LLMTrace.__table__.columns]
+    return union_all(*(
+        select(*(table.c[name] for name in names)) for table in [_table("llm_traces", "main")] + tables
+    )).subquery("llm_traces")
+
+def _file(name: str) -> str:
+    database_path = make_url(database.DATABASE_URL).database
+    stem = os.path.splitext(os.path.basename(database_path))[0]
+    return os.path.join(PARTITION_DIR or os.path.dirname(os.path.abspath(database_path)), f"{stem}.{name}.db")
+
+def _remove_file(path: str):
+    for suffix in ("", "-wal", "-shm", "-journal"):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+def _sqlite_create(db: Session, ts: datetime) -> Optional[TracePartition]:
+    """Create the file for the period containing `ts`, clipped to its neighbours in the catalog."""
+    existing = catalog(db)
+    if len(existing) >= MAX_FILES:
+        logger.warning("%d trace partition files attached (TRACE_PARTITION_MAX_FILES); rows before %s stay "
+                       "in the main table until retention drops a file", len(existing), period_end(ts).isoformat())
+        return None
+    lo, hi = period_start(ts), period_end(ts)
+    for partition in existing:
+        if partition.range_end <= ts:
+            lo = max(lo, partition.range_end)
+        elif partition.range_start > ts:
+            hi = min(hi, partition.range_start)
+    name, path = partition_name(lo), _file(partition_name(lo))
+    # A file the catalog no longer lists is left over from a failed drop
+    _remove_file(path)
+    db.commit()
+    conn = db.connection()
+    conn.exec_driver_sql(f'ATTACH DATABASE ? AS "{name}"', (path,))
+    conn.connection.info.setdefault(ATTACHED, {})[name] = path
+    conn.exec_driver_sql(f'PRAGMA "{name}".journal_mode=WAL')
+    _table("llm_traces", name).create(conn)
+    # Listed only once the table exists, so other connections never attach an empty file
+    partition = TracePartition(name=name, range_start=lo, range_end=hi, path=path)
+    db.add(partition)
+    db.commit()
+    logger.info("Created trace partition %s for [%s, %s)", name, lo.isoformat(), hi.isoformat())
+    return partition
+
+def _move(db: Session, partition: TracePartition, below_id: int) -> int:
+    """Move the main table's rows in the partition's range into its file, one chunk per transaction."""
+    main = LLMTrace.__table__
+    target = _table("llm_traces", partition.name)
+    names = [column.name for column in main.columns]
+    in_range = (main.c.created_at >= partition.range_start, main.c.created_at < partition.range_end, main.c.id < below_id)
+    moved = 0
+    while True:
+        ids = db.execute(
+            select(main.c.id).where(*in_range).order_by(main.c.created_at).limit(CHUNK_SIZE)
+        ).scalars().all()
+        if not ids:
+            break
+        # OR REPLACE: a chunk copied by a run that failed before deleting it is copied again
+        db.execute(insert(target).prefix_with("OR REPLACE").from_select(
+            names, select(*(main.c[name] for name in names)).where(main.c.id.in_(ids))
+        ))
+        db.execute(delete(main).where(main.c.id.in_(ids)))
+        db.commit()
+        moved += len(ids)
+    if moved:
+        logger.info("Moved %d traces into partition %s", moved, partition.name)
+    return moved
+
+def archive(db: Session, now: Optional[datetime] = None) -> Dict[str, int]:
+    """Move rows older than the previous period from the main table into their SQLite files."""
+    now = now or datetime.utcnow()
+    main = LLMTrace.__table__
+    before = period_start(now) - PERIODS[PERIOD]
+    # The newest row stays: SQLite reuses ids after the highest rowid, so an empty table would restart at 1
+    newest = db.execute(select(func.max(main.c.id))).scalar()
+    moved: Dict[str, int] = {}
+    lower = None
+    while newest is not None:
+        query = select(func.min(main.c.created_at)).where(main.c.created_at < before, main.c.id < newest)
+        if lower is not None:
+            query = query.where(main.c.created_at >= lower)
+        oldest = db.execute(query).scalar()
+        if oldest is None:
+            break
+        partition = db.execute(
+            select(TracePartition).where(TracePartition.range_start <= oldest, TracePartition.range_end > oldest)
+        ).scalar_one_or_none() or _sqlite_create(db, oldest)
+        if partition is None:
+            break
+        moved[partition.name] = moved.get(partition.name, 0) + _move(db, partition, newest)
+        lower = partition.range_end
+    return moved
+
+# --- PostgreSQL: declarative partitions --------------------------------------
+
+def is_partitioned(db: Session) -> bool:
+    return db.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('llm_traces')")).scalar() == "p"
+
+def convert(db: Session, now: Optional[datetime] = None) -> datetime:
+    """Turn `llm_traces` into a partitioned table whose first partition is the existing table.
+
+    One transaction: the table is locked, renamed to llm_traces_legacy and attached for every
+    `created_at` before the end of the current period (or of its newest row). A validated CHECK
+    constraint lets the attach skip its scan; building the (id, created_at) key still reads the
+    table once. Returns that boundary.
+    """
+    now = now or datetime.utcnow()
+    db.execute(text("LOCK TABLE llm_traces IN ACCESS EXCLUSIVE MODE"))
+    newest = db.execute(select(func.max(LLMTrace.created_at))).scalar()
+    boundary = period_end(max(now, newest or now))
+    # The partition key cannot be NULL
+    db.execute(update(LLMTrace.__table__).where(LLMTrace.created_at.is_(None)).values(created_at=now))
+    sequence = db.execute(text("SELECT pg_get_serial_sequence('llm_traces', 'id')")).scalar()
+    # A foreign key needs a unique key on the referenced table, which must now include created_at
+    for table, name in db.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = 'llm_traces'::regclass"
+    )).all():
+        db.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT "{name}"'))
+    db.execute(text("ALTER TABLE llm_traces ALTER COLUMN created_at SET NOT NULL"))
+    db.execute(text(f"ALTER TABLE llm_traces ADD CONSTRAINT llm_traces_legacy_range CHECK (created_at < {_literal(boundary)})"))
+    db.execute(text(f"ALTER TABLE llm_traces RENAME TO {LEGACY_PARTITION}"))
+    # Free the index and key names for the partitioned table
+    pkey = db.execute(text(
+        f"SELECT conname FROM pg_constraint WHERE conrelid = '{LEGACY_PARTITION}'::regclass AND contype = 'p'"
+    )).scalar()
+    if pkey:
+        db.execute(text(f'ALTER TABLE {LEGACY_PARTITION} RENAME CONSTRAINT "{pkey}" TO {LEGACY_PARTITION}_pkey'))
+    for (index,) in db.execute(text(
+        f"SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = '{LEGACY_PARTITION}'"
+    )).all():
+        if index.startswith("ix_llm_traces_"):
+            db.execute(text(f'ALTER INDEX "{index}" RENAME TO "{index.replace("ix_llm_traces_", "ix_llm_traces_legacy_", 1)}"'))
+    db.execute(text(f"CREATE TABLE llm_traces (LIKE {LEGACY_PARTITION} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)"))
+    db.execute(text("ALTER TABLE llm_traces ADD CONSTRAINT llm_traces_pkey PRIMARY KEY (id, created_at)"))
+    for fk in LLMTrace.__table__.foreign_keys:
+        db.execute(text(
+            f"ALTER TABLE llm_traces ADD FOREIGN KEY ({fk.parent.name}) REFERENCES {fk.column.table.name} ({fk.column.name})"
+        ))
+    if sequence:
+        # Otherwise dropping the legacy partition would drop the id sequence with it
+        db.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY llm_traces.id"))
+    conn = db.connection()
+    for index in LLMTrace.__table__.indexes:
+        index.create(conn)
+    # Equivalent indexes of the legacy table are attached to the partitioned ones rather than rebuilt
+    db.execute(text(f"ALTER TABLE llm_traces ATTACH PARTITION {LEGACY_PARTITION} FOR VALUES FROM (MINVALUE) TO ({_literal(boundary)})"))
+    db.execute(text(f"ALTER TABLE {LEGACY_PARTITION} DROP CONSTRAINT llm_traces_legacy_range"))
+    db.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF llm_traces DEFAULT"))
+    db.add(TracePartition(name=LEGACY_PARTITION, range_start=None, range_end=boundary))
+    cache.touch(db, cache.TRACES)
+    db.commit()
+    logger.info("Partitioned llm_traces; existing rows before %s are in %s", boundary.isoformat(), LEGACY_PARTITION)
+    return boundary
+
+def _pg_create(db: Session, lo: datetime, hi: datetime) -> TracePartition:
+    name = partition_name(lo)
+    bounds = f"FROM ({_literal(lo)}) TO ({_literal(hi)})"
+    in_range = f"created_at >= {_literal(lo)} AND created_at < {_literal(hi)}"
+    stray = db.execute(text(f"SELECT 1 FROM {DEFAULT_PARTITION} WHERE {in_range} LIMIT 1")).first()
+    if stray is None:
+        db.execute(text(f"CREATE TABLE {name} PARTITION OF llm_traces FOR VALUES {bounds}"))
+    else:
+        # Rows that arrived before their partition existed went to the default partition; move them
+        db.execute(text(f"ALTER TABLE llm_traces DETACH PARTITION {DEFAULT_PARTITION}"))
+        db.execute(text(f"CREATE TABLE {name} PARTITION OF llm_traces FOR VALUES {bounds}"))
+        db.execute(text(f"INSERT INTO llm_traces SELECT * FROM {DEFAULT_PARTITION} WHERE {in_range}"))
+        db.execute(text(f"DELETE FROM {DEFAULT_PARTITION} WHERE {in_range}"))
+        db.execute(text(f"ALTER TABLE llm_traces ATTACH PARTITION {DEFAULT_PARTITION} DEFAULT"))
+    partition = TracePartition(name=name, range_start=lo, range_end=hi)
+    db.add(partition)
+    db.commit()
+    logger.info("Created trace partition %s for [%s, %s)", name, lo.isoformat(), hi.isoformat())
+    return partition
+
+def ensure(db: Session, now: Optional[datetime] = None) -> List[str]:
+    """Create PostgreSQL partitions through AHEAD periods after the current one."""
+    now = now or datetime.utcnow()
+    existing = catalog(db)
+    lo = existing[-1].range_end if existing else period_start(now)
+    until = period_start(now) + (AHEAD + 1) * PERIODS[PERIOD]
+    created = []
+    while lo < until:
+        hi = period_end(lo)
+        created.append(_pg_create(db, lo, hi).name)
+        lo = hi
+    return created
+
+# --- Both -----------------------------------------------------------------------
+
+def maintain(db: Session, now: Optional[datetime] = None) -> Dict[str, Any]:
+    """Create upcoming partitions (PostgreSQL) or move closed periods into their files (SQLite)."""
+    report: Dict[str, Any] = {"created": [], "moved": {}}
+    if not ENABLED:
+        return report
+    dialect = _dialect(db)
+    if dialect == "postgresql":
+        if not is_partitioned(db):
+            if db.execute(select(LLMTrace.id).limit(1)).first() is not None:
+                logger.warning("TRACE_PARTITIONING is set but llm_traces is not partitioned yet; "
+                               "run `python -m app.partitions convert`")
+                return report
+            convert(db, now)
+            report["created"].append(LEGACY_PARTITION)
+        report["created"] += ensure(db, now)
+    elif dialect == "sqlite" and _is_sqlite_file(database.DATABASE_URL):
+        before = {partition.name for partition in catalog(db)}
+        report["moved"] = archive(db, now)
+        report["created"] = sorted({partition.name for partition in catalog(db)} - before)
+    return report
+
+def expired(db: Session, cutoff: datetime) -> List[TracePartition]:
+    """Partitions holding nothing newer than `cutoff`."""
+    return db.execute(
+        select(TracePartition).where(TracePartition.range_end <= cutoff).order_by(TracePartition.range_end)
+    ).scalars().all()
+
+def size(db: Session, partition: TracePartition) -> Tuple[int, int]:
+    """(rows, bytes) of a partition; PostgreSQL's row count is the planner's estimate."""
+    if partition.path is None:
+        rows, size_bytes = db.execute(text(
+            "SELECT reltuples::bigint, pg_total_relation_size(oid) FROM pg_class WHERE oid = to_regclass(:name)"
+        ), {"name": partition.name}).one()
+        return max(rows, 0), size_bytes
+    rows = db.execute(select(func.count()).select_from(_table("llm_traces", partition.name))).scalar()
+    return rows, sum(os.path.getsize(path) for path in (partition.path, partition.path + "-wal") if os.path.exists(path))
+
+def drop(db: Session, partition: TracePartition) -> Dict[str, Any]:
+    """Drop one partition; returns its rows, bytes and the blob hashes it referenced (for the caller to collect)."""
+    table = _table("llm_traces", partition.name) if partition.path else _table(partition.name)
+    rows, size_bytes = size(db, partition)
+    hashes: Set[str] = set(db.execute(
+        select(table.c.metadata_blob).where(table.c.metadata_blob.is_not(None)).distinct()
+    ).scalars())
+    alerts = Alert.__table__
+    db.execute(
+        update(alerts)
+        .where(alerts.c.trace_id.is_not(None), exists().where(table.c.id == alerts.c.trace_id))
+        .values(trace_id=None)
+    )
+    if partition.path is None:
+        db.execute(text(f"DROP TABLE {partition.name}"))
+    db.delete(partition)
+    cache.touch(db, cache.TRACES)
+    db.commit()
+    if partition.path is not None:
+        # Connections detach it at their next checkout; open handles keep reading the unlinked file until then
+        try:
+            _remove_file(partition.path)
+        except OSError:
+            logger.warning("Could not remove dropped trace partition file %s", partition.path, exc_info=True)
+    logger.info("Dropped trace partition %s (%d rows, %d bytes)", partition.name, rows, size_bytes)
+    return {"rows": rows, "bytes": size_bytes, "hashes": hashes}
+
+def row_cutoff(db: Session, cutoff: datetime) -> Optional[datetime]:
+    """Cutoff for deleting expired traces row by row once expired partitions are dropped, or None for none.
+
+    On PostgreSQL that is only what lies before every partition (rows in the default partition):
+    a partition still holding newer rows waits to be dropped whole. SQLite's main table keeps
+    row deletes.
+    """
+    if _dialect(db) != "postgresql":
+        return cutoff
+    partitions = catalog(db)
+    if not partitions:
+        return cutoff
+    starts = [partition.range_start for partition in partitions]
+    if None in starts:
+        return None
+    return min(cutoff, min(starts))
+
+def run_once() -> Dict[str, Any]:
+    with SessionLocal() as db:
+        return maintain(db)
+
+class PartitionJob:
+    def __init__(self, enabled: bool = ENABLED, interval_seconds: float = INTERVAL_SECONDS):
+        self.enabled = enabled
+        self.interval = interval_seconds
+        self.leader = None
+        self.is_leader = False
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        # Worker-thread call in progress; cancelling _task does not stop the thread
+        self._call: Optional[asyncio.Future] = None
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        if database.engine.dialect.name == "postgresql":
+            self.leader = scheduler.AdvisoryLock(database.engine, ADVISORY_LOCK_KEY)
+        else:
+            self.leader = scheduler.Lease(name=LEASE_NAME, ttl_seconds=3 * self.interval)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # Wait for the thread, so the leader is not released under a running pass
+        if self._call is not None:
+            await asyncio.gather(self._call, return_exceptions=True)
+            self._call = None
+        # Unconditionally: an acquire interrupted by the cancel may still have succeeded
+        await run_in_threadpool(self.leader.release)
+        self.is_leader = False
+
+    async def _in_thread(self, fn: Callable, *args):
+        self._call = asyncio.ensure_future(run_in_threadpool(fn, *args))
+        result = await asyncio.shield(self._call)
+        self._call = None
+        return result
+
+    async def _run(self):
+        while True:
+            try:
+                self.is_leader = await self._in_thread(self.leader.acquire)
+                if self.is_leader:
+                    self.last_report = await self._in_thread(run_once)
+            except Exception:
+                logger.exception("Trace partition maintenance failed")
+            await asyncio.sleep(self.interval)
+
+job = PartitionJob()
+
+# Every SQLite file database attaches the catalog's files, partitioning enabled or not, so rows
+# already moved stay visible if TRACE_PARTITIONING is turned off again
+if _is_sqlite_file(database.DATABASE_URL):
+    for _engine, _read_only in {
+        database.engine: False, database.async_engine.sync_engine: False,
+        database.read_engine: True, database.async_read_engine.sync_engine: True,
+    }.items():
+        install(_engine, _read_only)
+
+if __name__ == "__main__":
+    command = sys.argv[1:]
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    with SessionLocal() as session:
+        if command == ["convert"]:
+            if database.engine.dialect.name != "postgresql":
+                sys.exit("convert applies to PostgreSQL; SQLite partitions need no conversion")
+            if not ENABLED:
+                sys.exit("set TRACE_PARTITIONING=day or week first")
+            if is_partitioned(session):
+                sys.exit("llm_traces is already partitioned")
+            print(f"Partitioned llm_traces; rows before {convert(session).isoformat()} are in {LEGACY_PARTITION}")
+            print(f"Created {len(ensure(session))} upcoming partition(s)")
+        elif command == ["maintain"]:
+            result = maintain(session)
+            print(f"Created {len(result['created'])} partition(s)" + (f": {', '.join(result['created'])}" if result["created"] else ""))
+            for name, count in result["moved"].items():
+                print(f"Moved {count} traces into {name}")
+        elif command == ["list"]:
+            for partition in catalog(session):
+                start = partition.range_start.isoformat() if partition.range_start else "-"
+                print(f"{partition.name:24s} {start:20s} {partition.range_end.isoformat():20s} {partition.path or ''}")
+        else:
+            sys.exit("usage: python -m app.partitions convert|maintain|list")
@@ -0,0 +1,45 @@
+""" Dialect-portable percentile computation.
+
+PostgreSQL computes `percentile_cont` natively, so its columns can join the
+caller's aggregate query. Other backends (SQLite) have no ordered-set
+aggregates; there all requested percentiles come from one ordered query that
+skips to the lowest rank needed and streams rows up to the highest one, and
+each is interpolated between its two neighbouring ranks the same way
+`percentile_cont` does, which keeps results identical across backends.
+"""
+import math
+from typing import List, Optional, Sequence
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+def supports_native(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+def native_columns(column, quantiles: Sequence[float]) -> list:
+    """percentile_cont columns for dialects where `supports_native` is true."""
+    return [func.percentile_cont(q).within_group(column) for q in quantiles]
+
+def ordered_percentiles(db: Session, column, filters: Sequence, count: int, quantiles: Sequence[float]) -> List[Optional[float]]:
+    """Exact continuous percentiles from one ordered pass; `count` is the number of matching non-null rows."""
+    if count <= 0:
+        return [None] * len(quantiles)
+    ranks = [q * (count - 1) for q in quantiles]
+    wanted = {bound for rank in ranks for bound in (math.floor(rank), min(math.ceil(rank), count - 1))}
+    first, last = min(wanted), max(wanted)
+    rows = db.execute(
+        select(column).where(column.isnot(None), *filters).order_by(column).offset(first).limit(last - first + 1)
+    ).scalars()
+    values = {}
+    for position, value in enumerate(rows, first):
+        if position in wanted:
+            values[position] = float(value)
+    results: List[Optional[float]] = []
+    for rank in ranks:
+        lower, upper = math.floor(rank), min(math.ceil(rank), count - 1)
+        if lower not in values:
+            results.append(None)
+        elif upper not in values or upper == lower:
+            results.append(values[lower])
+        else:
+            results.append(values[lower] + (rank - lower) * (values[upper] - values[lower]))
+    return results
@@ -0,0 +1,377 @@
+""" Retention of raw traces, spans and alerts.
+
+Rows older than their table's policy are deleted by a background job every
+RETENTION_INTERVAL_SECONDS (RETENTION_TRACES_DAYS=14, RETENTION_SPANS_DAYS=30,
+RETENTION_ALERTS_DAYS=90; 0 keeps a table forever). Each step reads at most
+RETENTION_CHUNK_SIZE expired primary keys from the table's `created_at` index
+and deletes exactly those rows in one short transaction, so a lock is never
+held for longer than one chunk and ingest keeps running in between. In the
+same transaction, references from rows that are kept (`llm_traces.span_id`,
+`alerts.trace_id` / `span_id`, child spans' `parent_id`) are set to NULL and
+payload blobs no longer referenced by any row are removed, unless a writer
+has used them within BLOB_REUSE_GRACE_SECONDS (see `app.blobs`). Blobs
+spared that way are swept by a later run, once their grace period is over.
+
+History outlives the raw rows. Traces are folded into the minute and hour
+rollups and latency sketches on ingest already, so dashboard ranges older
+than the raw retention are still answered from those. Spans are folded into
+`agent_span_rollups_day` by the transaction that deletes them
+(RETENTION_FOLD_SPANS). Open threshold alerts are kept whatever their age,
+since the scheduler still has to resolve them.
+
+Each run reports the rows and estimated bytes it reclaimed per table (see
+`GET /metrics/retention`). With partitioned trace storage (`app.partitions`),
+expired trace partitions are dropped whole instead. Only one process runs the
+job at a time, elected like the alert scheduler. By hand:
+
+    python -m app.retention run
+    python -m app.retention report    # rows a run would delete now
+"""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Optional, Sequence, Set, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import JSON, LargeBinary, String, Text, and_, cast, delete, exists, func, literal, or_, select, tuple_, update
+from sqlalchemy.orm import Session
+from . import blobs, cache, partitions, rollups
+from .database import SessionLocal, engine as db_engine
+from .models import AgentSpan, Alert, Blob, LLMTrace, SpanRollupDay
+from .scheduler import AdvisoryLock, Lease
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("RETENTION_ENABLED", "false").lower() in ("1", "true", "yes")
+INTERVAL_SECONDS = float(os.getenv("RETENTION_INTERVAL_SECONDS", "3600"))
+CHUNK_SIZE = int(os.getenv("RETENTION_CHUNK_SIZE", "2000"))
+# Pause between chunks, leaving the database to writers
+PAUSE_SECONDS = float(os.getenv("RETENTION_PAUSE_MS", "0")) / 1000.0
+FOLD_SPANS = os.getenv("RETENTION_FOLD_SPANS", "true").lower() in ("1", "true", "yes")
+
+LEASE_NAME = "retention"
+ADVISORY_LOCK_KEY = 72150003
+
+# Every column holding a blob reference; a blob is deleted once none of them points at it
+BLOB_REFERENCES = [(AgentSpan, ref) for ref in blobs.SPAN_FIELDS.values()] + \
+                  [(LLMTrace, ref) for ref in blobs.TRACE_FIELDS.values()]
+
+SPAN_FOLD_COLUMNS = ("created_at", "span_type", "name", "status", "latency_ms", "tokens_used", "cost_usd")
+SPAN_SUMMED = ("span_count", "latency_sum", "tokens_sum", "cost_sum")
+
+def fold_spans(db: Session, rows: Sequence[Dict[str, Any]]):
+    """Add spans about to be deleted to their day's `agent_span_rollups_day` rows (caller commits)."""
+    groups: Dict[Tuple, Dict[str, Any]] = {}
+    for row in rows:
+        key = (rollups.truncate(row["created_at"], 86400), row["span_type"] or "", row["name"] or "", row["status"] or "")
+        latency = float(row["latency_ms"] or 0.0)
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = {
+                "bucket": key[0], "span_type": key[1], "name": key[2], "status": key[3],
+                "span_count": 0, "latency_sum": 0.0, "latency_max": latency, "tokens_sum": 0, "cost_sum": 0.0,
+            }
+        g["span_count"] += 1
+        g["latency_sum"] += latency
+        g["latency_max"] = max(g["latency_max"], latency)
+        g["tokens_sum"] += row["tokens_used"] or 0
+        g["cost_sum"] += row["cost_usd"] or 0.0
+    if not groups:
+        return
+    table = SpanRollupDay.__table__
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        greatest = func.greatest
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+        greatest = func.max
+    stmt = insert(table)
+    merged = {name: table.c[name] + stmt.excluded[name] for name in SPAN_SUMMED}
+    merged["latency_max"] = greatest(func.coalesce(table.c.latency_max, stmt.excluded.latency_max), stmt.excluded.latency_max)
+    stmt = stmt.on_conflict_do_update(index_elements=["bucket", "span_type", "name", "status"], set_=merged)
+    db.execute(stmt, [groups[key] for key in sorted(groups)])
+
+@dataclass
+class Policy:
+    model: Any
+    days: int
+    tag: str
+    # (model, column) pairs pointing at this table, set to NULL for the rows being deleted
+    references: Tuple[Tuple[Any, str], ...] = ()
+    blob_refs: Tuple[str, ...] = ()
+    # Extra condition rows must meet to be deleted
+    deletable: Optional[Callable[[], Any]] = None
+    fold: Optional[Callable[[Session, Sequence[Dict[str, Any]]], None]] = None
+    fold_columns: Tuple[str, ...] = ()
+    # Rows may live in partitions that are dropped whole (app.partitions)
+    partitioned: bool = False
+
+    @property
+    def name(self) -> str:
+        return self.model.__tablename__
+
+# Alerts first: they reference traces and spans, and traces reference spans
+POLICIES = [
+    Policy(
+        Alert, int(os.getenv("RETENTION_ALERTS_DAYS", "90")), cache.ALERTS,
+        deletable=lambda: or_(Alert.resolved_at.is_not(None), Alert.threshold_id.is_(None)),
+    ),
+    Policy(
+        LLMTrace, int(os.getenv("RETENTION_TRACES_DAYS", "14")), cache.TRACES,
+        references=((Alert, "trace_id"),),
+        blob_refs=tuple(blobs.TRACE_FIELDS.values()),
+        partitioned=True,
+    ),
+    Policy(
+        AgentSpan, int(os.getenv("RETENTION_SPANS_DAYS", "30")), cache.SPANS,
+        references=((LLMTrace, "span_id"), (Alert, "span_id"), (AgentSpan, "parent_id")),
+        blob_refs=tuple(blobs.SPAN_FIELDS.values()),
+        fold=fold_spans if FOLD_SPANS else None,
+        fold_columns=SPAN_FOLD_COLUMNS,
+    ),
+]
+
+def _row_bytes(table):
+    """Estimated stored size of a row: variable-width values by length, 8 bytes per other column."""
+    fixed, sizes = 0, []
+    for column in table.columns:
+        if isinstance(column.type, LargeBinary):
+            sizes.append(func.coalesce(func.length(column), 0))
+        elif isinstance(column.type, (String, JSON)):
+            sizes.append(func.coalesce(func.length(cast(column, Text)), 0))
+        else:
+            fixed += 8
+    return sum(sizes, literal(fixed))
+
+def _expired(policy: Policy, cutoff: datetime) -> list:
+    table = policy.model.__table__
+    conditions = [table.c.created_at < cutoff]
+    if policy.deletable is not None:
+        conditions.append(policy.deletable())
+    return conditions
+
+def delete_unreferenced_blobs(db: Session, hashes: Set[str]) -> Tuple[int, int]:
+    """Delete the blobs among `hashes` that no row references; returns (blobs, stored bytes)."""
+    if not hashes:
+        return 0, 0
+    blob = Blob.__table__
+    references = [model.__table__.c[ref] for model, ref in BLOB_REFERENCES] + [
+        table.c[ref] for table in partitions.archived_tables(db) for ref in blobs.TRACE_FIELDS.values()
+    ]
+    unreferenced = and_(*(~exists().where(column == blob.c.hash) for column in references))
+    sizes = db.execute(
+        delete(blob).where(blob.c.hash.in_(sorted(hashes)), unreferenced, blobs.unused_since())
+        .returning(func.length(blob.c.data))
+    ).scalars().all()
+    return len(sizes), sum(sizes)
+
+def sweep_blobs(db: Session, chunk_size: int = CHUNK_SIZE,
+                stop: Optional[threading.Event] = None) -> Tuple[int, int]:
+    """Delete unreferenced blobs whose grace period ended since about the previous run.
+
+    These are blobs a run spared because they had just been used; the window looks
+    back two intervals, so one late or failed run does not leave them behind.
+    """
+    blob = Blob.__table__
+    until = datetime.utcnow() - timedelta(seconds=blobs.REUSE_GRACE_SECONDS)
+    after, last_hash = until - timedelta(seconds=2 * INTERVAL_SECONDS), ""
+    count = size = 0
+    while stop is None or not stop.is_set():
+        rows = db.execute(
+            select(blob.c.used_at, blob.c.hash)
+            .where(blob.c.used_at < until, tuple_(blob.c.used_at, blob.c.hash) > tuple_(after, last_hash))
+            .order_by(blob.c.used_at, blob.c.hash)
+            .limit(chunk_size)
+        ).all()
+        if not rows:
+            break
+        deleted, deleted_bytes = delete_unreferenced_blobs(db, {h for _, h in rows})
+        db.commit()
+        count, size = count + deleted, size + deleted_bytes
+        after, last_hash = rows[-1]
+        if len(rows) < chunk_size:
+            break
+    return count, size
+
+def delete_chunk(db: Session, policy: Policy, cutoff: datetime, chunk_size: int = CHUNK_SIZE) -> Dict[str, int]:
+    """Delete up to `chunk_size` expired rows of one table in one transaction."""
+    table = policy.model.__table__
+    columns = {"id": table.c.id, "_bytes": _row_bytes(table)}
+    for name in policy.blob_refs + (policy.fold_columns if policy.fold else ()):
+        columns[name] = table.c[name]
+    rows = db.execute(
+        select(*(column.label(name) for name, column in columns.items()))
+        .where(*_expired(policy, cutoff))
+        .order_by(table.c.created_at)
+        .limit(chunk_size)
+    ).mappings().all()
+    if not rows:
+        return {"rows": 0, "bytes": 0, "blobs": 0, "blob_bytes": 0}
+    ids = [row["id"] for row in rows]
+    if policy.fold:
+        policy.fold(db, rows)
+    for model, column in policy.references:
+        for ref in [model.__table__] + (partitions.archived_tables(db) if model is LLMTrace else []):
+            db.execute(update(ref).where(ref.c[column].in_(ids)).values({column: None}))
+    db.execute(delete(table).where(table.c.id.in_(ids)))
+    blob_count, blob_bytes = delete_unreferenced_blobs(
+        db, {row[ref] for row in rows for ref in policy.blob_refs if row[ref]}
+    )
+    cache.touch(db, policy.tag)
+    db.commit()
+    return {"rows": len(rows), "bytes": sum(row["_bytes"] for row in rows), "blobs": blob_count, "blob_bytes": blob_bytes}
+
+def run(db: Session, now: Optional[datetime] = None, chunk_size: int = CHUNK_SIZE,
+        stop: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """Delete every expired row, chunk by chunk; returns what was reclaimed.
+
+    `stop` is checked between chunks, so a run can be interrupted without leaving a
+    chunk half done.
+    """
+    started = time.perf_counter()
+    now = now or datetime.utcnow()
+    report: Dict[str, Any] = {"started_at": now.isoformat(), "tables": {}, "blobs": {"rows": 0, "bytes": 0}}
+    for policy in POLICIES:
+        if policy.days <= 0:
+            continue
+        cutoff = now - timedelta(days=policy.days)
+        stats = report["tables"][policy.name] = {"cutoff": cutoff.isoformat(), "rows": 0, "bytes": 0}
+        rows_before = cutoff
+        if policy.partitioned:
+            for partition in partitions.expired(db, cutoff):
+                if stop is not None and stop.is_set():
+                    break
+                dropped = partitions.drop(db, partition)
+                stats["rows"] += dropped["rows"]
+                stats["bytes"] += dropped["bytes"]
+                blob_count, blob_bytes = delete_unreferenced_blobs(db, dropped["hashes"])
+                db.commit()
+                report["blobs"]["rows"] += blob_count
+                report["blobs"]["bytes"] += blob_bytes
+            rows_before = partitions.row_cutoff(db, cutoff)
+        while rows_before is not None and (stop is None or not stop.is_set()):
+            chunk = delete_chunk(db, policy, rows_before, chunk_size)
+            stats["rows"] += chunk["rows"]
+            stats["bytes"] += chunk["bytes"]
+            report["blobs"]["rows"] += chunk["blobs"]
+            report["blobs"]["bytes"] += chunk["blob_bytes"]
+            if chunk["rows"] < chunk_size:
+                break
+            if PAUSE_SECONDS:
+                time.sleep(PAUSE_SECONDS)
+        if stats["rows"]:
+            logger.info("Retention deleted %d %s rows (%d bytes) older than %s",
+                        stats["rows"], policy.name, stats["bytes"], cutoff.isoformat())
+    if stop is None or not stop.is_set():
+        blob_count, blob_bytes = sweep_blobs(db, chunk_size, stop)
+        report["blobs"]["rows"] += blob_count
+        report["blobs"]["bytes"] += blob_bytes
+    report["rows"] = sum(t["rows"] for t in report["tables"].values())
+    report["bytes"] = sum(t["bytes"] for t in report["tables"].values()) + report["blobs"]["bytes"]
+    report["interrupted"] = stop is not None and stop.is_set()
+    report["duration_ms"] = (time.perf_counter() - started) * 1000
+    return report
+
+def pending(db: Session, now: Optional[datetime] = None) -> Dict[str, int]:
+    """Rows per table a run would delete now (estimated for PostgreSQL partitions)."""
+    now = now or datetime.utcnow()
+    counts = {}
+    for policy in POLICIES:
+        if policy.days <= 0:
+            continue
+        cutoff = now - timedelta(days=policy.days)
+        counts[policy.name] = 0
+        rows_before = cutoff
+        if policy.partitioned:
+            counts[policy.name] += sum(partitions.size(db, partition)[0] for partition in partitions.expired(db, cutoff))
+            rows_before = partitions.row_cutoff(db, cutoff)
+        if rows_before is not None:
+            counts[policy.name] += db.execute(
+                select(func.count()).select_from(policy.model.__table__).where(*_expired(policy, rows_before))
+            ).scalar()
+    return counts
+
+def policies() -> Dict[str, int]:
+    return {policy.name: policy.days for policy in POLICIES}
+
+def run_once(stop: Optional[threading.Event] = None) -> Dict[str, Any]:
+    with SessionLocal() as db:
+        return run(db, stop=stop)
+
+class RetentionJob:
+    def __init__(self, enabled: bool = ENABLED, interval_seconds: float = INTERVAL_SECONDS):
+        self.enabled = enabled
+        self.interval = interval_seconds
+        self.leader = None
+        self.is_leader = False
+        self.last_report: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+        # Worker-thread call in progress; cancelling _task does not stop the thread
+        self._call: Optional[asyncio.Future] = None
+        self._stopping = threading.Event()
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        if db_engine.dialect.name == "postgresql":
+            self.leader = AdvisoryLock(db_engine, ADVISORY_LOCK_KEY)
+        else:
+            self.leader = Lease(name=LEASE_NAME, ttl_seconds=3 * self.interval)
+        self._stopping.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        # A run in progress finishes its current chunk and returns
+        self._stopping.set()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # Wait for the thread, so the lock is not released under a running chunk
+        if self._call is not None:
+            await asyncio.gather(self._call, return_exceptions=True)
+            self._call = None
+        # Unconditionally: an acquire interrupted by the cancel may still have succeeded
+        await run_in_threadpool(self.leader.release)
+        self.is_leader = False
+
+    async def _in_thread(self, fn: Callable, *args):
+        self._call = asyncio.ensure_future(run_in_threadpool(fn, *args))
+        result = await asyncio.shield(self._call)
+        self._call = None
+        return result
+
+    async def _run(self):
+        while True:
+            try:
+                self.is_leader = await self._in_thread(self.leader.acquire)
+                if self.is_leader:
+                    self.last_report = await self._in_thread(run_once, self._stopping)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Retention run failed")
+            await asyncio.sleep(self.interval)
+
+job = RetentionJob()
+
+if __name__ == "__main__":
+    command = sys.argv[1:]
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    with SessionLocal() as session:
+        if command == ["run"]:
+            result = run(session)
+            for name, stats in result["tables"].items():
+                print(f"{name:14s} {stats['rows']:10d} rows  {stats['bytes']:14d} bytes  (before {stats['cutoff']})")
+            print(f"{'blobs':14s} {result['blobs']['rows']:10d} rows  {result['blobs']['bytes']:14d} bytes")
+            print(f"reclaimed {result['rows']} rows, about {result['bytes']} bytes in {result['duration_ms']:.0f} ms")
+        elif command == ["report"]:
+            for name, count in pending(session).items():
+                print(f"{name:14s} {count:10d} rows expired")
+        else:
+            sys.exit("usage: python -m app.retention run|report")
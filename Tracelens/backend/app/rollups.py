@@ -0,0 +1,390 @@
+""" Minute and hour rollups of LLM traces.
+
+Rollup rows are keyed by (bucket, model, provider, status) and hold counts,
+sums and min/max latency. They are upserted in the same transaction as the
+traces they summarize (see `app.ingest`), so dashboard reads can aggregate a
+few rollup rows instead of rescanning `llm_traces`.
+
+Latency quantiles cannot be summed, so each minute, hour and day bucket also
+stores a mergeable DDSketch per (model, provider) in `latency_sketches`. A
+percentile over any minute-aligned range is answered by merging the sketches
+of the coarsest buckets that tile the range; the result is within
+SKETCH_RELATIVE_ACCURACY (default 1%) of the exact value, see `app.sketch`.
+
+Ingest does not update those rows: each transaction appends its per-minute
+sketches to `latency_sketch_deltas`, and a background job (one worker at a
+time) folds the deltas into `latency_sketches` every
+SKETCH_COMPACT_INTERVAL_SECONDS. Reads merge the stored sketches with the
+deltas not folded yet, so results do not wait for the job.
+
+Rebuild from raw data (for databases that predate the rollups, or after
+bulk writes that bypassed the ingest path), one day at a time while ingest
+keeps running, with:
+
+    python -m app.rollups rebuild
+    python -m app.rollups compact
+"""
+import asyncio
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+from sqlalchemy import bindparam, delete, func, select, text, union_all, update
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+from . import cache, database, partitions, scheduler
+from .models import LLMTrace, LatencySketch, LatencySketchDelta, TraceRollupMinute, TraceRollupHour
+from .sketch import DDSketch
+
+ENABLED = os.getenv("ROLLUPS_ENABLED", "true").lower() in ("1", "true", "yes")
+
+# granularity name -> (table model, bucket width in seconds), finest first
+GRANULARITIES = {
+    "minute": (TraceRollupMinute, 60),
+    "hour": (TraceRollupHour, 3600),
+}
+
+# sketch granularity -> bucket width in seconds, finest first
+SKETCH_GRANULARITIES = {"minute": 60, "hour": 3600, "day": 86400}
+SKETCH_RELATIVE_ACCURACY = float(os.getenv("SKETCH_RELATIVE_ACCURACY", "0.01"))
+
+COMPACT_ENABLED = os.getenv("SKETCH_COMPACT_ENABLED", "true").lower() in ("1", "true", "yes")
+COMPACT_INTERVAL_SECONDS = float(os.getenv("SKETCH_COMPACT_INTERVAL_SECONDS", "30"))
+COMPACT_BATCH = int(os.getenv("SKETCH_COMPACT_BATCH", "5000"))
+LEASE_NAME = "sketch_compaction"
+ADVISORY_LOCK_KEY = 72150005
+
+logger = logging.getLogger(__name__)
+
+SUMMED = ("request_count", "latency_sum", "tokens_sum", "input_tokens_sum", "output_tokens_sum", "cost_sum")
+
+def supported(db: Session) -> bool:
+    return ENABLED and db.get_bind().dialect.name in ("sqlite", "postgresql")
+
+def truncate(ts: datetime, seconds: int) -> datetime:
+    """Start of the bucket of width `seconds` containing `ts`."""
+    epoch = int((ts - datetime(1970, 1, 1)).total_seconds())
+    return datetime.utcfromtimestamp(epoch - epoch % seconds)
+
+def ceil(ts: datetime, seconds: int) -> datetime:
+    start = truncate(ts, seconds)
+    return start if start == ts else start + timedelta(seconds=seconds)
+
+def is_aligned(ts: Optional[datetime], seconds: int) -> bool:
+    return ts is None or truncate(ts, seconds) == ts
+
+def rollup_for_range(since: Optional[datetime], until: Optional[datetime], finest: str = "minute"):
+    """Coarsest rollup table whose buckets exactly tile [since, until), or None."""
+    names = list(GRANULARITIES)
+    for name in reversed(names[names.index(finest):]):
+        table, seconds = GRANULARITIES[name]
+        if is_aligned(since, seconds) and is_aligned(until, seconds):
+            return table
+    return None
+
+def _aggregate(rows: Iterable[Dict[str, Any]], seconds: int) -> Dict[Tuple, Dict[str, Any]]:
+    groups: Dict[Tuple, Dict[str, Any]] = {}
+    for row in rows:
+        key = (truncate(row["created_at"], seconds), row.get("model") or "", row.get("provider") or "", row.get("status") or "")
+        latency = float(row.get("latency_ms") or 0.0)
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = {
+                "bucket": key[0], "model": key[1], "provider": key[2], "status": key[3],
+                "request_count": 0, "latency_sum": 0.0, "latency_min": latency, "latency_max": latency,
+                "tokens_sum": 0, "input_tokens_sum": 0, "output_tokens_sum": 0, "cost_sum": 0.0,
+            }
+        g["request_count"] += 1
+        g["latency_sum"] += latency
+        g["latency_min"] = min(g["latency_min"], latency)
+        g["latency_max"] = max(g["latency_max"], latency)
+        g["tokens_sum"] += row.get("tokens") or 0
+        g["input_tokens_sum"] += row.get("input_tokens") or 0
+        g["output_tokens_sum"] += row.get("output_tokens") or 0
+        g["cost_sum"] += row.get("cost_usd") or 0.0
+    return groups
+
+def _upsert(db: Session, model, values: Sequence[Dict[str, Any]]):
+    table = model.__table__
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+        least, greatest = func.least, func.greatest
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+        least, greatest = func.min, func.max  # two-argument min/max are scalar in SQLite
+    stmt = insert(table)
+    excluded = stmt.excluded
+    merged = {name: table.c[name] + excluded[name] for name in SUMMED}
+    merged["latency_min"] = least(func.coalesce(table.c.latency_min, excluded.latency_min), excluded.latency_min)
+    merged["latency_max"] = greatest(func.coalesce(table.c.latency_max, excluded.latency_max), excluded.latency_max)
+    stmt = stmt.on_conflict_do_update(index_elements=["bucket", "model", "provider", "status"], set_=merged)
+    db.execute(stmt, list(values))
+
+def _insert_missing_sketches(db: Session, values: Sequence[Dict[str, Any]]):
+    table = LatencySketch.__table__
+    if db.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(table).on_conflict_do_nothing(index_elements=["granularity", "bucket", "model", "provider"])
+    db.execute(stmt, list(values))
+
+def _sketch_deltas(rows: Sequence[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    groups: Dict[Tuple, DDSketch] = {}
+    for row in rows:
+        if row.get("latency_ms") is None:
+            continue
+        key = (truncate(row["created_at"], 60), row.get("model") or "", row.get("provider") or "")
+        groups.setdefault(key, DDSketch(SKETCH_RELATIVE_ACCURACY)).add(row["latency_ms"])
+    return [
+        {"bucket": b, "model": m, "provider": p, "request_count": int(groups[b, m, p].count), "sketch": groups[b, m, p].to_bytes()}
+        for b, m, p in sorted(groups)
+    ]
+
+def _merge_sketches(db: Session, granularity: str, groups: Dict[Tuple, DDSketch]):
+    """Merge (bucket, model, provider) -> sketch into the stored sketches of one granularity."""
+    table = LatencySketch.__table__
+    empty = DDSketch(SKETCH_RELATIVE_ACCURACY).to_bytes()
+    keys = sorted(groups)
+    _insert_missing_sketches(db, [
+        {"granularity": granularity, "bucket": b, "model": m, "provider": p, "request_count": 0, "sketch": empty}
+        for b, m, p in keys
+    ])
+    stored = db.execute(
+        select(table.c.id, table.c.bucket, table.c.model, table.c.provider, table.c.sketch)
+        .where(table.c.granularity == granularity, table.c.bucket.in_(sorted({b for b, _, _ in keys})))
+    ).all()
+    changes = []
+    for sketch_id, bucket, model, provider, blob in stored:
+        incoming = groups.get((bucket, model, provider))
+        if incoming is None:
+            continue
+        merged = DDSketch.from_bytes(blob)
+        merged.merge(incoming)
+        changes.append({"_id": sketch_id, "_sketch": merged.to_bytes(), "_count": int(merged.count)})
+    db.execute(
+        update(table).where(table.c.id == bindparam("_id"))
+        .values(sketch=bindparam("_sketch"), request_count=bindparam("_count")),
+        changes,
+    )
+
+def _lock_tables(db: Session, *models):
+    """SHARE ROW EXCLUSIVE on the given tables (PostgreSQL; SQLite has one writer at a time)."""
+    if db.get_bind().dialect.name == "postgresql":
+        names = ", ".join(model.__tablename__ for model in models)
+        # Conflicts with the ROW EXCLUSIVE lock of every write, and with itself
+        db.execute(text(f"LOCK TABLE {names} IN SHARE ROW EXCLUSIVE MODE"))
+
+def compact_sketches(db: Session, limit: int = COMPACT_BATCH) -> int:
+    """Fold up to `limit` of the oldest sketch deltas into latency_sketches. Returns the number folded."""
+    # Serializes with rebuild(), which deletes the deltas and sketches of the day it refolds
+    _lock_tables(db, LatencySketch)
+    deltas = db.execute(
+        select(LatencySketchDelta.id, LatencySketchDelta.bucket, LatencySketchDelta.model,
+               LatencySketchDelta.provider, LatencySketchDelta.sketch)
+        .order_by(LatencySketchDelta.id).limit(limit)
+    ).all()
+    if not deltas:
+        db.rollback()
+        return 0
+    for granularity, seconds in SKETCH_GRANULARITIES.items():
+        groups: Dict[Tuple, DDSketch] = {}
+        for _, bucket, model, provider, blob in deltas:
+            key = (truncate(bucket, seconds), model, provider)
+            groups.setdefault(key, DDSketch(SKETCH_RELATIVE_ACCURACY)).merge(DDSketch.from_bytes(blob))
+        _merge_sketches(db, granularity, groups)
+    # Exactly the rows read: deltas committed meanwhile with lower ids are folded next time
+    db.execute(delete(LatencySketchDelta).where(LatencySketchDelta.id.in_([d.id for d in deltas])))
+    db.commit()
+    return len(deltas)
+
+def apply_trace_rows(db: Session, rows: Sequence[Dict[str, Any]]):
+    """Fold newly written trace rows into every rollup granularity and append their sketch deltas (caller commits)."""
+    if not rows or not supported(db):
+        return
+    for model, seconds in GRANULARITIES.values():
+        groups = _aggregate(rows, seconds)
+        # Sorted keys give concurrent writers a consistent lock order
+        _upsert(db, model, [groups[key] for key in sorted(groups)])
+    # Quantile sketches are appended, not merged in place, so concurrent ingest never waits on a hot bucket
+    deltas = _sketch_deltas(rows)
+    if deltas:
+        db.execute(LatencySketchDelta.__table__.insert(), deltas)
+
+def _decompose(since: Optional[datetime], until: Optional[datetime]) -> List[Tuple[str, Optional[datetime], Optional[datetime]]]:
+    """Split [since, until) into the coarsest sketch buckets that tile it exactly."""
+    names = list(SKETCH_GRANULARITIES)
+    parts = []
+    lo, hi = since, until
+    for name, coarser in zip(names, names[1:]):
+        seconds = SKETCH_GRANULARITIES[coarser]
+        next_lo = None if lo is None else ceil(lo, seconds)
+        next_hi = None if hi is None else truncate(hi, seconds)
+        if next_lo is not None and next_hi is not None and next_lo >= next_hi:
+            return parts + [(name, lo, hi)]
+        if lo is not None and lo < next_lo:
+            parts.append((name, lo, next_lo))
+        if hi is not None and next_hi < hi:
+            parts.append((name, next_hi, hi))
+        lo, hi = next_lo, next_hi
+    return parts + [(names[-1], lo, hi)]
+
+def _sketch_query(parts: List[Tuple[str, Optional[datetime], Optional[datetime]]], since: Optional[datetime],
+                  until: Optional[datetime], model: Optional[str] = None, provider: Optional[str] = None):
+    """(bucket, sketch) rows of the stored sketches for `parts` plus every pending delta in [since, until).
+
+    One statement, so a compaction committing meanwhile is seen either wholly or not at all.
+    """
+    selects = []
+    for granularity, lo, hi in parts:
+        selects.append(_filtered(LatencySketch, lo, hi, model, provider).where(LatencySketch.granularity == granularity))
+    selects.append(_filtered(LatencySketchDelta, since, until, model, provider))
+    return union_all(*selects)
+
+def _filtered(source, lo: Optional[datetime], hi: Optional[datetime], model: Optional[str], provider: Optional[str]):
+    q = select(source.bucket, source.sketch)
+    if lo is not None:
+        q = q.where(source.bucket >= lo)
+    if hi is not None:
+        q = q.where(source.bucket < hi)
+    if model is not None:
+        q = q.where(source.model == model)
+    if provider is not None:
+        q = q.where(source.provider == provider)
+    return q
+
+def merged_sketch(db: Session, since: Optional[datetime], until: Optional[datetime],
+                  model: Optional[str] = None, provider: Optional[str] = None) -> Optional[DDSketch]:
+    """Latency sketch of every trace in [since, until), or None if the range is not minute-aligned."""
+    if not supported(db) or not (is_aligned(since, 60) and is_aligned(until, 60)):
+        return None
+    result = DDSketch(SKETCH_RELATIVE_ACCURACY)
+    for _, blob in db.execute(_sketch_query(_decompose(since, until), since, until, model, provider)):
+        result.merge(DDSketch.from_bytes(blob))
+    return result
+
+def sketch_series(db: Session, since: datetime, until: datetime, granularity: str = "minute") -> Dict[datetime, DDSketch]:
+    """Per-bucket latency sketches (all models merged) for bucket starts in [since, until)."""
+    seconds = SKETCH_GRANULARITIES[granularity]
+    series: Dict[datetime, DDSketch] = {}
+    # Pending deltas are minute buckets; fold them into the bucket of the requested granularity
+    for bucket, blob in db.execute(_sketch_query([(granularity, since, until)], since, until)):
+        series.setdefault(truncate(bucket, seconds), DDSketch(SKETCH_RELATIVE_ACCURACY)).merge(DDSketch.from_bytes(blob))
+    return series
+
+def rebuild(db: Session, chunk_size: int = 50000) -> int:
+    """Recompute rollups and sketches from llm_traces, one UTC day per transaction.
+
+    Each day's rollup, sketch and sketch delta rows are deleted and refolded from that day's
+    traces in one transaction that first blocks ingest's writes to them and sketch compaction
+    (a lock on PostgreSQL, SQLite's write lock otherwise). A trace committed before the lock is read by the refold; one still in
+    flight waits and adds its own increment after the day is rebuilt, so each is counted once.
+    Rollups of days older than the oldest raw trace (history kept past retention) are left as
+    they are. Returns the number of traces folded in.
+    """
+    table = partitions.all_traces(db)
+    columns = [table.c[name] for name in ("created_at", "model", "provider", "status", "latency_ms",
+                                           "tokens", "input_tokens", "output_tokens", "cost_usd")]
+    derived = [model for model, _ in GRANULARITIES.values()] + [LatencySketch, LatencySketchDelta]
+    processed = 0
+    day = db.execute(select(func.min(table.c.created_at))).scalar()
+    db.commit()
+    while day is not None:
+        start = truncate(day, 86400)
+        end = start + timedelta(days=1)
+        _lock_tables(db, *derived)
+        for model in derived:
+            db.execute(delete(model).where(model.bucket >= start, model.bucket < end))
+        rows = db.execute(
+            select(*columns).where(table.c.created_at >= start, table.c.created_at < end),
+            execution_options={"yield_per": chunk_size},
+        ).mappings()
+        for chunk in rows.partitions():
+            apply_trace_rows(db, chunk)
+            processed += len(chunk)
+        cache.touch(db, cache.TRACES)
+        # The next day with traces, skipping empty ones
+        day = db.execute(select(func.min(table.c.created_at)).where(table.c.created_at >= end)).scalar()
+        db.commit()
+    return processed
+
+def ensure_built(db: Session):
+    """Populate rollups on first start against a database that already holds traces."""
+    if not supported(db):
+        return
+    if db.execute(select(TraceRollupMinute.id).limit(1)).first() is None and \
+            db.execute(select(LLMTrace.id).limit(1)).first() is not None:
+        rebuild(db)
+
+def compact_all() -> int:
+    """Fold every pending sketch delta, one batch per transaction."""
+    total = 0
+    with database.SessionLocal() as db:
+        while True:
+            folded = compact_sketches(db)
+            total += folded
+            if folded < COMPACT_BATCH:
+                return total
+
+class SketchCompactionJob:
+    def __init__(self, enabled: bool = COMPACT_ENABLED, interval_seconds: float = COMPACT_INTERVAL_SECONDS):
+        self.enabled = enabled
+        self.interval = interval_seconds
+        self.leader = None
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+        # Worker-thread call in progress; cancelling _task does not stop the thread
+        self._call: Optional[asyncio.Future] = None
+
+    async def start(self):
+        if not self.enabled or not ENABLED or self._task is not None:
+            return
+        if database.engine.dialect.name == "postgresql":
+            self.leader = scheduler.AdvisoryLock(database.engine, ADVISORY_LOCK_KEY)
+        else:
+            self.leader = scheduler.Lease(name=LEASE_NAME, ttl_seconds=3 * self.interval)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # Wait for the thread, so the leader is not released under a running compaction
+        if self._call is not None:
+            await asyncio.gather(self._call, return_exceptions=True)
+            self._call = None
+        # Unconditionally: an acquire interrupted by the cancel may still have succeeded
+        await run_in_threadpool(self.leader.release)
+        self.is_leader = False
+
+    async def _in_thread(self, fn: Callable, *args):
+        self._call = asyncio.ensure_future(run_in_threadpool(fn, *args))
+        result = await asyncio.shield(self._call)
+        self._call = None
+        return result
+
+    async def _run(self):
+        while True:
+            try:
+                self.is_leader = await self._in_thread(self.leader.acquire)
+                if self.is_leader:
+                    await self._in_thread(compact_all)
+            except Exception:
+                logger.exception("Sketch compaction failed")
+            await asyncio.sleep(self.interval)
+
+job = SketchCompactionJob()
+
+if __name__ == "__main__":
+    command = sys.argv[1:]
+    if command == ["rebuild"]:
+        with database.SessionLocal() as session:
+            print(f"Rolled up {rebuild(session)} traces")
+    elif command == ["compact"]:
+        print(f"Folded {compact_all()} sketch deltas")
+    else:
+        sys.exit("usage: python -m app.rollups rebuild|compact")
@@ -1,30 +1,32 @@
-from fastapi import APIRouter, Depends, Query, HTTPException
+from fastapi import APIRouter, Depends, Query, HTTPException, Response
+from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_, or_
+from sqlalchemy import case, func, and_, or_
 from typing import List, Optional, Dict, Any
 from datetime import datetime, timedelta
-from ..database import get_db
-from ..models import AgentSession, AgentSpan, LLMTrace
+from .. import blobs, cache, critical_path, events, partitions, span_tree
+from ..database import ReadSessionLocal, SessionLocal, get_async_db, run_in_session
+from ..ingest import insert_span_rows, span_row
+from ..models import AgentSession, AgentSpan
+from ..pagination import paginate
 from ..schemas import AgentSessionCreate, AgentSessionOut, AgentSpanCreate, AgentSpanOut
+from ..write_buffer import SPAN, write_buffer
 
 router = APIRouter(prefix="/agents", tags=["agent-workflow"])
 
 @router.post("/sessions", response_model=AgentSessionOut)
-def create_session(payload: AgentSessionCreate, db: Session = Depends(get_db)):
-    session = AgentSession(**payload.model_dump())
+async def create_session(payload: AgentSessionCreate, db: AsyncSession = Depends(get_async_db)):
+    session = AgentSession(**payload.model_dump(exclude={"metadata"}), metadata_=payload.metadata)
     db.add(session)
-    db.commit()
-    db.refresh(session)
+    cache.touch(db, cache.SESSIONS)
+    events.record(db, events.SESSIONS, 1)
+    await db.commit()
+    await db.refresh(session)
     return session
 
-@router.get("/sessions", response_model=List[AgentSessionOut])
-def list_sessions(
-    db: Session = Depends(get_db), 
-    limit: int = 50, 
-    offset: int = 0,
-    status: Optional[str] = None,
-    user_id: Optional[str] = None
-):
+def _list_sessions(db: Session, response: Response, limit: int, offset: int, cursor: Optional[str],
+                   status: Optional[str], user_id: Optional[str]) -> List[AgentSession]:
     q = db.query(AgentSession)
     
     if status:
@@ -32,145 +34,242 @@ def list_sessions(
     if user_id:
         q = q.filter(AgentSession.user_id == user_id)
     
-    return q.order_by(AgentSession.started_at.desc()).offset(offset).limit(limit).all()
+    return paginate(q, AgentSession.started_at, AgentSession.id, response, limit, offset, cursor)
+
+@router.get("/sessions", response_model=List[AgentSessionOut])
+async def list_sessions(
+    response: Response,
+    limit: int = Query(50, ge=1, le=1000), 
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    status: Optional[str] = None,
+    user_id: Optional[str] = None
+):
+    return await run_in_session(ReadSessionLocal, _list_sessions, response, limit, offset, cursor, status, user_id)
+
+# Declared before /sessions/{session_id} so "summary" is not parsed as an id
+@router.get("/sessions/summary")
+async def get_sessions_summary(
+    db: AsyncSession = Depends(get_async_db),
+    hours: int = Query(24, description="Hours of data to include")
+):
+    """Get summary of all sessions"""
+    return await cache.result_cache.get_or_compute_async(
+        db, "agents.sessions_summary", {"hours": hours},
+        lambda session: _sessions_summary(session, hours), tags=(cache.SESSIONS,),
+    )
+
+def _sessions_summary(db: Session, hours: int):
+    start_time = datetime.utcnow() - timedelta(hours=hours)
+    
+    # Session totals are maintained on ingest (app.session_totals), so agent_spans is not read
+    totals = db.query(
+        func.count(AgentSession.id).label("sessions"),
+        func.coalesce(func.sum(case((AgentSession.status == "completed", 1), else_=0)), 0).label("completed"),
+        func.coalesce(func.sum(case((AgentSession.status == "failed", 1), else_=0)), 0).label("failed"),
+        func.coalesce(func.sum(case((AgentSession.status == "running", 1), else_=0)), 0).label("running"),
+        func.coalesce(func.sum(AgentSession.total_latency_ms), 0.0).label("latency_ms"),
+        func.coalesce(func.sum(AgentSession.total_cost_usd), 0.0).label("cost_usd"),
+        func.coalesce(func.sum(AgentSession.total_tokens), 0).label("tokens"),
+    ).filter(AgentSession.started_at >= start_time).one()
+    
+    total_sessions = totals.sessions
+    completed_sessions = totals.completed
+    failed_sessions = totals.failed
+    running_sessions = totals.running
+    
+    avg_latency = totals.latency_ms / total_sessions if total_sessions > 0 else 0
+    total_cost = totals.cost_usd
+    total_tokens = totals.tokens
+    
+    return {
+        "total_sessions": total_sessions,
+        "completed_sessions": completed_sessions,
+        "failed_sessions": failed_sessions,
+        "running_sessions": running_sessions,
+        "success_rate": completed_sessions / total_sessions * 100 if total_sessions > 0 else 0,
+        "avg_latency_ms": avg_latency,
+        "total_cost_usd": total_cost,
+        "total_tokens": total_tokens,
+        "time_range_hours": hours
+    }
 
 @router.get("/sessions/{session_id}", response_model=AgentSessionOut)
-def get_session(session_id: int, db: Session = Depends(get_db)):
-    session = db.get(AgentSession, session_id)
+async def get_session(session_id: int, db: AsyncSession = Depends(get_async_db)):
+    session = await db.get(AgentSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     return session
 
-@router.put("/sessions/{session_id}", response_model=AgentSessionOut)
-def update_session(session_id: int, payload: AgentSessionCreate, db: Session = Depends(get_db)):
+def _update_session(db: Session, session_id: int, payload: AgentSessionCreate) -> AgentSession:
     session = db.get(AgentSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    for field, value in payload.model_dump().items():
+    was_finished = session.status in critical_path.FINISHED
+    for field, value in payload.model_dump(exclude={"metadata"}).items():
         setattr(session, field, value)
+    session.metadata_ = payload.metadata
     
+    if session.status in critical_path.FINISHED and not was_finished:
+        critical_path.materialize(db, session_id)
+    cache.touch(db, cache.SESSIONS)
     db.commit()
     db.refresh(session)
     return session
 
-@router.post("/spans", response_model=AgentSpanOut)
-def create_span(payload: AgentSpanCreate, db: Session = Depends(get_db)):
-    span = AgentSpan(**payload.model_dump())
-    db.add(span)
+@router.put("/sessions/{session_id}", response_model=AgentSessionOut)
+async def update_session(session_id: int, payload: AgentSessionCreate):
+    # Finishing a session computes its critical path
+    return await run_in_session(SessionLocal, _update_session, session_id, payload)
+
+def _create_span(db: Session, row: dict) -> int:
+    span_id = insert_span_rows(db, [row])[0]
     db.commit()
-    db.refresh(span)
-    return span
+    return span_id
+
+@router.post("/spans", response_model=AgentSpanOut)
+async def create_span(payload: AgentSpanCreate):
+    row = span_row(payload)
+    if write_buffer.running:
+        span_id = await write_buffer.submit(SPAN, row)
+        if span_id is None:
+            return JSONResponse(status_code=202, content={"status": "queued"})
+    else:
+        span_id = await run_in_session(SessionLocal, _create_span, row)
+    return AgentSpanOut(**row, id=span_id)
+
+def _session_spans(db: Session, session_id: int) -> List[AgentSpan]:
+    spans = db.query(AgentSpan).filter(AgentSpan.session_id==session_id).order_by(AgentSpan.created_at.asc()).all()
+    return blobs.resolve_objects(db, spans, blobs.SPAN_FIELDS)
 
 @router.get("/sessions/{session_id}/spans", response_model=List[AgentSpanOut])
-def get_session_spans(session_id: int, db: Session = Depends(get_db)):
-    return db.query(AgentSpan).filter(AgentSpan.session_id==session_id).order_by(AgentSpan.created_at.asc()).all()
+async def get_session_spans(session_id: int):
+    return await run_in_session(ReadSessionLocal, _session_spans, session_id)
+
+def _span(db: Session, span_id: int) -> AgentSpan:
+    span = db.get(AgentSpan, span_id)
+    if not span:
+        raise HTTPException(status_code=404, detail="Span not found")
+    return blobs.resolve_objects(db, [span], blobs.SPAN_FIELDS)[0]
+
+@router.get("/spans/{span_id}", response_model=AgentSpanOut)
+async def get_span(span_id: int):
+    return await run_in_session(ReadSessionLocal, _span, span_id)
 
 @router.get("/sessions/{session_id}/spans/tree")
-def get_session_spans_tree(session_id: int, db: Session = Depends(get_db)):
+async def get_session_spans_tree(
+    session_id: int,
+    max_depth: Optional[int] = Query(None, ge=0, description="Levels below the roots to include; deeper nodes are left for /agents/spans/{span_id}/subtree"),
+    fields: Optional[str] = Query(None, description="Comma-separated span fields, \"summary\" (no prompt/output/tool/reasoning payloads) or \"all\" (default)"),
+):
     """Get spans organized as a hierarchical tree"""
-    spans = db.query(AgentSpan).filter(AgentSpan.session_id==session_id).order_by(AgentSpan.created_at.asc()).all()
-    
-    # Build tree structure
-    span_map = {span.id: span for span in spans}
-    root_spans = []
-    
-    for span in spans:
-        if span.parent_id and span.parent_id in span_map:
-            parent = span_map[span.parent_id]
-            if not hasattr(parent, 'children'):
-                parent.children = []
-            parent.children.append(span)
-        else:
-            root_spans.append(span)
-    
-    def serialize_span(span):
-        result = {
-            "id": span.id,
-            "span_type": span.span_type,
-            "name": span.name,
-            "status": span.status,
-            "latency_ms": span.latency_ms,
-            "prompt": span.prompt,
-            "output": span.output,
-            "error": span.error,
-            "created_at": span.created_at.isoformat(),
-            "started_at": span.started_at.isoformat() if span.started_at else None,
-            "ended_at": span.ended_at.isoformat() if span.ended_at else None,
-            "tokens_used": span.tokens_used,
-            "cost_usd": span.cost_usd,
-            "model_used": span.model_used,
-            "provider_used": span.provider_used,
-            "tool_calls": span.tool_calls,
-            "reasoning_steps": span.reasoning_steps,
-            "metadata": span.metadata,
-            "trace_id": span.trace_id,
-            "children": []
+    try:
+        names = span_tree.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    roots = await run_in_session(ReadSessionLocal, span_tree.session_tree, session_id, names, max_depth)
+    return Response(span_tree.to_json(roots), media_type="application/json")
+
+@router.get("/spans/{span_id}/subtree")
+async def get_span_subtree(
+    span_id: int,
+    max_depth: int = Query(1, ge=0, le=1000, description="Levels below this span to include"),
+    fields: Optional[str] = Query(None, description="Same as for the session tree"),
+):
+    """Expand one span of a depth-limited tree"""
+    try:
+        names = span_tree.parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    node = await run_in_session(ReadSessionLocal, span_tree.subtree, span_id, names, max_depth)
+    if node is None:
+        raise HTTPException(status_code=404, detail="Span not found")
+    # A one-element list encodes the same way; strip the brackets
+    return Response(span_tree.to_json([node])[1:-1], media_type="application/json")
+
+def _span_counts(db: Session, session_id: int):
+    return db.query(
+        func.count(AgentSpan.id).label("spans"),
+        func.coalesce(func.sum(case((AgentSpan.status == "success", 1), else_=0)), 0).label("succeeded"),
+        func.coalesce(func.sum(case((AgentSpan.status == "failure", 1), else_=0)), 0).label("failed"),
+    ).filter(AgentSpan.session_id == session_id).one()
+
+def _root_causes(db: Session, session_id: int, top: int) -> List[Dict[str, Any]]:
+    """Earliest failed spans first"""
+    rows = db.query(
+        AgentSpan.id, AgentSpan.name, AgentSpan.span_type, AgentSpan.error, AgentSpan.latency_ms, AgentSpan.created_at,
+    ).filter(
+        AgentSpan.session_id == session_id, AgentSpan.status == "failure",
+    ).order_by(AgentSpan.created_at, AgentSpan.id).limit(top)
+    return [
+        {
+            "span_id": r.id,
+            "span_name": r.name,
+            "span_type": r.span_type,
+            "error": r.error,
+            "latency_ms": r.latency_ms,
+            "created_at": r.created_at.isoformat(),
         }
-        
-        if hasattr(span, 'children'):
-            result["children"] = [serialize_span(child) for child in span.children]
-        
-        return result
-    
-    return [serialize_span(span) for span in root_spans]
+        for r in rows
+    ]
 
-@router.get("/sessions/{session_id}/analysis")
-def get_session_analysis(session_id: int, db: Session = Depends(get_db)):
-    """Get comprehensive analysis of a session including root cause analysis"""
+def _bottlenecks(db: Session, session_id: int, top: int) -> List[Dict[str, Any]]:
+    """Slowest spans taking over twice the session's average span latency"""
+    ranked = db.query(
+        AgentSpan.id, AgentSpan.name, AgentSpan.span_type, AgentSpan.latency_ms,
+        func.avg(func.coalesce(AgentSpan.latency_ms, 0.0)).over().label("avg_latency_ms"),
+    ).filter(AgentSpan.session_id == session_id).subquery()
+    rows = db.query(ranked).filter(
+        ranked.c.latency_ms > ranked.c.avg_latency_ms * 2,  # 2x average latency
+    ).order_by(ranked.c.latency_ms.desc(), ranked.c.id).limit(top)
+    return [
+        {
+            "span_id": r.id,
+            "span_name": r.name,
+            "span_type": r.span_type,
+            "latency_ms": r.latency_ms,
+            "avg_latency_ms": r.avg_latency_ms,
+            "latency_ratio": r.latency_ms / r.avg_latency_ms,
+        }
+        for r in rows
+    ]
+
+def _session_analysis(db: Session, session_id: int, response: Response, top: int, limit: int,
+                      cursor: Optional[str]) -> Dict[str, Any]:
     session = db.get(AgentSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    spans = db.query(AgentSpan).filter(AgentSpan.session_id==session_id).all()
-    llm_traces = db.query(LLMTrace).filter(LLMTrace.session_id==session_id).all()
+    spans = _span_counts(db, session_id)
+    # Includes traces moved into SQLite partition files
+    traces = partitions.all_traces(db)
+    llm_calls = db.query(func.count(traces.c.id)).filter(traces.c.session_id == session_id).scalar()
     
-    # Calculate session metrics
-    total_spans = len(spans)
-    failed_spans = [s for s in spans if s.status == "failure"]
-    success_spans = [s for s in spans if s.status == "success"]
-    
-    total_latency = sum(s.latency_ms for s in spans)
-    total_tokens = sum(s.tokens_used for s in spans)
-    total_cost = sum(s.cost_usd for s in spans) + sum(t.cost_usd for t in llm_traces)
-    
-    # Root cause analysis
-    root_causes = []
-    if failed_spans:
-        for span in failed_spans:
-            root_causes.append({
-                "span_id": span.id,
-                "span_name": span.name,
-                "span_type": span.span_type,
-                "error": span.error,
-                "latency_ms": span.latency_ms,
-                "created_at": span.created_at.isoformat()
-            })
-    
-    # Performance bottlenecks
-    bottlenecks = []
-    if spans:
-        avg_latency = total_latency / len(spans)
-        for span in spans:
-            if span.latency_ms > avg_latency * 2:  # 2x average latency
-                bottlenecks.append({
-                    "span_id": span.id,
-                    "span_name": span.name,
-                    "span_type": span.span_type,
-                    "latency_ms": span.latency_ms,
-                    "avg_latency_ms": avg_latency,
-                    "latency_ratio": span.latency_ms / avg_latency
-                })
+    # Calculate session metrics; the sums are the session's running totals
+    total_spans = spans.spans
+    total_latency = session.total_latency_ms or 0.0
+    total_tokens = session.total_tokens or 0
+    total_cost = session.total_cost_usd or 0.0
     
     # Token usage analysis
     token_analysis = {
         "total_tokens": total_tokens,
         "total_cost": total_cost,
         "cost_per_token": total_cost / total_tokens if total_tokens > 0 else 0,
-        "llm_calls": len(llm_traces),
-        "avg_tokens_per_call": total_tokens / len(llm_traces) if llm_traces else 0
+        "llm_calls": llm_calls,
+        "avg_tokens_per_call": total_tokens / llm_calls if llm_calls else 0
     }
     
+    llm_traces = []
+    if limit:
+        # Same view as the count above, so pages cover the traces it counts
+        q = db.query(
+            traces.c.id, traces.c.model, traces.c.provider, traces.c.latency_ms, traces.c.tokens,
+            traces.c.cost_usd, traces.c.status, traces.c.created_at,
+        ).filter(traces.c.session_id == session_id)
+        llm_traces = paginate(q, traces.c.created_at, traces.c.id, response, limit, cursor=cursor)
+    
     return {
         "session": {
             "id": session.id,
@@ -184,13 +283,15 @@ def get_session_analysis(session_id: int, db: Session = Depends(get_db)):
         },
         "metrics": {
             "total_spans": total_spans,
-            "successful_spans": len(success_spans),
-            "failed_spans": len(failed_spans),
-            "success_rate": len(success_spans) / total_spans * 100 if total_spans > 0 else 0,
+            "successful_spans": spans.succeeded,
+            "failed_spans": spans.failed,
+            "success_rate": spans.succeeded / total_spans * 100 if total_spans > 0 else 0,
             "avg_latency_ms": total_latency / total_spans if total_spans > 0 else 0
         },
-        "root_causes": root_causes,
-        "bottlenecks": bottlenecks,
+        "root_causes": _root_causes(db, session_id, top) if spans.failed else [],
+        "bottlenecks": _bottlenecks(db, session_id, top) if total_spans else [],
+        # Completed and failed sessions only; see /sessions/{id}/critical-path for the whole path
+        "critical_path": critical_path.top_spans(db, session, top),
         "token_analysis": token_analysis,
         "llm_traces": [
             {
@@ -207,9 +308,34 @@ def get_session_analysis(session_id: int, db: Session = Depends(get_db)):
         ]
     }
 
-@router.get("/sessions/{session_id}/trace")
-def get_session_trace(session_id: int, db: Session = Depends(get_db)):
-    """Get detailed trace information for a session"""
+@router.get("/sessions/{session_id}/analysis")
+async def get_session_analysis(
+    session_id: int,
+    response: Response,
+    top: int = Query(10, ge=1, le=1000, description="Root causes and bottlenecks to return"),
+    limit: int = Query(50, ge=0, le=1000, description="LLM traces per page"),
+    cursor: Optional[str] = None,
+):
+    """Get comprehensive analysis of a session including root cause analysis
+
+    Counts are aggregated in the database and sums are the session's running totals;
+    `llm_traces` is one newest-first page, continued through the X-Next-Cursor header
+    like the other listings.
+    """
+    return await run_in_session(ReadSessionLocal, _session_analysis, session_id, response, top, limit, cursor)
+
+def _critical_path(db: Session, session_id: int) -> Dict[str, Any]:
+    session = db.get(AgentSession, session_id)
+    if not session:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return critical_path.path(db, session)
+
+@router.get("/sessions/{session_id}/critical-path")
+async def get_session_critical_path(session_id: int):
+    """Spans on the session's critical path with their self and critical time"""
+    return await run_in_session(ReadSessionLocal, _critical_path, session_id)
+
+def _session_trace(db: Session, session_id: int) -> Dict[str, Any]:
     session = db.get(AgentSession, session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -240,33 +366,7 @@ def get_session_trace(session_id: int, db: Session = Depends(get_db)):
         "duration_ms": (session.ended_at - session.started_at).total_seconds() * 1000 if session.ended_at else None
     }
 
-@router.get("/sessions/summary")
-def get_sessions_summary(
-    db: Session = Depends(get_db),
-    hours: int = Query(24, description="Hours of data to include")
-):
-    """Get summary of all sessions"""
-    start_time = datetime.utcnow() - timedelta(hours=hours)
-    
-    sessions = db.query(AgentSession).filter(AgentSession.started_at >= start_time).all()
-    
-    total_sessions = len(sessions)
-    completed_sessions = len([s for s in sessions if s.status == "completed"])
-    failed_sessions = len([s for s in sessions if s.status == "failed"])
-    running_sessions = len([s for s in sessions if s.status == "running"])
-    
-    avg_latency = sum(s.total_latency_ms for s in sessions) / total_sessions if total_sessions > 0 else 0
-    total_cost = sum(s.total_cost_usd for s in sessions)
-    total_tokens = sum(s.total_tokens for s in sessions)
-    
-    return {
-        "total_sessions": total_sessions,
-        "completed_sessions": completed_sessions,
-        "failed_sessions": failed_sessions,
-        "running_sessions": running_sessions,
-        "success_rate": completed_sessions / total_sessions * 100 if total_sessions > 0 else 0,
-        "avg_latency_ms": avg_latency,
-        "total_cost_usd": total_cost,
-        "total_tokens": total_tokens,
-        "time_range_hours": hours
-    }
+@router.get("/sessions/{session_id}/trace")
+async def get_session_trace(session_id: int):
+    """Get detailed trace information for a session"""
+    return await run_in_session(ReadSessionLocal, _session_trace, session_id)
@@ -1,71 +1,172 @@
-from fastapi import APIRouter, Depends, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import APIRouter, Depends, Query, Response, WebSocket, WebSocketDisconnect, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
-from typing import List, Optional
+from sqlalchemy import func, and_, select
+from typing import Deque, Dict, List, Optional
 from datetime import datetime, timedelta
 import json
 import asyncio
-from ..database import get_db
+import os
+from collections import deque
+from .. import alerting, cache, events, scheduler
+from ..alerting import alert_message
+from ..database import get_async_db
 from ..models import Alert, AlertThreshold, LLMTrace, AgentSession, AgentSpan
+from ..pagination import paginate
 from ..schemas import AlertCreate, AlertOut, AlertThresholdCreate, AlertThresholdOut
 
 router = APIRouter(prefix="/alerts", tags=["alerts"])
 
+# Outgoing messages buffered per alert subscriber before the overflow policy applies
+WS_QUEUE_SIZE = int(os.getenv("ALERTS_WS_QUEUE_SIZE", "100"))
+# "drop_oldest" keeps the newest messages for a slow client; "disconnect" closes it
+WS_OVERFLOW = os.getenv("ALERTS_WS_OVERFLOW", "drop_oldest")
+WS_SEND_TIMEOUT = float(os.getenv("ALERTS_WS_SEND_TIMEOUT_SECONDS", "10"))
+WS_PING_SECONDS = float(os.getenv("ALERTS_WS_PING_SECONDS", "20"))
+WS_PONG_TIMEOUT = float(os.getenv("ALERTS_WS_PONG_TIMEOUT_SECONDS", "10"))
+
+class AlertSubscriber:
+    """One client's bounded outgoing queue, drained by its own sender task."""
+
+    def __init__(self, websocket: WebSocket, max_queue: Optional[int] = None):
+        self.websocket = websocket
+        self.max_queue = WS_QUEUE_SIZE if max_queue is None else max_queue
+        self.queue: Deque[str] = deque()
+        self.ready = asyncio.Event()
+        self.last_seen = asyncio.get_running_loop().time()
+        self.dropped = 0
+        self.sender: Optional[asyncio.Task] = None
+
+    def offer(self, text: str) -> bool:
+        """Queue `text` without blocking; False means the client should be disconnected."""
+        if len(self.queue) >= self.max_queue:
+            if WS_OVERFLOW == "disconnect":
+                return False
+            self.queue.popleft()
+            self.dropped += 1
+        self.queue.append(text)
+        self.ready.set()
+        return True
+
+    async def send_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            while self.queue:
+                await asyncio.wait_for(self.websocket.send_text(self.queue.popleft()), WS_SEND_TIMEOUT)
+
 # WebSocket connection manager for alerts
 class AlertConnectionManager:
+    """Fans alerts out to every subscriber without waiting on any of them.
+
+    Alerts are published on the event bus when their transaction commits
+    (from any thread), serialized once and offered to each subscriber's
+    queue; a slow client only ever delays itself. An application-level
+    ping is sent every WS_PING_SECONDS and clients that have not been heard
+    from (any message counts, normally {"type": "pong"}) within
+    WS_PONG_TIMEOUT after that are disconnected.
+    """
+
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.subscribers: Dict[WebSocket, AlertSubscriber] = {}
+        self._keepalive: Optional[asyncio.Task] = None
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.subscribers)
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        if not self.subscribers:
+            events.bus.subscribe(self._on_event)
+        subscriber = self.subscribers[websocket] = AlertSubscriber(websocket)
+        subscriber.sender = asyncio.create_task(self._run_sender(subscriber))
+        if self._keepalive is None or self._keepalive.done():
+            self._keepalive = asyncio.create_task(self._run_keepalive())
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        subscriber = self.subscribers.pop(websocket, None)
+        if subscriber is None:
+            return
+        if subscriber.sender is not None and subscriber.sender is not asyncio.current_task():
+            subscriber.sender.cancel()
+        if not self.subscribers:
+            events.bus.unsubscribe(self._on_event)
+
+    def received(self, websocket: WebSocket, text: str):
+        """Any client message proves liveness; a client {"type": "ping"} is answered with a pong."""
+        subscriber = self.subscribers.get(websocket)
+        if subscriber is None:
+            return
+        subscriber.last_seen = asyncio.get_running_loop().time()
+        try:
+            is_ping = json.loads(text).get("type") == "ping"
+        except (ValueError, AttributeError):
+            is_ping = False
+        if is_ping:
+            subscriber.offer(json.dumps({"type": "pong"}))
+
+    def broadcast_text(self, text: str):
+        for websocket, subscriber in list(self.subscribers.items()):
+            if not subscriber.offer(text):
+                self._drop(websocket, code=1013)  # try again later
 
     async def broadcast_alert(self, alert: Alert):
-        message = {
-            "type": "new_alert",
-            "data": {
-                "id": alert.id,
-                "severity": alert.severity,
-                "title": alert.title,
-                "description": alert.description,
-                "metric": alert.metric,
-                "threshold": alert.threshold,
-                "created_at": alert.created_at.isoformat(),
-                "alert_type": alert.alert_type
-            }
-        }
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(json.dumps(message))
-            except:
-                self.active_connections.remove(connection)
+        self.broadcast_text(json.dumps(alert_message(alert)))
+
+    def _on_event(self, kind: str, payload):
+        if kind == events.ALERTS:
+            for message in payload:
+                self.broadcast_text(json.dumps(message))
+
+    def _drop(self, websocket: WebSocket, code: int = 1000):
+        self.disconnect(websocket)
+        asyncio.create_task(self._close(websocket, code))
+
+    @staticmethod
+    async def _close(websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass
+
+    async def _run_sender(self, subscriber: AlertSubscriber):
+        try:
+            await subscriber.send_loop()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Send failed or timed out: the client is gone or too slow
+            self._drop(subscriber.websocket, code=1011)
+
+    async def _run_keepalive(self):
+        loop = asyncio.get_running_loop()
+        ping = json.dumps({"type": "ping"})
+        while self.subscribers:
+            await asyncio.sleep(WS_PING_SECONDS)
+            deadline = loop.time() - WS_PING_SECONDS - WS_PONG_TIMEOUT
+            for websocket, subscriber in list(self.subscribers.items()):
+                if subscriber.last_seen < deadline:
+                    self._drop(websocket, code=1001)
+                elif not subscriber.offer(ping):
+                    self._drop(websocket, code=1013)
 
 alert_manager = AlertConnectionManager()
 
 @router.post("", response_model=AlertOut)
-def create_alert(payload: AlertCreate, db: Session = Depends(get_db)):
-    alert = Alert(**payload.model_dump())
+async def create_alert(payload: AlertCreate, db: AsyncSession = Depends(get_async_db)):
+    alert = Alert(**payload.model_dump(exclude={"metadata"}), metadata_=payload.metadata)
     db.add(alert)
-    db.commit()
-    db.refresh(alert)
-    
-    # Broadcast to WebSocket connections
-    asyncio.create_task(alert_manager.broadcast_alert(alert))
-    
+    await db.flush()
+    cache.touch(db, cache.ALERTS)
+    # Broadcast to WebSocket connections once committed
+    events.record(db, events.ALERTS, [alert_message(alert)])
+    await db.commit()
+    await db.refresh(alert)
     return alert
 
-@router.get("", response_model=List[AlertOut])
-def list_alerts(
-    db: Session = Depends(get_db), 
-    limit: int = 50, 
-    offset: int = 0,
-    severity: Optional[str] = None,
-    acknowledged: Optional[bool] = None,
-    alert_type: Optional[str] = None
-):
+def _list_alerts(db: Session, response: Response, limit: int, offset: int, cursor: Optional[str],
+                 severity: Optional[str], acknowledged: Optional[bool], alert_type: Optional[str]) -> List[Alert]:
     q = db.query(Alert)
     
     if severity:
@@ -75,35 +176,53 @@ def list_alerts(
     if alert_type:
         q = q.filter(Alert.alert_type == alert_type)
     
-    return q.order_by(Alert.created_at.desc()).offset(offset).limit(limit).all()
+    return paginate(q, Alert.created_at, Alert.id, response, limit, offset, cursor)
+
+@router.get("", response_model=List[AlertOut])
+async def list_alerts(
+    response: Response,
+    db: AsyncSession = Depends(get_async_db), 
+    limit: int = Query(50, ge=1, le=1000), 
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    severity: Optional[str] = None,
+    acknowledged: Optional[bool] = None,
+    alert_type: Optional[str] = None
+):
+    return await db.run_sync(_list_alerts, response, limit, offset, cursor, severity, acknowledged, alert_type)
 
 @router.post("/{alert_id}/ack", response_model=AlertOut)
-def acknowledge_alert(alert_id: int, acknowledged_by: Optional[str] = None, db: Session = Depends(get_db)):
-    alert = db.get(Alert, alert_id)
+async def acknowledge_alert(alert_id: int, acknowledged_by: Optional[str] = None, db: AsyncSession = Depends(get_async_db)):
+    alert = await db.get(Alert, alert_id)
     if not alert:
         raise HTTPException(status_code=404, detail="Alert not found")
     
     alert.acknowledged = True
     alert.acknowledged_at = datetime.utcnow()
     alert.acknowledged_by = acknowledged_by
-    db.commit()
-    db.refresh(alert)
+    cache.touch(db, cache.ALERTS)
+    await db.commit()
+    await db.refresh(alert)
     return alert
 
 @router.post("/{alert_id}/resolve", response_model=AlertOut)
-def resolve_alert(alert_id: int, db: Session = Depends(get_db)):
-    alert = db.get(Alert, alert_id)
+async def resolve_alert(alert_id: int, db: AsyncSession = Depends(get_async_db)):
+    alert = await db.get(Alert, alert_id)
     if not alert:
         raise HTTPException(status_code=404, detail="Alert not found")
     
     alert.resolved_at = datetime.utcnow()
-    db.commit()
-    db.refresh(alert)
+    cache.touch(db, cache.ALERTS)
+    await db.commit()
+    await db.refresh(alert)
     return alert
 
 @router.get("/summary")
-def get_alerts_summary(db: Session = Depends(get_db)):
+async def get_alerts_summary(db: AsyncSession = Depends(get_async_db)):
     """Get summary of alerts by severity"""
+    return await cache.result_cache.get_or_compute_async(db, "alerts.summary", {}, _alerts_summary, tags=(cache.ALERTS,))
+
+def _alerts_summary(db: Session):
     results = db.query(
         Alert.severity,
         func.count(Alert.id).label('count'),
@@ -124,102 +243,70 @@ def get_alerts_summary(db: Session = Depends(get_db)):
     }
 
 # Alert Threshold Management
+def _validate_threshold(payload: AlertThresholdCreate):
+    if payload.window not in alerting.WINDOWS:
+        raise HTTPException(status_code=400, detail=f"window must be one of {', '.join(alerting.WINDOWS)}")
+    if payload.group_by not in alerting.GROUP_BY:
+        raise HTTPException(status_code=400, detail="group_by must be model, provider or model_provider")
+
 @router.post("/thresholds", response_model=AlertThresholdOut)
-def create_threshold(payload: AlertThresholdCreate, db: Session = Depends(get_db)):
+async def create_threshold(payload: AlertThresholdCreate, db: AsyncSession = Depends(get_async_db)):
+    _validate_threshold(payload)
     threshold = AlertThreshold(**payload.model_dump())
     db.add(threshold)
-    db.commit()
-    db.refresh(threshold)
+    await db.flush()
+    events.record(db, events.THRESHOLDS, threshold.id)
+    await db.commit()
+    await db.refresh(threshold)
     return threshold
 
 @router.get("/thresholds", response_model=List[AlertThresholdOut])
-def list_thresholds(db: Session = Depends(get_db)):
-    return db.query(AlertThreshold).order_by(AlertThreshold.metric_name).all()
+async def list_thresholds(db: AsyncSession = Depends(get_async_db)):
+    return (await db.scalars(select(AlertThreshold).order_by(AlertThreshold.metric_name))).all()
 
 @router.put("/thresholds/{threshold_id}", response_model=AlertThresholdOut)
-def update_threshold(threshold_id: int, payload: AlertThresholdCreate, db: Session = Depends(get_db)):
-    threshold = db.get(AlertThreshold, threshold_id)
+async def update_threshold(threshold_id: int, payload: AlertThresholdCreate, db: AsyncSession = Depends(get_async_db)):
+    threshold = await db.get(AlertThreshold, threshold_id)
     if not threshold:
         raise HTTPException(status_code=404, detail="Threshold not found")
     
+    _validate_threshold(payload)
     for field, value in payload.model_dump().items():
         setattr(threshold, field, value)
     
     threshold.updated_at = datetime.utcnow()
-    db.commit()
-    db.refresh(threshold)
+    events.record(db, events.THRESHOLDS, threshold.id)
+    await db.commit()
+    await db.refresh(threshold)
     return threshold
 
 @router.delete("/thresholds/{threshold_id}")
-def delete_threshold(threshold_id: int, db: Session = Depends(get_db)):
-    threshold = db.get(AlertThreshold, threshold_id)
+async def delete_threshold(threshold_id: int, db: AsyncSession = Depends(get_async_db)):
+    threshold = await db.get(AlertThreshold, threshold_id)
     if not threshold:
         raise HTTPException(status_code=404, detail="Threshold not found")
     
-    db.delete(threshold)
-    db.commit()
+    await db.delete(threshold)
+    events.record(db, events.THRESHOLDS, threshold_id)
+    await db.commit()
     return {"message": "Threshold deleted"}
 
 @router.post("/check-thresholds")
-def check_thresholds(db: Session = Depends(get_db)):
-    """Check current metrics against thresholds and create alerts if needed"""
-    thresholds = db.query(AlertThreshold).filter(AlertThreshold.enabled == True).all()
-    new_alerts = []
-    
-    for threshold in thresholds:
-        # Get current metric value based on threshold.metric_name
-        if threshold.metric_name == "avg_latency_ms":
-            current_value = db.query(func.avg(LLMTrace.latency_ms)).scalar() or 0.0
-        elif threshold.metric_name == "error_rate_pct":
-            total = db.query(func.count(LLMTrace.id)).scalar() or 0
-            errors = db.query(func.count(LLMTrace.id)).filter(LLMTrace.status == "failure").scalar() or 0
-            current_value = (errors / total * 100) if total else 0.0
-        elif threshold.metric_name == "total_cost_usd":
-            current_value = db.query(func.sum(LLMTrace.cost_usd)).scalar() or 0.0
-        elif threshold.metric_name == "requests_per_minute":
-            one_hour_ago = datetime.utcnow() - timedelta(hours=1)
-            recent_requests = db.query(func.count(LLMTrace.id)).filter(LLMTrace.created_at >= one_hour_ago).scalar() or 0
-            current_value = recent_requests / 60.0
-        else:
-            continue
-        
-        # Check if threshold is exceeded
-        if current_value > threshold.threshold_value:
-            # Check if alert already exists for this threshold
-            existing_alert = db.query(Alert).filter(
-                and_(
-                    Alert.metric_name == threshold.metric_name,
-                    Alert.acknowledged == False,
-                    Alert.created_at >= datetime.utcnow() - timedelta(minutes=5)  # Within last 5 minutes
-                )
-            ).first()
-            
-            if not existing_alert:
-                alert = Alert(
-                    severity=threshold.severity,
-                    title=f"{threshold.metric_name} threshold exceeded",
-                    description=f"Current value: {current_value:.2f}, Threshold: {threshold.threshold_value:.2f}",
-                    metric=current_value,
-                    threshold=threshold.threshold_value,
-                    alert_type="threshold",
-                    metric_name=threshold.metric_name
-                )
-                db.add(alert)
-                new_alerts.append(alert)
-    
-    if new_alerts:
-        db.commit()
-        for alert in new_alerts:
-            db.refresh(alert)
-            asyncio.create_task(alert_manager.broadcast_alert(alert))
-    
-    return {"checked_thresholds": len(thresholds), "new_alerts_created": len(new_alerts)}
+async def check_thresholds(db: AsyncSession = Depends(get_async_db)):
+    """Evaluate every threshold now (they are also evaluated as traces arrive and by the background scheduler)"""
+    if alerting.engine.enabled:
+        created = await alerting.engine.evaluate()
+        return {"checked_thresholds": len(alerting.engine.thresholds), "new_alerts_created": created}
+    created, resolved = await db.run_sync(scheduler.evaluate)
+    return {"new_alerts_created": created, "alerts_resolved": resolved}
 
 @router.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     await alert_manager.connect(websocket)
     try:
         while True:
-            await asyncio.sleep(1)  # Keep connection alive
+            alert_manager.received(websocket, await websocket.receive_text())
     except WebSocketDisconnect:
+        pass
+    finally:
         alert_manager.disconnect(websocket)
@@ -0,0 +1,164 @@
+from fastapi import APIRouter, Query, Request
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy.orm import Session
+from typing import Any, Dict, List, Optional
+from datetime import datetime
+import json
+import os
+import time
+from ..database import SessionLocal, run_in_session
+from ..ingest import (
+    insert_session_rows, insert_span_rows, insert_trace_rows,
+    session_row, span_row, trace_row,
+)
+from ..schemas import (
+    AgentSessionCreate, AgentSpanCreate, LLMTraceCreate, LineError, NdjsonIngestResult,
+)
+
+router = APIRouter(prefix="/ingest", tags=["ingest"])
+
+CHUNK_ROWS = int(os.getenv("INGEST_NDJSON_CHUNK_ROWS", "1000"))
+MAX_LINE_BYTES = int(os.getenv("INGEST_NDJSON_MAX_LINE_BYTES", str(1024 * 1024)))
+MAX_ERRORS = int(os.getenv("INGEST_NDJSON_MAX_ERRORS", "100"))
+
+RECORD_TYPES = {
+    # type -> (schema, row builder, insert function, historical timestamp field)
+    "session": (AgentSessionCreate, session_row, insert_session_rows, "started_at"),
+    "span": (AgentSpanCreate, span_row, insert_span_rows, "created_at"),
+    "trace": (LLMTraceCreate, trace_row, insert_trace_rows, "created_at"),
+}
+
+_timestamp = TypeAdapter(datetime)
+
+class _Ingest:
+    """Accumulates validated rows of one upload and writes them in chunked transactions"""
+
+    def __init__(self):
+        self.result = NdjsonIngestResult(accepted={kind: 0 for kind in RECORD_TYPES})
+        self.pending: Dict[str, List[Dict[str, Any]]] = {kind: [] for kind in RECORD_TYPES}
+        self.pending_lines: List[int] = []
+
+    def reject(self, line_no: int, error: str):
+        self.result.rejected += 1
+        if len(self.result.errors) < MAX_ERRORS:
+            self.result.errors.append(LineError(line=line_no, error=error))
+
+    def add(self, line_no: int, raw: bytes, default_type: Optional[str]):
+        try:
+            record = json.loads(raw)
+            if not isinstance(record, dict):
+                raise ValueError("line is not a JSON object")
+            kind = record.pop("type", default_type)
+            if kind not in RECORD_TYPES:
+                raise ValueError(f"unknown record type: {kind!r}")
+            schema, build_row, _, ts_field = RECORD_TYPES[kind]
+            # Backfilled records keep their original timestamp
+            ts = record.pop(ts_field, None)
+            row = build_row(schema.model_validate(record), _timestamp.validate_python(ts) if ts else None)
+            if kind == "session" and record.get("ended_at"):
+                row["ended_at"] = _timestamp.validate_python(record["ended_at"])
+        except ValidationError as e:
+            self.reject(line_no, "; ".join(f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()))
+            return
+        except ValueError as e:
+            self.reject(line_no, str(e))
+            return
+        self.pending[kind].append(row)
+        self.pending_lines.append(line_no)
+
+    @property
+    def pending_count(self) -> int:
+        return len(self.pending_lines)
+
+    def flush(self, db: Session):
+        """Write pending rows in one transaction"""
+        if not self.pending_lines:
+            return
+        try:
+            for kind, (_, _, insert_rows, _) in RECORD_TYPES.items():
+                insert_rows(db, self.pending[kind])
+            db.commit()
+            for kind, rows in self.pending.items():
+                self.result.accepted[kind] += len(rows)
+        except Exception as e:
+            db.rollback()
+            for line_no in self.pending_lines:
+                self.reject(line_no, f"chunk rejected by database: {e}")
+        self.pending = {kind: [] for kind in RECORD_TYPES}
+        self.pending_lines = []
+
+class _LineSplitter:
+    """Splits a byte stream into lines, searching each chunk for line breaks once.
+
+    Lines longer than `max_bytes` come back as None; their bytes are dropped as they arrive.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.head: List[bytes] = []  # start of the current line, from earlier chunks
+        self.head_bytes = 0
+        self.oversized = False
+
+    def _take(self, piece: bytes) -> Optional[bytes]:
+        """Complete the current line with `piece`."""
+        too_long = self.oversized or self.head_bytes + len(piece) > self.max_bytes
+        line = None if too_long else b"".join(self.head) + piece
+        self.head, self.head_bytes, self.oversized = [], 0, False
+        return line
+
+    def feed(self, chunk: bytes) -> List[Optional[bytes]]:
+        *complete, rest = chunk.split(b"\n")
+        lines = [self._take(piece) for piece in complete]
+        if rest and not self.oversized:
+            self.head_bytes += len(rest)
+            if self.head_bytes > self.max_bytes:
+                self.head, self.oversized = [], True
+            else:
+                self.head.append(rest)
+        return lines
+
+    def close(self) -> List[Optional[bytes]]:
+        """The last line, when the stream does not end with a line break."""
+        return [self._take(b"")] if self.head or self.oversized else []
+
+@router.post("/ndjson", response_model=NdjsonIngestResult)
+async def ingest_ndjson(
+    request: Request,
+    type: Optional[str] = Query(None, description="Record type for lines without a 'type' field: trace, span, session"),
+):
+    """Stream newline-delimited JSON records into the database.
+
+    Each line is one trace, span or session, selected by its `type` field. Lines are
+    validated as they arrive and written every INGEST_NDJSON_CHUNK_ROWS records, so
+    memory use does not grow with the size of the upload. Records refer to sessions
+    and spans by their database ids, so those must exist before the upload.
+    """
+    started = time.perf_counter()
+    ingest = _Ingest()
+    line_no = 0
+    lines = _LineSplitter(MAX_LINE_BYTES)
+
+    async def handle(raw: Optional[bytes]):
+        nonlocal line_no
+        line_no += 1
+        if raw is None:
+            ingest.reject(line_no, f"line exceeds {MAX_LINE_BYTES} bytes")
+        elif raw.strip():
+            ingest.add(line_no, raw, type)
+            if ingest.pending_count >= CHUNK_ROWS:
+                await run_in_session(SessionLocal, ingest.flush)
+
+    async for chunk in request.stream():
+        ingest.result.bytes_read += len(chunk)
+        for raw in lines.feed(chunk):
+            await handle(raw)
+    for raw in lines.close():
+        await handle(raw)
+    await run_in_session(SessionLocal, ingest.flush)
+
+    result = ingest.result
+    result.lines = line_no
+    elapsed = time.perf_counter() - started
+    result.duration_ms = elapsed * 1000
+    result.records_per_second = sum(result.accepted.values()) / elapsed if elapsed > 0 else 0.0
+    return result
@@ -1,159 +1,373 @@
-from fastapi import APIRouter, Depends, Query, WebSocket, WebSocketDisconnect
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, WebSocketDisconnect
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import func, text
-from typing import List, Optional
+from sqlalchemy import case, func, select, text
+from typing import Any, Dict, List, Optional
 from datetime import datetime, timedelta
 import json
 import asyncio
-from ..database import get_db
-from ..models import LLMTrace, AgentSession, AgentSpan, Alert
+import logging
+import os
+from .. import bucketing, cache, events, partitions, percentiles, retention, rollups
+from ..database import AsyncReadSessionLocal, ReadSessionLocal, get_async_db, run_in_session
+from ..models import LLMTrace, AgentSession, AgentSpan, Alert, TraceRollupHour, TraceRollupMinute
 from ..schemas import MetricsSummary, MetricsTimeSeries, TimeSeriesDataPoint
 
 router = APIRouter(prefix="/metrics", tags=["metrics"])
+logger = logging.getLogger(__name__)
+
+# Shared producer tick for /metrics/ws; subscriber intervals are rounded to whole ticks
+WS_TICK_SECONDS = float(os.getenv("METRICS_WS_TICK_SECONDS", "1"))
+# Upper bound on metrics_delta messages per second; events in between are coalesced
+WS_MAX_DELTAS_PER_SECOND = float(os.getenv("METRICS_WS_MAX_DELTAS_PER_SECOND", "4"))
+# Full snapshots resync values deltas cannot carry (percentiles, requests per minute)
+WS_DEFAULT_INTERVAL = 60.0
+WS_MAX_INTERVAL = 300.0
 
-# WebSocket connection manager
 class ConnectionManager:
-    def __init__(self):
-        self.active_connections: List[WebSocket] = []
+    """Pushes a snapshot on connect, then ingestion deltas, to every subscriber.
+
+    Committed writes publish to `app.events.bus`; while anyone is connected the
+    manager merges those events into one pending delta and a single producer
+    task sends it as a "metrics_delta" message at most
+    WS_MAX_DELTAS_PER_SECOND times a second. Each subscriber additionally
+    receives a full "metrics_update" snapshot on connect and every `interval`
+    seconds. The summary is computed at most once per tick, serialized once
+    and sent to all due subscribers concurrently. The producer exits when the
+    last subscriber disconnects.
+    """
+
+    def __init__(self, tick_seconds: float = WS_TICK_SECONDS, max_deltas_per_second: float = WS_MAX_DELTAS_PER_SECOND):
+        self.tick_seconds = tick_seconds
+        self.delta_interval = 1.0 / max_deltas_per_second
+        # websocket -> [interval seconds, next snapshot due (loop time)]
+        self.subscribers: Dict[WebSocket, List[float]] = {}
+        self._producer: Optional[asyncio.Task] = None
+        self._pending: Dict[str, Any] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.subscribers)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, interval: float = WS_DEFAULT_INTERVAL):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        interval = min(max(interval, self.tick_seconds), WS_MAX_INTERVAL)
+        if self._producer is None or self._producer.done():
+            self._wakeup = asyncio.Event()
+            self._pending = {}
+            events.bus.subscribe(self._on_event)
+            self._producer = asyncio.create_task(self._run())
+        # Subscribe before computing the snapshot: a write landing in between may be counted
+        # twice (until the next snapshot), but none is missed
+        self.subscribers[websocket] = [interval, asyncio.get_running_loop().time() + interval]
+        snapshot = await _current_summary()
+        await self.broadcast({"type": "metrics_update", "data": snapshot.model_dump()}, [websocket])
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        self.subscribers.pop(websocket, None)
+
+    async def broadcast(self, message: dict, targets: Optional[List[WebSocket]] = None):
+        text = json.dumps(message)
+        targets = self.active_connections if targets is None else targets
+        results = await asyncio.gather(*(ws.send_text(text) for ws in targets), return_exceptions=True)
+        # Drop failed sockets after the fan-out rather than while iterating
+        for ws, result in zip(targets, results):
+            if isinstance(result, Exception):
+                self.disconnect(ws)
+
+    def _on_event(self, kind: str, payload: Any):
+        if kind == events.THRESHOLDS:
+            return
+        if kind == events.TRACES:
+            events.merge_trace_delta(self._pending.setdefault("traces", {}), payload)
+        else:
+            # Alerts carry their messages, other kinds a row count
+            count = len(payload) if kind == events.ALERTS else payload
+            self._pending[kind] = self._pending.get(kind, 0) + count
+        self._wakeup.set()
 
-    async def broadcast(self, message: dict):
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(json.dumps(message))
-            except:
-                # Remove disconnected connections
-                self.active_connections.remove(connection)
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        last_delta = 0.0
+        try:
+            while self.subscribers:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.tick_seconds)
+                except asyncio.TimeoutError:
+                    pass
+                now = loop.time()
+                if self._pending:
+                    wait = last_delta + self.delta_interval - now
+                    if wait > 0:
+                        await asyncio.sleep(wait)
+                    delta, self._pending = self._pending, {}
+                    self._wakeup.clear()
+                    last_delta = loop.time()
+                    await self.broadcast({"type": "metrics_delta", "data": delta})
+                await self._send_snapshots(loop.time())
+        finally:
+            events.bus.unsubscribe(self._on_event)
+
+    async def _send_snapshots(self, now: float):
+        due = [ws for ws, (_, next_due) in list(self.subscribers.items()) if next_due <= now]
+        if not due:
+            return
+        try:
+            summary = await _current_summary()
+        except Exception:
+            logger.exception("Failed to compute metrics summary for WebSocket subscribers")
+            return
+        for ws in due:
+            if ws in self.subscribers:
+                self.subscribers[ws][1] = now + self.subscribers[ws][0]
+        await self.broadcast({"type": "metrics_update", "data": summary.model_dump()}, due)
 
 manager = ConnectionManager()
 
-@router.get("/summary", response_model=MetricsSummary)
-def get_summary(db: Session = Depends(get_db)):
-    # Basic metrics
-    total = db.query(func.count(LLMTrace.id)).scalar() or 0
-    avg_latency = db.query(func.avg(LLMTrace.latency_ms)).scalar() or 0.0
-    total_tokens = db.query(func.sum(LLMTrace.tokens)).scalar() or 0
-    total_cost = db.query(func.sum(LLMTrace.cost_usd)).scalar() or 0.0
-    success = db.query(func.count(LLMTrace.id)).filter(LLMTrace.status=="success").scalar() or 0
-    failure = db.query(func.count(LLMTrace.id)).filter(LLMTrace.status=="failure").scalar() or 0
-    success_rate = (success / total * 100.0) if total else 0.0
-    failure_rate = (failure / total * 100.0) if total else 0.0
-    
-    # Additional metrics
-    p95_latency = db.query(func.percentile_cont(0.95).within_group(LLMTrace.latency_ms)).scalar() or 0.0
-    p99_latency = db.query(func.percentile_cont(0.99).within_group(LLMTrace.latency_ms)).scalar() or 0.0
-    total_input_tokens = db.query(func.sum(LLMTrace.input_tokens)).scalar() or 0
-    total_output_tokens = db.query(func.sum(LLMTrace.output_tokens)).scalar() or 0
-    avg_tokens_per_request = (total_tokens / total) if total else 0.0
-    cost_per_token = (total_cost / total_tokens) if total_tokens else 0.0
-    
-    # Calculate requests per minute (last hour)
-    one_hour_ago = datetime.utcnow() - timedelta(hours=1)
-    recent_requests = db.query(func.count(LLMTrace.id)).filter(LLMTrace.created_at >= one_hour_ago).scalar() or 0
-    requests_per_minute = recent_requests / 60.0
-    
+async def _current_summary() -> MetricsSummary:
+    # Never a stale cache entry: deltas sent after a snapshot must apply on top of it
+    async with AsyncReadSessionLocal() as db:
+        return await cache.result_cache.get_or_compute_async(
+            db, "metrics.summary", {"since": None, "until": None},
+            lambda session: compute_summary(session), tags=(cache.TRACES,), stale_ttl=0,
+        )
+
+def _window_filters(since: Optional[datetime], until: Optional[datetime]) -> list:
+    filters = []
+    if since:
+        filters.append(LLMTrace.created_at >= since)
+    if until:
+        filters.append(LLMTrace.created_at < until)
+    return filters
+
+def _rollup_filters(rollup, since: Optional[datetime], until: Optional[datetime]) -> list:
+    filters = []
+    if since:
+        filters.append(rollup.bucket >= since)
+    if until:
+        filters.append(rollup.bucket < until)
+    return filters
+
+def _summary_totals(db: Session, since: Optional[datetime], until: Optional[datetime]):
+    """Counts and sums for the summary, read from rollups when the window is bucket-aligned"""
+    # Requests per minute is measured over the last hour of the window
+    one_hour_ago = (until or datetime.utcnow()) - timedelta(hours=1)
+    rollup = rollups.rollup_for_range(since, until) if rollups.supported(db) else None
+    if rollup is None:
+        return db.execute(select(
+            func.count(LLMTrace.id),
+            func.sum(LLMTrace.latency_ms),
+            func.sum(LLMTrace.tokens),
+            func.sum(LLMTrace.cost_usd),
+            func.sum(case((LLMTrace.status == "success", 1), else_=0)),
+            func.sum(case((LLMTrace.status == "failure", 1), else_=0)),
+            func.sum(LLMTrace.input_tokens),
+            func.sum(LLMTrace.output_tokens),
+            func.sum(case((LLMTrace.created_at >= one_hour_ago, 1), else_=0)),
+            # Traces with a latency, for the ordered percentile path
+            func.count(LLMTrace.latency_ms),
+        ).where(*_window_filters(since, until))).one()
+
+    row = db.execute(select(
+        func.sum(rollup.request_count),
+        func.sum(rollup.latency_sum),
+        func.sum(rollup.tokens_sum),
+        func.sum(rollup.cost_sum),
+        func.sum(case((rollup.status == "success", rollup.request_count), else_=0)),
+        func.sum(case((rollup.status == "failure", rollup.request_count), else_=0)),
+        func.sum(rollup.input_tokens_sum),
+        func.sum(rollup.output_tokens_sum),
+    ).where(*_rollup_filters(rollup, since, until))).one()
+    recent_since = rollups.truncate(one_hour_ago, 60)
+    if since and since > recent_since:
+        recent_since = since
+    recent = db.execute(
+        select(func.sum(TraceRollupMinute.request_count)).where(*_rollup_filters(TraceRollupMinute, recent_since, until))
+    ).scalar()
+    # Percentiles come from the sketches of the same buckets, so no latency count is needed
+    return tuple(row) + (recent, None)
+
+def compute_summary(db: Session, since: Optional[datetime] = None, until: Optional[datetime] = None) -> MetricsSummary:
+    """Summary metrics over the (optional) time window.
+
+    Counts and sums come from one aggregate query and percentiles from merged
+    latency sketches when the window is bucket-aligned; otherwise raw traces are
+    aggregated and percentiles use the native or portable path in `app.percentiles`.
+    """
+    (total, latency_sum, total_tokens, total_cost, success, failure,
+     total_input_tokens, total_output_tokens, recent_requests, latency_count) = _summary_totals(db, since, until)
+
+    filters = _window_filters(since, until)
+    sketch = rollups.merged_sketch(db, since, until) if total else None
+    if not total:
+        p95_latency = p99_latency = 0.0
+    elif sketch is not None:
+        p95_latency, p99_latency = sketch.quantile(0.95), sketch.quantile(0.99)
+    elif percentiles.supports_native(db):
+        p95_latency, p99_latency = db.execute(
+            select(*percentiles.native_columns(LLMTrace.latency_ms, (0.95, 0.99))).where(*filters)
+        ).one()
+    else:
+        p95_latency, p99_latency = percentiles.ordered_percentiles(
+            db, LLMTrace.latency_ms, filters, latency_count, (0.95, 0.99)
+        )
+
+    total = total or 0
+    total_tokens = total_tokens or 0
+    total_cost = total_cost or 0.0
+    success_rate = ((success or 0) / total * 100.0) if total else 0.0
+    failure_rate = ((failure or 0) / total * 100.0) if total else 0.0
+
     return MetricsSummary(
         total_requests=total,
-        avg_latency_ms=avg_latency,
+        avg_latency_ms=(latency_sum / total) if total and latency_sum else 0.0,
         total_tokens=total_tokens,
         total_cost_usd=total_cost,
         success_rate_pct=success_rate,
         failure_rate_pct=failure_rate,
-        p95_latency_ms=p95_latency,
-        p99_latency_ms=p99_latency,
-        total_input_tokens=total_input_tokens,
-        total_output_tokens=total_output_tokens,
-        avg_tokens_per_request=avg_tokens_per_request,
-        cost_per_token=cost_per_token,
-        requests_per_minute=requests_per_minute,
+        p95_latency_ms=p95_latency or 0.0,
+        p99_latency_ms=p99_latency or 0.0,
+        total_input_tokens=total_input_tokens or 0,
+        total_output_tokens=total_output_tokens or 0,
+        avg_tokens_per_request=(total_tokens / total) if total else 0.0,
+        cost_per_token=(total_cost / total_tokens) if total_tokens else 0.0,
+        requests_per_minute=(recent_requests or 0) / 60.0,
         error_rate_pct=failure_rate,
     )
 
+async def cached_summary(db: AsyncSession, since: Optional[datetime] = None, until: Optional[datetime] = None) -> MetricsSummary:
+    return await cache.result_cache.get_or_compute_async(
+        db, "metrics.summary", {"since": since, "until": until},
+        lambda session: compute_summary(session, since, until), tags=(cache.TRACES,),
+    )
+
+@router.get("/summary", response_model=MetricsSummary)
+async def get_summary(
+    since: Optional[datetime] = Query(None, description="Only include traces created at or after this time (UTC)"),
+    until: Optional[datetime] = Query(None, description="Only include traces created before this time (UTC)"),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await cached_summary(db, since, until)
+
+@router.get("/cache")
+def get_cache_stats():
+    """Hit/miss counters of the summary result cache"""
+    return cache.result_cache.snapshot()
+
+@router.get("/retention")
+def get_retention():
+    """Retention policies in days (0 keeps rows forever) and the last run of this process's job"""
+    return {
+        "enabled": retention.job.enabled,
+        "interval_seconds": retention.job.interval,
+        "policies": retention.policies(),
+        "last_run": retention.job.last_report,
+    }
+
+@router.get("/partitions")
+async def get_partitions():
+    """Trace partitions (see app.partitions) and the last maintenance run of this process's job"""
+    rows = await run_in_session(ReadSessionLocal, partitions.catalog)
+    return {
+        "enabled": partitions.job.enabled,
+        "period": partitions.PERIOD or None,
+        "partitions": [
+            {"name": partition.name, "range_start": partition.range_start, "range_end": partition.range_end}
+            for partition in rows
+        ],
+        "last_run": partitions.job.last_report,
+    }
+
 @router.get("/timeseries", response_model=MetricsTimeSeries)
-def get_timeseries(
+async def get_timeseries(
     metric_name: str = Query(..., description="Metric name: latency_ms, tokens, cost_usd, requests"),
-    hours: int = Query(24, description="Hours of data to return"),
-    aggregation: str = Query("avg", description="Aggregation: avg, sum, count, max, min"),
-    db: Session = Depends(get_db)
+    hours: int = Query(24, description="Hours of data to return (ignored when since is given)"),
+    aggregation: str = Query("avg", description="Aggregation: avg, sum, count, max, min, p95"),
+    since: Optional[datetime] = Query(None, description="Range start (UTC)"),
+    until: Optional[datetime] = Query(None, description="Range end (UTC), defaults to now"),
+    step: Optional[str] = Query(None, description="Bucket width such as 1m, 5m, 1h or 1d; chosen from the range when omitted"),
+    fill: str = Query("zero", description="Empty buckets: zero, previous or none (omit them)"),
 ):
-    end_time = datetime.utcnow()
-    start_time = end_time - timedelta(hours=hours)
-    
-    # Build query based on metric and aggregation
-    if metric_name == "latency_ms":
-        if aggregation == "avg":
-            query = db.query(
-                func.date_trunc('minute', LLMTrace.created_at).label('timestamp'),
-                func.avg(LLMTrace.latency_ms).label('value')
-            )
-        elif aggregation == "p95":
-            query = db.query(
-                func.date_trunc('minute', LLMTrace.created_at).label('timestamp'),
-                func.percentile_cont(0.95).within_group(LLMTrace.latency_ms).label('value')
-            )
-        else:
-            query = db.query(
-                func.date_trunc('minute', LLMTrace.created_at).label('timestamp'),
-                func.avg(LLMTrace.latency_ms).label('value')
+    if metric_name not in bucketing.METRICS:
+        raise HTTPException(status_code=400, detail=f"Unknown metric: {metric_name}")
+    if aggregation not in bucketing.AGGREGATIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown aggregation: {aggregation}")
+    if fill not in ("zero", "previous", "none"):
+        raise HTTPException(status_code=400, detail=f"Unknown fill mode: {fill}")
+
+    end_time = until or datetime.utcnow()
+    start_time = since or end_time - timedelta(hours=hours)
+    if start_time > end_time:
+        raise HTTPException(status_code=400, detail="since must be before until")
+    if step:
+        try:
+            step_seconds = bucketing.parse_step(step)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if bucketing.point_count(start_time, end_time, step_seconds) > bucketing.MAX_POINTS:
+            raise HTTPException(
+                status_code=400,
+                detail=f"step {step} yields more than {bucketing.MAX_POINTS} points for this range",
             )
-    elif metric_name == "tokens":
-        query = db.query(
-            func.date_trunc('minute', LLMTrace.created_at).label('timestamp'),
-            func.sum(LLMTrace.tokens).label('value')
-        )
-    elif metric_name == "cost_usd":
-        query = db.query(
-            func.date_trunc('minute', LLMTrace.created_at).label('timestamp'),
-            func.sum(LLMTrace.cost_usd).label('value')
-        )
-    elif metric_name == "requests":
-        query = db.query(
-            func.date_trunc('minute', LLMTrace.created_at).label('timestamp'),
-            func.count(LLMTrace.id).label('value')
-        )
     else:
-        raise ValueError(f"Unknown metric: {metric_name}")
-    
-    results = query.filter(
-        LLMTrace.created_at >= start_time,
-        LLMTrace.created_at <= end_time
-    ).group_by('timestamp').order_by('timestamp').all()
-    
-    data_points = [
-        TimeSeriesDataPoint(timestamp=row.timestamp, value=float(row.value or 0))
-        for row in results
-    ]
-    
+        step_seconds = bucketing.choose_step(start_time, end_time)
+
+    values = await run_in_session(ReadSessionLocal, bucketing.timeseries, metric_name, aggregation, start_time, end_time, step_seconds)
+
+    data_points = []
+    previous = 0.0
+    for epoch in bucketing.bucket_starts(start_time, end_time, step_seconds):
+        value = values.get(epoch)
+        if value is None:
+            if fill == "none":
+                continue
+            value = previous if fill == "previous" else 0.0
+        previous = float(value)
+        data_points.append(TimeSeriesDataPoint(timestamp=bucketing.from_epoch(epoch), value=previous))
+
     return MetricsTimeSeries(
         metric_name=metric_name,
         data_points=data_points,
-        aggregation=aggregation
+        aggregation=aggregation,
+        step_seconds=step_seconds,
     )
 
 @router.get("/models/summary")
-def get_models_summary(db: Session = Depends(get_db)):
+async def get_models_summary(db: AsyncSession = Depends(get_async_db)):
     """Get summary metrics grouped by model"""
-    results = db.query(
-        LLMTrace.model,
-        LLMTrace.provider,
-        func.count(LLMTrace.id).label('total_requests'),
-        func.avg(LLMTrace.latency_ms).label('avg_latency'),
-        func.sum(LLMTrace.tokens).label('total_tokens'),
-        func.sum(LLMTrace.cost_usd).label('total_cost'),
-        func.count(LLMTrace.id).filter(LLMTrace.status == 'success').label('success_count'),
-        func.count(LLMTrace.id).filter(LLMTrace.status == 'failure').label('failure_count')
-    ).group_by(LLMTrace.model, LLMTrace.provider).all()
+    return await cache.result_cache.get_or_compute_async(db, "metrics.models_summary", {}, _models_summary, tags=(cache.TRACES,))
+
+def _models_summary(db: Session):
+    if rollups.supported(db):
+        r = TraceRollupHour
+        results = db.query(
+            r.model,
+            r.provider,
+            func.sum(r.request_count).label('total_requests'),
+            (func.sum(r.latency_sum) / func.sum(r.request_count)).label('avg_latency'),
+            func.sum(r.tokens_sum).label('total_tokens'),
+            func.sum(r.cost_sum).label('total_cost'),
+            func.sum(case((r.status == 'success', r.request_count), else_=0)).label('success_count'),
+            func.sum(case((r.status == 'failure', r.request_count), else_=0)).label('failure_count')
+        ).group_by(r.model, r.provider).all()
+    else:
+        results = db.query(
+            LLMTrace.model,
+            LLMTrace.provider,
+            func.count(LLMTrace.id).label('total_requests'),
+            func.avg(LLMTrace.latency_ms).label('avg_latency'),
+            func.sum(LLMTrace.tokens).label('total_tokens'),
+            func.sum(LLMTrace.cost_usd).label('total_cost'),
+            func.count(LLMTrace.id).filter(LLMTrace.status == 'success').label('success_count'),
+            func.count(LLMTrace.id).filter(LLMTrace.status == 'failure').label('failure_count')
+        ).group_by(LLMTrace.model, LLMTrace.provider).all()
     
     return [
         {
-            "model": row.model,
-            "provider": row.provider,
+            # rollups store NULL model/provider as ""
+            "model": row.model or None,
+            "provider": row.provider or None,
             "total_requests": row.total_requests,
             "avg_latency_ms": float(row.avg_latency or 0),
             "total_tokens": row.total_tokens or 0,
@@ -166,16 +380,16 @@ def get_models_summary(db: Session = Depends(get_db)):
     ]
 
 @router.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(
+    websocket: WebSocket,
+    interval: float = Query(WS_DEFAULT_INTERVAL, description="Seconds between full snapshots; deltas are pushed as data arrives"),
+):
+    await manager.connect(websocket, interval)
     try:
+        # Updates are pushed by the shared producer; reading here only detects disconnects
         while True:
-            # Send periodic updates
-            await asyncio.sleep(5)  # Update every 5 seconds
-            summary = get_summary(db=next(get_db()))
-            await websocket.send_text(json.dumps({
-                "type": "metrics_update",
-                "data": summary.dict()
-            }))
+            await websocket.receive_text()
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(websocket)
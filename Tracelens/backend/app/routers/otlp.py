@@ -0,0 +1,40 @@
+from fastapi import APIRouter, HTTPException, Request, Response
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+import gzip
+from ..database import SessionLocal, run_in_session
+from ..otlp import OTLPDecodeError, decode_request, encode_response, ingest_export_request
+
+router = APIRouter(tags=["otlp"])
+
+def _ingest(db: Session, request: dict):
+    try:
+        result = ingest_export_request(db, request)
+        db.commit()
+        return result
+    except SQLAlchemyError:
+        db.rollback()
+        raise
+
+@router.post("/v1/traces")
+async def export_traces(request: Request):
+    """OTLP/HTTP trace receiver (protobuf or JSON encoding).
+
+    Each export request is written as one transaction: spans become AgentSpan rows
+    grouped into one session per OTLP trace, and GenAI model calls also become LLMTrace rows.
+    """
+    content_type = request.headers.get("content-type", "application/json")
+    body = await request.body()
+    if request.headers.get("content-encoding") == "gzip":
+        try:
+            body = gzip.decompress(body)
+        except OSError:
+            raise HTTPException(status_code=400, detail="Invalid gzip body")
+    try:
+        export = decode_request(body, content_type)
+    except OTLPDecodeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    _, _, errors = await run_in_session(SessionLocal, _ingest, export)
+    payload, media_type = encode_response(content_type, len(errors), "; ".join(sorted(set(errors))))
+    return Response(content=payload, media_type=media_type)
@@ -1,34 +1,96 @@
-from fastapi import APIRouter, Depends, Query
+from fastapi import APIRouter, Body, HTTPException, Query, Response
+from fastapi.responses import JSONResponse
+from pydantic import ValidationError
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
-from typing import List, Optional
-from ..database import get_db
+from typing import Any, Dict, List, Optional
+from .. import blobs
+from ..database import ReadSessionLocal, SessionLocal, run_in_session
+from ..ingest import MAX_BATCH_ITEMS, insert_trace_rows, insert_traces, trace_row
 from ..models import LLMTrace
-from ..schemas import LLMTraceCreate, LLMTraceOut
+from ..pagination import paginate
+from ..schemas import BatchItemError, BatchResult, LLMTraceCreate, LLMTraceOut
+from ..write_buffer import TRACE, write_buffer
 
 router = APIRouter(prefix="/traces", tags=["llm-traces"])
 
-@router.post("", response_model=LLMTraceOut)
-def create_trace(payload: LLMTraceCreate, db: Session = Depends(get_db)):
-    obj = LLMTrace(**payload.model_dump())
-    db.add(obj)
+def _create_trace(db: Session, row: dict) -> int:
+    trace_id = insert_trace_rows(db, [row])[0]
     db.commit()
-    db.refresh(obj)
-    return obj
+    return trace_id
 
-@router.get("", response_model=List[LLMTraceOut])
-def list_traces(
-    db: Session = Depends(get_db),
-    limit: int = 50,
-    offset: int = 0,
-    model: Optional[str] = None,
-    provider: Optional[str] = None,
-    status: Optional[str] = None,
-):
-    q = db.query(LLMTrace).order_by(LLMTrace.created_at.desc())
+@router.post("", response_model=LLMTraceOut)
+async def create_trace(payload: LLMTraceCreate):
+    row = trace_row(payload)
+    if write_buffer.running:
+        trace_id = await write_buffer.submit(TRACE, row)
+        if trace_id is None:
+            return JSONResponse(status_code=202, content={"status": "queued"})
+    else:
+        trace_id = await run_in_session(SessionLocal, _create_trace, row)
+    return LLMTraceOut(**row, id=trace_id)
+
+def _insert_batch(db: Session, valid: List[LLMTraceCreate]) -> List[int]:
+    try:
+        new_ids = insert_traces(db, valid)
+        db.commit()
+    except IntegrityError as e:
+        db.rollback()
+        raise HTTPException(status_code=409, detail=f"Batch rejected by database: {e.orig}")
+    return new_ids
+
+@router.post("/batch", response_model=BatchResult)
+async def create_traces_batch(items: List[Dict[str, Any]] = Body(...)):
+    """Persist many traces in one transaction; invalid items are reported, not fatal"""
+    if len(items) > MAX_BATCH_ITEMS:
+        raise HTTPException(status_code=413, detail=f"Batch exceeds {MAX_BATCH_ITEMS} items")
+
+    valid, positions, errors = [], [], []
+    for index, item in enumerate(items):
+        try:
+            valid.append(LLMTraceCreate.model_validate(item))
+            positions.append(index)
+        except ValidationError as e:
+            errors.append(BatchItemError(index=index, errors=e.errors(include_url=False, include_context=False)))
+
+    new_ids = await run_in_session(SessionLocal, _insert_batch, valid)
+
+    ids: List[Optional[int]] = [None] * len(items)
+    for index, trace_id in zip(positions, new_ids):
+        ids[index] = trace_id
+    return BatchResult(accepted=len(new_ids), rejected=len(errors), ids=ids, errors=errors)
+
+def _list_traces(db: Session, response: Response, limit: int, offset: int, cursor: Optional[str],
+                 model: Optional[str], provider: Optional[str], status: Optional[str]) -> List[LLMTrace]:
+    q = db.query(LLMTrace)
     if model:
         q = q.filter(LLMTrace.model == model)
     if provider:
         q = q.filter(LLMTrace.provider == provider)
     if status:
         q = q.filter(LLMTrace.status == status)
-    return q.offset(offset).limit(limit).all()
+    traces = paginate(q, LLMTrace.created_at, LLMTrace.id, response, limit, offset, cursor)
+    return blobs.resolve_objects(db, traces, blobs.TRACE_FIELDS)
+
+@router.get("", response_model=List[LLMTraceOut])
+async def list_traces(
+    response: Response,
+    limit: int = Query(50, ge=1, le=1000),
+    offset: int = 0,
+    cursor: Optional[str] = None,
+    model: Optional[str] = None,
+    provider: Optional[str] = None,
+    status: Optional[str] = None,
+):
+    """Newest first; pass the X-Next-Cursor header back as `cursor` for the next page"""
+    return await run_in_session(ReadSessionLocal, _list_traces, response, limit, offset, cursor, model, provider, status)
+
+def _trace(db: Session, trace_id: int) -> LLMTrace:
+    trace = db.get(LLMTrace, trace_id)
+    if not trace:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return blobs.resolve_objects(db, [trace], blobs.TRACE_FIELDS)[0]
+
+@router.get("/{trace_id}", response_model=LLMTraceOut)
+async def get_trace(trace_id: int):
+    return await run_in_session(ReadSessionLocal, _trace, trace_id)
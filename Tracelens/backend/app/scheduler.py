@@ -0,0 +1,243 @@
+""" Leader-elected background evaluation of alert thresholds.
+
+Every ALERT_SCHEDULER_INTERVAL_SECONDS the leader runs one grouped query over
+the longest window any enabled threshold uses, with conditional sums per
+window size, grouped by (model, provider). Per-threshold values (and their
+model/provider groups) are folded from that result in Python, then alerts are
+fired and resolved in one transaction through the `app.alerting` helpers:
+at most one open alert per threshold and group, resolution (setting
+`Alert.resolved_at`) only once the metric drops ALERT_HYSTERESIS_PCT below
+the threshold, and no re-firing within ALERT_COOLDOWN_SECONDS.
+
+Only one process evaluates at a time, so running several uvicorn workers is
+safe. On PostgreSQL the leader holds a session-level advisory lock on a
+dedicated connection, released when it stops or its connection dies. Other
+databases use a row in `scheduler_leases`, renewed every tick and taken over
+by another worker once it has not been renewed for three intervals.
+"""
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import and_, case, func, insert, or_, select, text, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from . import alerting
+from .database import SessionLocal, engine as db_engine
+from .models import LLMTrace, SchedulerLease
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.getenv("ALERT_SCHEDULER_ENABLED", "true").lower() in ("1", "true", "yes")
+INTERVAL_SECONDS = float(os.getenv("ALERT_SCHEDULER_INTERVAL_SECONDS", "30"))
+
+LEASE_NAME = "alert-scheduler"
+# Arbitrary application-wide key for pg_try_advisory_lock
+ADVISORY_LOCK_KEY = 72150001
+
+class AdvisoryLock:
+    """PostgreSQL session advisory lock held on a connection outside the pool."""
+
+    def __init__(self, engine, key: int = ADVISORY_LOCK_KEY):
+        self.engine = engine
+        self.key = key
+        self.conn = None
+
+    def acquire(self) -> bool:
+        if self.conn is not None:
+            try:
+                self.conn.execute(text("select 1"))
+                self.conn.commit()
+                return True
+            except Exception:
+                logger.warning("Lost the scheduler lock connection; re-electing")
+                self.release()
+        conn = self.engine.connect()
+        # Detached, so closing it ends the session (and the lock) instead of returning it to the pool
+        conn.detach()
+        try:
+            acquired = conn.execute(select(func.pg_try_advisory_lock(self.key))).scalar()
+            conn.commit()
+        except Exception:
+            conn.close()
+            raise
+        if not acquired:
+            conn.close()
+            return False
+        self.conn = conn
+        return True
+
+    def release(self):
+        if self.conn is None:
+            return
+        try:
+            self.conn.execute(select(func.pg_advisory_unlock(self.key)))
+            self.conn.commit()
+        except Exception:
+            pass
+        finally:
+            self.conn.close()
+            self.conn = None
+
+class Lease:
+    """Expiring leader lease stored in `scheduler_leases`."""
+
+    def __init__(self, session_factory=SessionLocal, name: str = LEASE_NAME, ttl_seconds: float = 3 * INTERVAL_SECONDS):
+        self.session_factory = session_factory
+        self.name = name
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def acquire(self) -> bool:
+        """Renew the lease if held, take it over if expired; True when this process holds it."""
+        table = SchedulerLease.__table__
+        now = datetime.utcnow()
+        with self.session_factory() as db:
+            renewed = db.execute(
+                update(table)
+                .where(table.c.name == self.name, or_(table.c.holder == self.holder, table.c.expires_at < now))
+                .values(holder=self.holder, expires_at=now + self.ttl)
+            ).rowcount
+            if not renewed:
+                try:
+                    db.execute(insert(table).values(name=self.name, holder=self.holder, expires_at=now + self.ttl))
+                except IntegrityError:
+                    # Held by another worker
+                    db.rollback()
+                    return False
+            db.commit()
+        return True
+
+    def release(self):
+        table = SchedulerLease.__table__
+        with self.session_factory() as db:
+            db.execute(
+                update(table)
+                .where(table.c.name == self.name, table.c.holder == self.holder)
+                .values(expires_at=datetime.utcnow())
+            )
+            db.commit()
+
+def _window_columns(sizes: List[int], now: datetime) -> list:
+    """Per-window REQUESTS..COST conditional sums, in alerting's accumulator order."""
+    columns = []
+    for seconds in sizes:
+        inside = LLMTrace.created_at >= now - timedelta(seconds=seconds)
+        columns += [
+            func.sum(case((inside, 1), else_=0)),
+            func.sum(case((and_(inside, LLMTrace.status == "failure"), 1), else_=0)),
+            func.coalesce(func.sum(case((inside, LLMTrace.latency_ms), else_=0)), 0),
+            func.coalesce(func.sum(case((inside, LLMTrace.tokens), else_=0)), 0),
+            func.coalesce(func.sum(case((inside, LLMTrace.cost_usd), else_=0)), 0),
+        ]
+    return columns
+
+def window_totals(db: Session, sizes: List[int], now: datetime) -> List[Tuple[Any, Any, Dict[int, List[float]]]]:
+    """(model, provider, {window seconds: totals}) for traces in the longest of `sizes`."""
+    rows = db.execute(
+        select(LLMTrace.model, LLMTrace.provider, *_window_columns(sizes, now))
+        .where(LLMTrace.created_at >= now - timedelta(seconds=max(sizes)))
+        .group_by(LLMTrace.model, LLMTrace.provider)
+    )
+    result = []
+    for model, provider, *sums in rows:
+        totals = {seconds: [float(v or 0) for v in sums[i * 5:(i + 1) * 5]] for i, seconds in enumerate(sizes)}
+        result.append((model, provider, totals))
+    return result
+
+def evaluate(db: Session, now: Optional[datetime] = None) -> Tuple[int, int]:
+    """Fire and resolve threshold alerts for the current windows and commit; returns (fired, resolved)."""
+    now = now or datetime.utcnow()
+    thresholds = alerting.load_thresholds(db)
+    if not thresholds:
+        return 0, 0
+    sizes = sorted({alerting.WINDOWS[t["window"]] for t in thresholds})
+    rows = window_totals(db, sizes, now)
+    opened = alerting.open_alerts(db)
+    cooling = alerting.cooling_down(db, now)
+
+    fired = resolved = 0
+    for t in thresholds:
+        seconds = alerting.WINDOWS[t["window"]]
+        groups: Dict[str, List[float]] = {}
+        for model, provider, totals in rows:
+            row = {"model": model, "provider": provider}
+            label = alerting.group_label(t["group_by"], tuple(row[name] for name in alerting.GROUP_BY[t["group_by"]]))
+            acc = groups.setdefault(label, [0.0] * 5)
+            for field, value in enumerate(totals[seconds]):
+                acc[field] += value
+        # Groups with open alerts but no traffic left in the window are evaluated as empty
+        for threshold_id, label in opened:
+            if threshold_id == t["id"]:
+                groups.setdefault(label, [0.0] * 5)
+        for label, totals in groups.items():
+            value = alerting.metric_value(t["metric_name"], totals, seconds)
+            key = (t["id"], label)
+            if key in opened:
+                if alerting.recovered(value, t["threshold_value"]):
+                    resolved += alerting.resolve_alert(db, opened[key]) is not None
+            elif key not in cooling and alerting.breached(value, t["threshold_value"]):
+                fired += alerting.fire_alert(db, t, value, label, check=False) is not None
+    db.commit()
+    return fired, resolved
+
+def run_once() -> Tuple[int, int]:
+    with SessionLocal() as db:
+        return evaluate(db)
+
+class AlertScheduler:
+    def __init__(self, enabled: bool = ENABLED, interval_seconds: float = INTERVAL_SECONDS):
+        self.enabled = enabled
+        self.interval = interval_seconds
+        self.leader = None
+        self.is_leader = False
+        self._task: Optional[asyncio.Task] = None
+        # Worker-thread call in progress; cancelling _task does not stop the thread
+        self._call: Optional[asyncio.Future] = None
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        if db_engine.dialect.name == "postgresql":
+            self.leader = AdvisoryLock(db_engine)
+        else:
+            self.leader = Lease(ttl_seconds=3 * self.interval)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+        # Wait for the thread, so the leader is not released under a running tick
+        if self._call is not None:
+            await asyncio.gather(self._call, return_exceptions=True)
+            self._call = None
+        # Unconditionally: an acquire interrupted by the cancel may still have succeeded
+        await run_in_threadpool(self.leader.release)
+        self.is_leader = False
+
+    async def _in_thread(self, fn: Callable, *args):
+        self._call = asyncio.ensure_future(run_in_threadpool(fn, *args))
+        result = await asyncio.shield(self._call)
+        self._call = None
+        return result
+
+    async def _run(self):
+        while True:
+            try:
+                self.is_leader = await self._in_thread(self.leader.acquire)
+                if self.is_leader:
+                    fired, resolved = await self._in_thread(run_once)
+                    if fired or resolved:
+                        logger.info("Alert scheduler fired %d and resolved %d alerts", fired, resolved)
+            except Exception:
+                logger.exception("Alert scheduler tick failed")
+            await asyncio.sleep(self.interval)
+
+scheduler = AlertScheduler()
@@ -1,7 +1,11 @@
-from pydantic import BaseModel, Field
+from pydantic import AliasChoices, BaseModel, Field
 from typing import Optional, List, Dict, Any
 from datetime import datetime
 
+def _metadata_field():
+    # ORM rows map the `metadata` column as `metadata_` (the name is reserved by declarative)
+    return Field(None, validation_alias=AliasChoices("metadata_", "metadata"))
+
 class LLMTraceCreate(BaseModel):
     model: str
     provider: str
@@ -23,7 +27,7 @@ class LLMTraceCreate(BaseModel):
     endpoint: Optional[str] = None
     temperature: Optional[float] = None
     max_tokens: Optional[int] = None
-    metadata: Optional[Dict[str, Any]] = None
+    metadata: Optional[Dict[str, Any]] = _metadata_field()
 
 class LLMTraceOut(LLMTraceCreate):
     id: int
@@ -31,6 +35,29 @@ class LLMTraceOut(LLMTraceCreate):
     class Config:
         from_attributes = True
 
+class BatchItemError(BaseModel):
+    index: int
+    errors: List[Dict[str, Any]]
+
+class BatchResult(BaseModel):
+    accepted: int = 0
+    rejected: int = 0
+    ids: List[Optional[int]] = []  # aligned with the request items, None for rejected ones
+    errors: List[BatchItemError] = []
+
+class LineError(BaseModel):
+    line: int
+    error: str
+
+class NdjsonIngestResult(BaseModel):
+    lines: int = 0
+    accepted: Dict[str, int] = {}
+    rejected: int = 0
+    errors: List[LineError] = []  # first INGEST_NDJSON_MAX_ERRORS rejections only
+    bytes_read: int = 0
+    duration_ms: float = 0.0
+    records_per_second: float = 0.0
+
 class AgentSpanCreate(BaseModel):
     session_id: int
     parent_id: Optional[int] = None
@@ -51,12 +78,14 @@ class AgentSpanCreate(BaseModel):
     provider_used: Optional[str] = None
     tool_calls: Optional[Dict[str, Any]] = None
     reasoning_steps: Optional[Dict[str, Any]] = None
-    metadata: Optional[Dict[str, Any]] = None
+    metadata: Optional[Dict[str, Any]] = _metadata_field()
     trace_id: Optional[str] = None
 
 class AgentSpanOut(AgentSpanCreate):
     id: int
     created_at: datetime
+    self_time_ms: Optional[float] = None
+    critical_time_ms: Optional[float] = None
     class Config:
         from_attributes = True
 
@@ -64,7 +93,7 @@ class AgentSessionCreate(BaseModel):
     user_id: Optional[str] = None
     title: Optional[str] = None
     status: str = "running"
-    metadata: Optional[Dict[str, Any]] = None
+    metadata: Optional[Dict[str, Any]] = _metadata_field()
 
 class AgentSessionOut(AgentSessionCreate):
     id: int
@@ -74,6 +103,7 @@ class AgentSessionOut(AgentSessionCreate):
     total_tokens: int = 0
     total_cost_usd: float = 0.0
     error_message: Optional[str] = None
+    critical_path_ms: Optional[float] = None
     class Config:
         from_attributes = True
 
@@ -88,7 +118,7 @@ class AlertCreate(BaseModel):
     session_id: Optional[int] = None
     span_id: Optional[int] = None
     trace_id: Optional[int] = None
-    metadata: Optional[Dict[str, Any]] = None
+    metadata: Optional[Dict[str, Any]] = _metadata_field()
 
 class AlertOut(AlertCreate):
     id: int
@@ -106,6 +136,8 @@ class AlertThresholdCreate(BaseModel):
     severity: str
     enabled: bool = True
     description: Optional[str] = None
+    window: str = "5m"  # 1m | 5m | 1h
+    group_by: Optional[str] = None  # model | provider | model_provider
 
 class AlertThresholdOut(AlertThresholdCreate):
     id: int
@@ -140,4 +172,5 @@ class TimeSeriesDataPoint(BaseModel):
 class MetricsTimeSeries(BaseModel):
     metric_name: str
     data_points: List[TimeSeriesDataPoint]
-    aggregation: str = "avg"  # avg | sum | count | max | min
+    aggregation: str = "avg"  # avg | sum | count | max | min | p95
+    step_seconds: Optional[int] = None  # bucket width
@@ -0,0 +1,121 @@
+""" Session totals maintained on ingest.
+
+`agent_sessions.total_latency_ms`, `total_tokens` and `total_cost_usd` are
+incremented in the same transaction as the spans and traces that change
+them, with `UPDATE ... SET total = total + :delta` so concurrent writers
+never lose an update. `app.ingest` accumulates the deltas of a transaction
+and writes them when it commits, after every other table. Spans add their latency, tokens and cost; LLM traces
+attached to a session add their cost (the same sums `get_session_analysis`
+has always reported).
+
+Totals of sessions written outside the API, or before this existed, are
+recomputed from the spans and traces in chunks of sessions with:
+
+    python -m app.session_totals repair
+"""
+import math
+import os
+import sys
+from typing import Any, Dict, List, Sequence, Tuple
+from sqlalchemy import bindparam, func, select, update
+from sqlalchemy.orm import Session
+from . import cache, partitions
+from .models import AgentSession, AgentSpan
+
+REPAIR_CHUNK_SIZE = int(os.getenv("SESSION_TOTALS_REPAIR_CHUNK_SIZE", "500"))
+
+TOTALS = ("total_latency_ms", "total_tokens", "total_cost_usd")
+
+def add(deltas: Dict[int, List[float]], span_rows: Sequence[Dict[str, Any]] = (),
+        trace_rows: Sequence[Dict[str, Any]] = ()) -> Dict[int, List[float]]:
+    """Accumulate the totals new rows add to their sessions into `deltas` (session id -> [latency, tokens, cost])."""
+    for row in span_rows:
+        if row.get("session_id") is not None:
+            d = deltas.setdefault(row["session_id"], [0.0, 0, 0.0])
+            d[0] += row.get("latency_ms") or 0.0
+            d[1] += row.get("tokens_used") or 0
+            d[2] += row.get("cost_usd") or 0.0
+    for row in trace_rows:
+        if row.get("session_id") is not None:
+            deltas.setdefault(row["session_id"], [0.0, 0, 0.0])[2] += row.get("cost_usd") or 0.0
+    return deltas
+
+def write(db: Session, deltas: Dict[int, List[float]]):
+    """Add accumulated deltas to the stored totals; the caller owns the transaction."""
+    deltas = {session_id: d for session_id, d in deltas.items() if any(d)}
+    if not deltas:
+        return
+    table = AgentSession.__table__
+    stmt = update(table).where(table.c.id == bindparam("_id")).values({
+        table.c[name]: func.coalesce(table.c[name], 0) + bindparam(f"_{name}") for name in TOTALS
+    })
+    # Sorted, so concurrent batches lock session rows in the same order
+    db.execute(stmt, [
+        {"_id": session_id, **{f"_{name}": value for name, value in zip(TOTALS, deltas[session_id])}}
+        for session_id in sorted(deltas)
+    ])
+    cache.touch(db, cache.SESSIONS)
+
+def _recomputed(db: Session, low: int, high: int) -> Dict[int, Tuple[float, int, float]]:
+    spans = db.execute(
+        select(
+            AgentSpan.session_id,
+            func.coalesce(func.sum(AgentSpan.latency_ms), 0.0),
+            func.coalesce(func.sum(AgentSpan.tokens_used), 0),
+            func.coalesce(func.sum(AgentSpan.cost_usd), 0.0),
+        ).where(AgentSpan.session_id >= low, AgentSpan.session_id <= high).group_by(AgentSpan.session_id)
+    )
+    totals = {session_id: [latency, tokens, cost] for session_id, latency, tokens, cost in spans}
+    table = partitions.all_traces(db)
+    traces = db.execute(
+        select(table.c.session_id, func.coalesce(func.sum(table.c.cost_usd), 0.0))
+        .where(table.c.session_id >= low, table.c.session_id <= high).group_by(table.c.session_id)
+    )
+    for session_id, cost in traces:
+        totals.setdefault(session_id, [0.0, 0, 0.0])[2] += cost
+    return totals
+
+def repair(db: Session, chunk_size: int = REPAIR_CHUNK_SIZE) -> Tuple[int, int]:
+    """Recompute totals from spans and traces, `chunk_size` sessions per transaction.
+
+    Returns (sessions checked, sessions corrected). Each chunk's session rows are locked
+    (on PostgreSQL) before summing, so increments from concurrent ingest are not lost.
+    """
+    table = AgentSession.__table__
+    stmt = update(table).where(table.c.id == bindparam("_id")).values({
+        table.c[name]: bindparam(f"_{name}") for name in TOTALS
+    })
+    checked = corrected = 0
+    last_id = 0
+    while True:
+        sessions = db.execute(
+            select(table.c.id, *(table.c[name] for name in TOTALS))
+            .where(table.c.id > last_id)
+            .order_by(table.c.id)
+            .limit(chunk_size)
+            .with_for_update()
+        ).all()
+        if not sessions:
+            break
+        last_id = sessions[-1][0]
+        totals = _recomputed(db, sessions[0][0], last_id)
+        changed = []
+        for session_id, *stored in sessions:
+            expected = totals.get(session_id, [0.0, 0, 0.0])
+            if not all(math.isclose(s or 0, e, rel_tol=1e-9, abs_tol=1e-9) for s, e in zip(stored, expected)):
+                changed.append({"_id": session_id, **{f"_{name}": value for name, value in zip(TOTALS, expected)}})
+        if changed:
+            db.execute(stmt, changed)
+            cache.touch(db, cache.SESSIONS)
+        db.commit()
+        checked += len(sessions)
+        corrected += len(changed)
+    return checked, corrected
+
+if __name__ == "__main__":
+    from .database import SessionLocal
+    if sys.argv[1:] != ["repair"]:
+        sys.exit("usage: python -m app.session_totals repair")
+    with SessionLocal() as session:
+        checked, corrected = repair(session)
+        print(f"Checked {checked} sessions, corrected {corrected}")
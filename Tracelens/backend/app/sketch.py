@@ -0,0 +1,147 @@
+""" DDSketch: a compact, mergeable quantile sketch.
+
+Values are counted in logarithmically sized bins: bin i covers
+(gamma^(i-1), gamma^i] with gamma = (1 + a) / (1 - a). Any quantile returned
+by `quantile` is within a relative error of `a` (the `relative_accuracy`) of
+the exact value of that rank, e.g. with the default a = 0.01 a true p99 of
+2000 ms is reported between 1980 ms and 2020 ms. Merging two sketches with the
+same accuracy is exact (bin counts are added), so sketches of small time
+buckets can be combined to answer any larger range with the same guarantee.
+
+Reference: Masson, Rim, Lee, "DDSketch: A Fast and Fully-Mergeable Quantile
+Sketch with Relative-Error Guarantees", VLDB 2019.
+"""
+import math
+import struct
+from typing import Dict, Iterable, Optional
+
+DEFAULT_RELATIVE_ACCURACY = 0.01
+# Values at or below this are counted as zero (latencies are never negative)
+MIN_INDEXABLE_VALUE = 1e-9
+
+_HEADER = struct.Struct("<Bdddd")  # version, relative accuracy, zero count, min, max
+_VERSION = 1
+
+class DDSketch:
+    def __init__(self, relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins: Dict[int, float] = {}
+        self.zero_count = 0.0
+        self.count = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _index(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index: int) -> float:
+        # Midpoint (in relative terms) of the bin, which bounds the error on both sides
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value: float, count: float = 1.0):
+        if value is None or count <= 0:
+            return
+        value = max(float(value), 0.0)
+        if value <= MIN_INDEXABLE_VALUE:
+            self.zero_count += count
+        else:
+            index = self._index(value)
+            self.bins[index] = self.bins.get(index, 0.0) + count
+        self.count += count
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def merge(self, other: "DDSketch"):
+        if other.count == 0:
+            return
+        if other.gamma == self.gamma:
+            for index, count in other.bins.items():
+                self.bins[index] = self.bins.get(index, 0.0) + count
+            self.zero_count += other.zero_count
+            self.count += other.count
+        else:
+            # Different accuracy: re-bin the other sketch's representative values
+            self.add(0.0, other.zero_count)
+            for index, count in other.bins.items():
+                self.add(other._value(index), count)
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if self.count == 0:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                return min(max(self._value(index), self.min), self.max)
+        return self.max
+
+    def to_bytes(self) -> bytes:
+        """Compact encoding: header, then zig-zag varint bin index deltas and varint counts."""
+        out = bytearray(_HEADER.pack(_VERSION, self.relative_accuracy, self.zero_count,
+                                     self.min if self.count else 0.0, self.max if self.count else 0.0))
+        previous = 0
+        for index in sorted(self.bins):
+            delta = index - previous
+            previous = index
+            _write_varint(out, (delta << 1) ^ (delta >> 63))
+            _write_varint(out, int(round(self.bins[index])))
+        return bytes(out)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "DDSketch":
+        version, accuracy, zero_count, lo, hi = _HEADER.unpack_from(data)
+        if version != _VERSION:
+            raise ValueError(f"Unsupported sketch version {version}")
+        sketch = cls(accuracy)
+        sketch.zero_count = zero_count
+        pos = _HEADER.size
+        index = 0
+        while pos < len(data):
+            zigzag, pos = _read_varint(data, pos)
+            index += (zigzag >> 1) ^ -(zigzag & 1)
+            count, pos = _read_varint(data, pos)
+            sketch.bins[index] = float(count)
+        sketch.count = zero_count + sum(sketch.bins.values())
+        if sketch.count:
+            sketch.min, sketch.max = lo, hi
+        return sketch
+
+    @classmethod
+    def of(cls, values: Iterable[float], relative_accuracy: float = DEFAULT_RELATIVE_ACCURACY) -> "DDSketch":
+        sketch = cls(relative_accuracy)
+        for value in values:
+            sketch.add(value)
+        return sketch
+
+def _write_varint(out: bytearray, value: int):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+def _read_varint(data: bytes, pos: int):
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
@@ -0,0 +1,169 @@
+""" Span trees for agent sessions.
+
+Trees are built from a projection: only `id`, `parent_id` and the requested
+fields are selected, so the prompt/output/reasoning payloads are never read
+unless asked for; large prompts and outputs are then read from `blobs` (see
+`app.blobs`). With `max_depth` the spans are walked with a recursive CTE
+over `agent_spans.parent_id`, so the top levels of a session with tens of
+thousands of spans cost a few index lookups; nodes cut off at the depth limit
+report their `child_count` and can be expanded later from their own id.
+
+Assembly and JSON encoding are iterative, so arbitrarily deep agent loops do
+not hit the interpreter's recursion limit.
+"""
+import json
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+from sqlalchemy import and_, func, literal, select
+from sqlalchemy.orm import Session
+from . import blobs
+from .models import AgentSpan
+
+# field name -> agent_spans column name; "children" and "child_count" are always present
+FIELDS = {
+    name: name for name in (
+        "id", "parent_id", "span_type", "name", "status", "latency_ms", "prompt", "output", "error",
+        "created_at", "started_at", "ended_at", "tokens_used", "cost_usd", "model_used", "provider_used",
+        "tool_calls", "reasoning_steps", "metadata", "trace_id", "self_time_ms", "critical_time_ms",
+    )
+}
+# Everything but the large text/JSON payloads
+SUMMARY_FIELDS = [name for name in FIELDS if name not in ("prompt", "output", "tool_calls", "reasoning_steps", "metadata")]
+
+# Ids per IN (...) list when counting children of frontier nodes
+CHUNK_SIZE = 500
+
+def parse_fields(value: Optional[str]) -> List[str]:
+    """`fields=` query value -> field names. None or "all" selects every field, "summary" the small ones."""
+    if value is None or value == "all":
+        return list(FIELDS)
+    if value == "summary":
+        return list(SUMMARY_FIELDS)
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    unknown = [name for name in names if name not in FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown span fields: {', '.join(unknown)} (expected any of {', '.join(FIELDS)})")
+    return names
+
+def _columns(fields: Sequence[str]) -> list:
+    columns = {column.name: column for column in AgentSpan.__table__.columns}
+    names = ["id", "parent_id"] + [name for name in fields if name not in ("id", "parent_id")]
+    refs = [blobs.SPAN_FIELDS[name] for name in names if name in blobs.SPAN_FIELDS]
+    return [columns[FIELDS[name]].label(name) for name in names] + [columns[ref].label(ref) for ref in refs]
+
+def _walk(db: Session, anchor, fields: Sequence[str], max_depth: int) -> List[Dict[str, Any]]:
+    """Rows of `anchor`'s spans and their descendants down to `max_depth` levels below them."""
+    table = AgentSpan.__table__
+    tree = select(table.c.id, literal(0).label("depth")).where(anchor).cte("span_tree", recursive=True)
+    tree = tree.union_all(
+        select(table.c.id, tree.c.depth + 1)
+        .join(tree, table.c.parent_id == tree.c.id)
+        .where(tree.c.depth < max_depth)
+    )
+    rows = db.execute(
+        select(tree.c.depth, *_columns(fields))
+        .join(tree, table.c.id == tree.c.id)
+        .order_by(table.c.created_at, table.c.id)
+    ).mappings().all()
+    # A span reached twice (only possible through a parent_id cycle) is kept at its shallowest depth
+    depth: Dict[int, int] = {}
+    for row in rows:
+        depth[row["id"]] = min(row["depth"], depth.get(row["id"], row["depth"]))
+    result = []
+    for row in rows:
+        if depth.get(row["id"]) == row["depth"]:
+            del depth[row["id"]]
+            result.append(dict(row))
+    return result
+
+def _child_counts(db: Session, ids: Iterable[int]) -> Dict[int, int]:
+    ids = list(ids)
+    counts: Dict[int, int] = {}
+    for i in range(0, len(ids), CHUNK_SIZE):
+        rows = db.execute(
+            select(AgentSpan.parent_id, func.count(AgentSpan.id))
+            .where(AgentSpan.parent_id.in_(ids[i:i + CHUNK_SIZE]))
+            .group_by(AgentSpan.parent_id)
+        )
+        counts.update((parent_id, count) for parent_id, count in rows)
+    return counts
+
+def _assemble(rows: List[Dict[str, Any]], root_ids: Optional[set] = None) -> List[Dict[str, Any]]:
+    """Link rows (in display order) into trees; rows whose parent is absent become roots."""
+    nodes = {row["id"]: row for row in rows}
+    roots = []
+    for row in rows:
+        row["children"] = []
+    for row in rows:
+        parent = nodes.get(row["parent_id"])
+        if parent is None or (root_ids is not None and row["id"] in root_ids):
+            roots.append(row)
+        else:
+            parent["children"].append(row)
+    return roots
+
+def _finish(db: Session, rows: List[Dict[str, Any]], fields: Sequence[str], frontier_depth: Optional[int]):
+    """Fill child_count, querying children of nodes at the depth limit, and blob payloads; drop helper columns."""
+    blobs.resolve(db, rows, blobs.SPAN_FIELDS)
+    frontier = [row["id"] for row in rows if frontier_depth is not None and row.get("depth") == frontier_depth]
+    counts = _child_counts(db, frontier) if frontier else {}
+    for row in rows:
+        row["child_count"] = counts.get(row["id"], len(row["children"]))
+        row.pop("depth", None)
+        if "parent_id" not in fields:
+            del row["parent_id"]
+
+def session_tree(db: Session, session_id: int, fields: Sequence[str], max_depth: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Root spans of a session with their descendants, at most `max_depth` levels below the roots."""
+    if max_depth is None:
+        rows = [dict(row) for row in db.execute(
+            select(*_columns(fields))
+            .where(AgentSpan.session_id == session_id)
+            .order_by(AgentSpan.created_at, AgentSpan.id)
+        ).mappings()]
+        roots = _assemble(rows)
+        _finish(db, rows, fields, None)
+        return roots
+    # Depth-limited trees start from parentless spans only (an index range); spans whose parent
+    # is missing from the session are returned as roots by the full tree
+    anchor = and_(AgentSpan.session_id == session_id, AgentSpan.parent_id.is_(None))
+    rows = _walk(db, anchor, fields, max_depth)
+    roots = _assemble(rows, {row["id"] for row in rows if row["depth"] == 0})
+    _finish(db, rows, fields, max_depth)
+    return roots
+
+def subtree(db: Session, span_id: int, fields: Sequence[str], max_depth: int = 1) -> Optional[Dict[str, Any]]:
+    """One span with its descendants down to `max_depth` levels, or None if it does not exist."""
+    rows = _walk(db, AgentSpan.id == span_id, fields, max_depth)
+    if not rows:
+        return None
+    roots = _assemble(rows, {span_id})
+    _finish(db, rows, fields, max_depth)
+    return next(root for root in roots if root["id"] == span_id)
+
+def _default(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def to_json(nodes: List[Dict[str, Any]]) -> str:
+    """Encode a list of nested nodes without recursion."""
+    out = ["["]
+    stack = [iter(nodes)]
+    first = [True]
+    while stack:
+        node = next(stack[-1], None)
+        if node is None:
+            stack.pop()
+            first.pop()
+            out.append("]}" if stack else "]")
+            continue
+        if not first[-1]:
+            out.append(",")
+        first[-1] = False
+        values = {key: value for key, value in node.items() if key != "children"}
+        # One dumps call per node; reopen the object to append its children
+        out.append(json.dumps(values, default=_default)[:-1] + (',"children":[' if values else '"children":['))
+        stack.append(iter(node["children"]))
+        first.append(True)
+    return "".join(out)
@@ -0,0 +1,174 @@
+""" Group-commit buffer that coalesces single-row trace and span writes.
+
+Producers enqueue prepared rows; a background flusher writes whatever has
+accumulated every `max_rows` rows or `max_delay_ms` milliseconds, whichever
+comes first, in one transaction. With durability "flush" the caller waits for
+the commit and gets the assigned id back; with "enqueue" it is acknowledged
+as soon as the row is queued.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+from sqlalchemy.orm import Session
+from .database import SessionLocal, run_in_session
+from .ingest import insert_span_rows, insert_trace_rows
+
+logger = logging.getLogger(__name__)
+
+TRACE = "trace"
+SPAN = "span"
+
+class BufferClosed(Exception):
+    pass
+
+class WriteBuffer:
+    def __init__(self, enabled: bool = False, max_rows: int = 500, max_delay_ms: int = 50,
+                 max_pending: int = 10000, durability: str = "flush"):
+        if durability not in ("flush", "enqueue"):
+            raise ValueError(f"Unknown durability mode: {durability}")
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000.0
+        self.max_pending = max_pending
+        self.durability = durability
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._blocked = 0  # producers waiting for room in the queue
+
+    @classmethod
+    def from_env(cls) -> "WriteBuffer":
+        return cls(
+            enabled=os.getenv("INGEST_BUFFER_ENABLED", "false").lower() in ("1", "true", "yes"),
+            max_rows=int(os.getenv("INGEST_BUFFER_MAX_ROWS", "500")),
+            max_delay_ms=int(os.getenv("INGEST_BUFFER_MAX_DELAY_MS", "50")),
+            max_pending=int(os.getenv("INGEST_BUFFER_MAX_PENDING", "10000")),
+            durability=os.getenv("INGEST_BUFFER_DURABILITY", "flush"),
+        )
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    async def start(self):
+        if not self.enabled or self._task is not None:
+            return
+        self._closing = False
+        self._queue = asyncio.Queue(maxsize=self.max_pending)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop accepting rows and flush everything already queued, including rows of blocked producers."""
+        if self._task is None:
+            return
+        self._closing = True
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    async def submit(self, kind: str, row: Dict[str, Any]) -> Optional[int]:
+        """Queue one row. Blocks while the buffer is full (bounded memory).
+
+        Returns the assigned id in "flush" mode and None in "enqueue" mode.
+        """
+        if not self.running:
+            raise BufferClosed("Write buffer is not running")
+        future = asyncio.get_running_loop().create_future() if self.durability == "flush" else None
+        self._blocked += 1
+        try:
+            await self._queue.put((kind, row, future))
+        finally:
+            self._blocked -= 1
+        if future is None:
+            return None
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_rows:
+                try:
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+        # Producers blocked on a full queue when stop() began are woken as the queue drains;
+        # `running` is already false, so no new ones arrive
+        while self._blocked or not self._queue.empty():
+            leftovers = []
+            while not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is not None:
+                    leftovers.append(item)
+            if leftovers:
+                await self._flush(leftovers)
+            else:
+                await asyncio.sleep(0)
+
+    async def _flush(self, batch: List[Tuple[str, Dict[str, Any], Optional[asyncio.Future]]]):
+        rows = [(kind, row) for kind, row, _ in batch]
+        try:
+            results = await run_in_session(SessionLocal, _write_batch, rows)
+        except Exception as e:  # the whole batch failed before per-row isolation could run
+            logger.exception("Write buffer flush failed")
+            results = [e] * len(batch)
+        for (_, _, future), result in zip(batch, results):
+            if future is None:
+                if isinstance(result, Exception):
+                    logger.error("Dropped buffered row: %s", result)
+            elif future.done():  # the waiting request went away
+                continue
+            elif isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+def _write_batch(db: Session, rows: List[Tuple[str, Dict[str, Any]]]) -> List[Any]:
+    """Write a batch in one transaction, falling back to row-by-row to isolate bad rows."""
+    # One multi-row INSERT per table; ids are mapped back to each row's position in the batch
+    span_positions = [i for i, (kind, _) in enumerate(rows) if kind == SPAN]
+    trace_positions = [i for i, (kind, _) in enumerate(rows) if kind == TRACE]
+    results: List[Any] = [None] * len(rows)
+
+    try:
+        ids = (insert_span_rows(db, [rows[i][1] for i in span_positions])
+               + insert_trace_rows(db, [rows[i][1] for i in trace_positions]))
+        db.commit()
+        for i, new_id in zip(span_positions + trace_positions, ids):
+            results[i] = new_id
+        return results
+    except Exception:
+        db.rollback()
+        if len(rows) == 1:
+            raise
+
+    # In submission order
+    for i, (kind, row) in enumerate(rows):
+        try:
+            insert = insert_span_rows if kind == SPAN else insert_trace_rows
+            results[i] = insert(db, [row])[0]
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            results[i] = e
+    return results
+
+write_buffer = WriteBuffer.from_env()
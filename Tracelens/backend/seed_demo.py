@@ -2,6 +2,7 @@
 import random
 import json
 from datetime import datetime, timedelta
+from app import rollups
 from app.database import SessionLocal, engine, Base
 from app.models import LLMTrace, AgentSession, AgentSpan, Alert, AlertThreshold
 
@@ -54,7 +55,7 @@ for i in range(200):
         endpoint=f"/v1/chat/completions",
         temperature=random.uniform(0.1, 1.0),
         max_tokens=random.randint(100, 2000),
-        metadata={
+        metadata_={
             "conversation_id": f"conv_{random.randint(1000, 9999)}",
             "session_id": f"session_{random.randint(100, 999)}",
             "model_version": f"{model}-v{random.randint(1, 3)}"
@@ -66,6 +67,9 @@ for i in range(200):
 db.commit()
 print("✓ Created 200 LLM traces")
 
+# The ORM inserts above bypass the ingest path, so refresh the dashboard rollups
+rollups.rebuild(db)
+
 print("Creating agent sessions and spans...")
 # Enhanced agent sessions with realistic workflows
 session_titles = [
@@ -96,7 +100,7 @@ for sidx in range(15):
         status=random.choice(["completed", "running", "failed"]),
         started_at=started_at,
         ended_at=started_at + timedelta(minutes=random.randint(1, 30)) if random.random() > 0.2 else None,
-        metadata={
+        metadata_={
             "environment": random.choice(["production", "staging", "development"]),
             "version": f"v{random.randint(1, 5)}.{random.randint(0, 9)}",
             "region": random.choice(["us-east", "us-west", "eu-west", "asia-pacific"])
@@ -161,7 +165,7 @@ for sidx in range(15):
                 f"Step {k+2}: Executing {span_type} logic",
                 f"Step {k+3}: Validating {span_type} results"
             ] if span_type == "reasoning" else None,
-            metadata={
+            metadata_={
                 "iteration": j+1,
                 "priority": random.choice(["high", "medium", "low"]),
                 "retry_count": random.randint(0, 3)
@@ -232,7 +236,7 @@ for i in range(8):
         acknowledged_by=f"user_{random.randint(1, 10)}" if random.random() > 0.3 else None,
         created_at=created_at,
         resolved_at=created_at + timedelta(hours=random.randint(1, 24)) if random.random() > 0.5 else None,
-        metadata={
+        metadata_={
             "source": random.choice(["monitoring", "user_report", "automated_check"]),
             "environment": random.choice(["production", "staging"]),
             "region": random.choice(["us-east", "eu-west"])
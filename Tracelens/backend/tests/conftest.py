@@ -0,0 +1,61 @@
+""" Shared fixtures: a throwaway database, configured before `app` is imported.
+
+Tests run on SQLite by default; set TEST_DATABASE_URL to run them against a
+scratch PostgreSQL database instead (its tables are emptied between tests).
+"""
+import asyncio
+import os
+import tempfile
+
+_url = os.getenv("TEST_DATABASE_URL")
+if not _url:
+    _url = "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="tracelens-tests-"), "test.db")
+os.environ["DATABASE_URL"] = _url
+# Every request reaches the database, and no background job writes unless a test starts it
+os.environ["CACHE_BACKEND"] = "none"
+os.environ["ALERT_SCHEDULER_ENABLED"] = "false"
+os.environ["ALERT_STREAMING_ENABLED"] = "false"
+os.environ["INGEST_BUFFER_ENABLED"] = "false"
+os.environ["RETENTION_ENABLED"] = "false"
+os.environ["SKETCH_COMPACT_ENABLED"] = "false"
+os.environ["TRACE_PARTITIONING"] = ""
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import delete
+
+from app import blobs, migrations
+from app.database import Base, SessionLocal, dispose_engines, engine
+
+migrations.upgrade(engine)
+
+@pytest.fixture(autouse=True)
+def _empty_tables():
+    yield
+    with engine.begin() as conn:
+        for table in reversed(Base.metadata.sorted_tables):
+            conn.execute(delete(table))
+    blobs.text_cache.clear()
+
+@pytest.fixture
+def db():
+    with SessionLocal() as session:
+        yield session
+
+@pytest.fixture
+def client():
+    from app.main import app
+    with TestClient(app) as c:
+        yield c
+
+@pytest.fixture
+def run():
+    """asyncio.run for tests; pooled async connections belong to its loop, so they are closed with it."""
+    def run(coro):
+        async def main():
+            try:
+                return await coro
+            finally:
+                await dispose_engines()
+        return asyncio.run(main())
+    return run
@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select
+
+from app import alerting, events, scheduler
+from app.alerting import REQUESTS, ThresholdEngine
+from app.ingest import insert_trace_rows
+from app.models import Alert, AlertThreshold, SchedulerLease
+
+def _row(created_at, status="success", latency=100.0):
+    return {"model": "gpt-4o", "provider": "openai", "latency_ms": latency, "tokens": 10,
+            "cost_usd": 0.01, "status": status, "created_at": created_at}
+
+def _threshold(db, window="1m", metric_name="requests_per_minute", value=1e9):
+    threshold = AlertThreshold(metric_name=metric_name, threshold_value=value, severity="high", window=window)
+    db.add(threshold)
+    db.commit()
+    return threshold.id
+
+def _requests(engine, window):
+    groups = engine.windows[(alerting.WINDOWS[window], None)]
+    return sum(w.totals[REQUESTS] for w in groups.values())
+
+def test_traces_count_in_the_windows_of_their_created_at(db, run):
+    _threshold(db, "1m")
+    _threshold(db, "5m")
+    now = datetime.utcnow()
+
+    async def scenario():
+        engine = ThresholdEngine()
+        await engine.start()
+        try:
+            # One batch (as from a backfill or an OTLP export) spanning several minutes
+            rows = [_row(now - timedelta(seconds=10))] * 3 + [_row(now - timedelta(minutes=3))] * 2 \
+                + [_row(now - timedelta(minutes=30))]
+            engine._on_event(events.TRACES, events.trace_delta(rows))
+            return _requests(engine, "1m"), _requests(engine, "5m")
+        finally:
+            await engine.stop()
+
+    assert run(scenario()) == (3, 5)
+
+def test_events_published_while_loading_are_applied_after_the_replay(db, run, monkeypatch):
+    _threshold(db, "5m")
+    insert_trace_rows(db, [_row(datetime.utcnow() - timedelta(seconds=30))] * 2)
+    db.commit()
+
+    async def scenario():
+        engine = ThresholdEngine()
+        read = engine._read
+
+        def slow_read(cutoff):
+            # A commit lands while the windows are being rebuilt
+            events.bus.publish(events.TRACES, events.trace_delta([_row(datetime.utcnow() + timedelta(seconds=1))] * 4))
+            return read(cutoff)
+
+        monkeypatch.setattr(engine, "_read", slow_read)
+        await engine.start()
+        try:
+            await asyncio.sleep(0)
+            return _requests(engine, "5m"), engine._buffered
+        finally:
+            await engine.stop()
+
+    assert run(scenario()) == (6, None)
+
+def test_fire_uses_the_stored_threshold(db, run):
+    kept = _threshold(db, "1m", "error_rate_pct", 50.0)
+    removed = _threshold(db, "1m", "error_rate_pct", 50.0)
+
+    async def scenario():
+        engine = ThresholdEngine()
+        await engine.start()
+        try:
+            # Deleted without an event, after the engine loaded it
+            with alerting.SessionLocal() as other:
+                other.execute(delete(AlertThreshold).where(AlertThreshold.id == removed))
+                other.commit()
+            rows = [_row(datetime.utcnow(), status="failure")] * 5
+            engine._on_event(events.TRACES, events.trace_delta(rows))
+            await asyncio.gather(*list(engine._pending))
+            return dict(engine.firing)
+        finally:
+            await engine.stop()
+
+    firing = run(scenario())
+    alerts = db.execute(select(Alert.threshold_id, Alert.metric)).all()
+    assert alerts == [(kept, 100.0)]
+    assert list(firing) == [(kept, "")]
+
+def test_second_open_alert_for_a_group_is_treated_as_already_open(db):
+    threshold_id = _threshold(db, "1m", "error_rate_pct", 50.0)
+    threshold = alerting.load_thresholds(db)[0]
+    first = alerting.fire_alert(db, threshold, 80.0, "model=gpt-4o", check=False)
+    # As the scheduler does after its own check: the unique index still refuses a second one
+    assert alerting.fire_alert(db, threshold, 90.0, "model=gpt-4o", check=False) is None
+    other = alerting.fire_alert(db, threshold, 90.0, "model=claude", check=False)
+    db.commit()
+    assert alerting.open_alerts(db) == {(threshold_id, "model=gpt-4o"): first.id, (threshold_id, "model=claude"): other.id}
+    alerting.resolve_alert(db, first.id)
+    db.commit()
+    assert alerting.fire_alert(db, threshold, 95.0, "model=gpt-4o", check=False) is not None
+
+def test_scheduler_stop_waits_for_the_running_tick(db, run, monkeypatch):
+    started, finished = threading.Event(), []
+
+    def slow_tick():
+        started.set()
+        time.sleep(0.2)
+        finished.append(True)
+        return 0, 0
+
+    monkeypatch.setattr(scheduler, "run_once", slow_tick)
+    job = scheduler.AlertScheduler(enabled=True, interval_seconds=60)
+
+    async def scenario():
+        await job.start()
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        await job.stop()
+        return bool(finished)
+
+    assert run(scenario()) is True
+    db.expire_all()
+    lease = db.execute(select(SchedulerLease).where(SchedulerLease.name == scheduler.LEASE_NAME)).scalar_one()
+    assert lease.expires_at <= datetime.utcnow()
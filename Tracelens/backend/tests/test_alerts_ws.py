@@ -0,0 +1,78 @@
+import json
+
+import pytest
+from starlette.websockets import WebSocketDisconnect
+
+from app import events
+from app.routers import alerts
+
+ALERT = {"severity": "high", "title": "latency", "metric": 2.0, "threshold": 1.0,
+         "alert_type": "latency", "metric_name": "avg_latency_ms"}
+
+def _receive(ws):
+    return json.loads(ws.receive_text())
+
+def _sync(ws):
+    """Round-trip a client ping, so every message queued before it has been delivered."""
+    ws.send_text(json.dumps({"type": "ping"}))
+    messages = []
+    while True:
+        message = _receive(ws)
+        if message == {"type": "pong"}:
+            return messages
+        messages.append(message)
+
+def test_alert_is_fanned_out_to_every_subscriber(client):
+    with client.websocket_connect("/alerts/ws") as first, client.websocket_connect("/alerts/ws") as second:
+        _sync(first), _sync(second)
+        assert len(alerts.alert_manager.subscribers) == 2
+        created = client.post("/alerts", json=ALERT).json()
+        for ws in (first, second):
+            message = _receive(ws)
+            assert message["type"] == "new_alert"
+            assert message["data"]["id"] == created["id"]
+
+def test_rolled_back_alerts_are_not_broadcast(client, db):
+    with client.websocket_connect("/alerts/ws") as ws:
+        _sync(ws)
+        events.record(db, events.ALERTS, [{"title": "never committed"}])
+        db.rollback()
+        assert _sync(ws) == []
+
+def test_full_queue_drops_the_oldest_messages(client, monkeypatch):
+    monkeypatch.setattr(alerts, "WS_QUEUE_SIZE", 2)
+    with client.websocket_connect("/alerts/ws") as ws:
+        _sync(ws)
+        # One event offers all five messages before the sender task runs
+        events.bus.publish(events.ALERTS, [{"n": n} for n in range(5)])
+        assert _sync(ws) == [{"n": 3}, {"n": 4}]
+        subscriber, = alerts.alert_manager.subscribers.values()
+        assert subscriber.dropped == 3
+
+def test_full_queue_disconnects_in_disconnect_mode(client, monkeypatch):
+    monkeypatch.setattr(alerts, "WS_QUEUE_SIZE", 2)
+    monkeypatch.setattr(alerts, "WS_OVERFLOW", "disconnect")
+    with client.websocket_connect("/alerts/ws") as slow:
+        _sync(slow)
+        events.bus.publish(events.ALERTS, [{"n": n} for n in range(3)])
+        with pytest.raises(WebSocketDisconnect) as closed:
+            while True:
+                slow.receive_text()
+        assert closed.value.code == 1013
+    assert alerts.alert_manager.subscribers == {}
+    with client.websocket_connect("/alerts/ws") as ws:
+        events.bus.publish(events.ALERTS, [{"n": 0}])
+        assert _sync(ws) == [{"n": 0}]
+
+def test_keepalive_pings_and_drops_silent_clients(client, monkeypatch):
+    monkeypatch.setattr(alerts, "WS_PING_SECONDS", 0.05)
+    monkeypatch.setattr(alerts, "WS_PONG_TIMEOUT", 0.1)
+    with client.websocket_connect("/alerts/ws") as live, client.websocket_connect("/alerts/ws") as silent:
+        for _ in range(6):  # several ping intervals past the pong timeout
+            assert _receive(live) == {"type": "ping"}
+            live.send_text(json.dumps({"type": "pong"}))
+        with pytest.raises(WebSocketDisconnect) as closed:
+            while True:
+                assert _receive(silent) == {"type": "ping"}
+        assert closed.value.code == 1001
+        assert len(alerts.alert_manager.subscribers) == 1
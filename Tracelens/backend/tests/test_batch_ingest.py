@@ -0,0 +1,47 @@
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from app import rollups
+from app.models import AgentSession, LLMTrace, TraceRollupMinute
+from app.routers import traces as traces_router
+
+def _trace(**fields):
+    return dict({"model": "gpt-4o", "provider": "openai", "latency_ms": 100.0, "tokens": 10, "cost_usd": 0.5}, **fields)
+
+def _count(db) -> int:
+    return db.execute(select(func.count(LLMTrace.id))).scalar()
+
+def test_valid_items_are_written_and_invalid_ones_reported(client, db):
+    items = [_trace(), {"model": "gpt-4o"}, _trace(latency_ms=300.0), _trace(latency_ms="fast")]
+    result = client.post("/traces/batch", json=items).json()
+    assert (result["accepted"], result["rejected"]) == (2, 2)
+    assert [error["index"] for error in result["errors"]] == [1, 3]
+    ids = result["ids"]
+    assert ids[1] is None and ids[3] is None
+    latencies = dict(db.execute(select(LLMTrace.id, LLMTrace.latency_ms)).all())
+    assert (latencies[ids[0]], latencies[ids[2]]) == (100.0, 300.0)
+
+def test_batch_updates_rollups_and_session_totals(client, db):
+    session_id = client.post("/agents/sessions", json={"title": "s"}).json()["id"]
+    client.post("/traces/batch", json=[_trace(session_id=session_id) for _ in range(3)] + [_trace()])
+    db.expire_all()
+    # Traces add their cost to the session; tokens and latency come from spans
+    assert db.get(AgentSession, session_id).total_cost_usd == 1.5
+    if rollups.supported(db):
+        assert db.execute(select(func.sum(TraceRollupMinute.request_count))).scalar() == 4
+
+def test_oversized_batch_is_rejected_whole(client, db, monkeypatch):
+    monkeypatch.setattr(traces_router, "MAX_BATCH_ITEMS", 3)
+    response = client.post("/traces/batch", json=[_trace() for _ in range(4)])
+    assert response.status_code == 413
+    assert _count(db) == 0
+
+def test_database_error_rejects_the_batch(client, db, monkeypatch):
+    def failing(session, valid):
+        raise IntegrityError("INSERT INTO llm_traces ...", {}, Exception("constraint failed"))
+
+    monkeypatch.setattr(traces_router, "insert_traces", failing)
+    response = client.post("/traces/batch", json=[_trace(), _trace()])
+    assert response.status_code == 409
+    assert "constraint failed" in response.json()["detail"]
+    assert _count(db) == 0
@@ -0,0 +1,70 @@
+from datetime import datetime
+
+from sqlalchemy import func, select
+
+from app import blobs
+from app.ingest import insert_session_rows, insert_span_rows
+from app.models import AgentSpan, Blob
+
+NOW = datetime(2024, 3, 1, 12, 0, 0)
+PROMPT = "You are a careful assistant. Answer in one sentence. " * 10
+
+def _session(db):
+    session_id = insert_session_rows(db, [{"title": "s", "status": "running", "started_at": NOW}])[0]
+    db.commit()
+    return session_id
+
+def _span(session_id, **fields):
+    return dict({"session_id": session_id, "span_type": "llm", "name": "call", "status": "success",
+                 "latency_ms": 10.0, "created_at": NOW}, **fields)
+
+def test_encode_round_trip_and_codec_choice():
+    packed = blobs.encode(PROMPT)
+    assert packed["codec"] == "zlib" and len(packed["data"]) < packed["size"] == len(PROMPT)
+    assert blobs.decode(packed["codec"], packed["data"]) == PROMPT
+    # zlib would make a short text longer
+    short = blobs.encode("héllo")
+    assert short["codec"] == "raw" and blobs.decode("raw", short["data"]) == "héllo"
+    assert short["hash"] != packed["hash"]
+
+def test_large_payloads_are_stored_once_and_small_ones_stay_inline(db):
+    session_id = _session(db)
+    ids = insert_span_rows(db, [_span(session_id, prompt=PROMPT, output="ok") for _ in range(3)])
+    db.commit()
+    rows = db.execute(select(AgentSpan.prompt, AgentSpan.prompt_blob, AgentSpan.output, AgentSpan.output_blob)).all()
+    assert {row.prompt_blob for row in rows} == {blobs.encode(PROMPT)["hash"]}
+    assert all(row.prompt is None and row.output == "ok" and row.output_blob is None for row in rows)
+    assert db.execute(select(func.count()).select_from(Blob)).scalar() == 1
+
+    blobs.text_cache.clear()
+    spans = blobs.resolve_objects(db, db.execute(select(AgentSpan).where(AgentSpan.id.in_(ids))).scalars().all(),
+                                  blobs.SPAN_FIELDS)
+    assert [span.prompt for span in spans] == [PROMPT] * 3
+    assert not db.dirty
+    assert blobs.text_cache.get(blobs.encode(PROMPT)["hash"]) == PROMPT
+
+def test_api_returns_payloads_stored_in_blobs(client):
+    session_id = client.post("/agents/sessions", json={"title": "s"}).json()["id"]
+    span = client.post("/agents/spans", json={"session_id": session_id, "span_type": "llm", "name": "call",
+                                              "prompt": PROMPT, "metadata": {"system": PROMPT}}).json()
+    assert span["prompt"] == PROMPT
+    fetched = client.get(f"/agents/spans/{span['id']}").json()
+    assert fetched["prompt"] == PROMPT and fetched["metadata"] == {"system": PROMPT}
+    listed = client.get(f"/agents/sessions/{session_id}/spans").json()
+    assert [s["prompt"] for s in listed] == [PROMPT]
+
+def test_migrate_moves_inline_payloads_and_can_run_again(db):
+    session_id = _session(db)
+    db.add_all([AgentSpan(**_span(session_id, prompt=PROMPT)) for _ in range(3)])
+    db.add(AgentSpan(**_span(session_id, prompt="short")))
+    db.commit()
+    assert blobs.migrate(db, batch_size=2) == {"agent_spans": 3, "llm_traces": 0}
+    db.expire_all()
+    assert db.execute(select(func.count()).where(AgentSpan.prompt_blob.is_not(None))).scalar() == 3
+    assert db.execute(select(AgentSpan.prompt).where(AgentSpan.prompt_blob.is_(None))).scalar() == "short"
+    assert blobs.migrate(db) == {"agent_spans": 0, "llm_traces": 0}
+
+    report = blobs.report(db)
+    assert report["blobs"] == 1
+    assert report["logical_bytes"] == 3 * len(PROMPT) and report["dedup_ratio"] == 3.0
+    assert report["stored_bytes"] < report["unique_bytes"]
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+from app import cache
+from app.cache import MemoryBackend, ResultCache
+from app.ingest import insert_trace_rows, trace_row
+from app.schemas import LLMTraceCreate
+
+class Counter:
+    """A compute function returning how many times it has run."""
+
+    def __init__(self, delay: float = 0.0):
+        self.calls = 0
+        self.delay = delay
+        self._lock = threading.Lock()
+
+    def __call__(self, db):
+        time.sleep(self.delay)
+        with self._lock:
+            self.calls += 1
+            return self.calls
+
+@pytest.fixture
+def results(monkeypatch):
+    # Commits invalidate the module's cache, so tests swap in their own
+    results = ResultCache(MemoryBackend(max_entries=8))
+    monkeypatch.setattr(cache, "result_cache", results)
+    return results
+
+def test_hit_until_a_commit_touches_its_tag(db, results):
+    compute = Counter()
+    get = lambda: results.get_or_compute(db, "summary", {"hours": 1}, compute, [cache.TRACES], stale_ttl=0)
+    assert get() == 1 and get() == 1
+    assert results.get_or_compute(db, "summary", {"hours": 2}, compute, [cache.TRACES], stale_ttl=0) == 2
+
+    cache.touch(db, cache.SPANS)
+    db.commit()
+    assert get() == 1
+    cache.touch(db, cache.TRACES)
+    db.commit()
+    assert get() == 3
+    assert results.snapshot()["invalidations"] == 2
+
+def test_rolled_back_writes_do_not_invalidate(db, results):
+    compute = Counter()
+    results.get_or_compute(db, "summary", {}, compute, [cache.TRACES], stale_ttl=0)
+    insert_trace_rows(db, [trace_row(LLMTraceCreate(model="gpt-4o", provider="openai", latency_ms=1.0, tokens=1))])
+    cache.touch(db, cache.TRACES)
+    db.rollback()
+    db.commit()
+    assert results.get_or_compute(db, "summary", {}, compute, [cache.TRACES], stale_ttl=0) == 1
+
+def test_stale_entry_is_served_while_one_refresh_runs(db, results):
+    compute = Counter(delay=0.05)
+    results.get_or_compute(db, "summary", {}, compute, [cache.TRACES])
+    results.invalidate(cache.TRACES)
+    assert [results.get_or_compute(db, "summary", {}, compute, [cache.TRACES]) for _ in range(3)] == [1, 1, 1]
+    deadline = time.monotonic() + 5
+    while results.snapshot()["refreshes"] == 0 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert compute.calls == 2
+    assert results.get_or_compute(db, "summary", {}, compute, [cache.TRACES]) == 2
+
+def test_concurrent_misses_compute_once(db, results):
+    compute = Counter(delay=0.1)
+    values = []
+    threads = [
+        threading.Thread(target=lambda: values.append(results.get_or_compute(db, "summary", {}, compute, [cache.TRACES])))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert values == [1, 1, 1, 1]
+    assert compute.calls == 1
+
+def test_value_computed_across_an_invalidation_is_stored_stale(db, results):
+    def compute(session):
+        results.invalidate(cache.TRACES)
+        return "old"
+
+    assert results.get_or_compute(db, "summary", {}, compute, [cache.TRACES], stale_ttl=0) == "old"
+    assert results.get_or_compute(db, "summary", {}, lambda session: "new", [cache.TRACES], stale_ttl=0) == "new"
+
+def test_least_recently_used_entries_are_evicted(db, results):
+    for hours in range(10):
+        results.get_or_compute(db, "summary", {"hours": hours}, Counter(), [cache.TRACES])
+    snapshot = results.snapshot()
+    assert snapshot["entries"] == 8 and snapshot["evictions"] == 2
@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update
+
+from app import critical_path
+from app.models import AgentSession, AgentSpan
+
+T0 = datetime(2024, 3, 1, 12, 0, 0)
+
+def _span(span_id, start, end, parent_id=None, created_at=None, latency_ms=None):
+    at = lambda seconds: None if seconds is None else T0 + timedelta(seconds=seconds)
+    return {"id": span_id, "parent_id": parent_id, "started_at": at(start), "ended_at": at(end),
+            "created_at": created_at or at(start) or T0, "latency_ms": latency_ms}
+
+def test_self_time_subtracts_the_union_of_children():
+    self_times, critical = critical_path.compute([
+        _span(1, 0, 20),
+        _span(2, 2, 8, parent_id=1),
+        _span(3, 6, 12, parent_id=1),  # overlaps the previous child
+        _span(4, 15, 30, parent_id=1),  # clipped to the parent
+    ])
+    assert self_times == {1: 20000 - 10000 - 5000, 2: 6000, 3: 6000, 4: 15000}
+    # Walking back from 20s: the clipped last child, a gap the parent ran alone, then each child up to where the next took over
+    assert critical == {1: 3000 + 2000, 2: 4000, 3: 6000, 4: 5000}
+    assert sum(critical.values()) == 20000
+
+def test_children_without_started_at_sort_by_created_at():
+    # The second child reported no started_at; it ran from its created_at for latency_ms.
+    # A database ordering by started_at puts it last (PostgreSQL sorts NULL last).
+    rows = [
+        _span(1, 0, 20),
+        _span(2, 5, 10, parent_id=1),
+        _span(3, None, None, parent_id=1, created_at=T0, latency_ms=10000),
+    ]
+    self_times, _ = critical_path.compute(rows)
+    assert self_times[1] == 10000
+
+def test_critical_path_follows_the_last_finishing_chain():
+    _, critical = critical_path.compute([
+        _span(1, 0, 10),
+        _span(2, 0, 4, parent_id=1),
+        _span(3, 1, 9, parent_id=1),
+        _span(4, 2, 3, parent_id=3),
+    ])
+    # 9..10 the root itself, 1..9 the third span (2..3 of it its own child), 0..1 the second span
+    assert critical == {1: 1000, 3: 7000, 4: 1000, 2: 1000}
+    assert sum(critical.values()) == 10000
+
+def _session_with_spans(client, status="running"):
+    session = client.post("/agents/sessions", json={"title": "cp", "status": status}).json()
+    root = client.post("/agents/spans", json={
+        "session_id": session["id"], "span_type": "agent", "name": "root",
+        "started_at": T0.isoformat(), "ended_at": (T0 + timedelta(seconds=10)).isoformat(),
+    }).json()
+    client.post("/agents/spans", json={
+        "session_id": session["id"], "parent_id": root["id"], "span_type": "tool", "name": "tool",
+        "started_at": (T0 + timedelta(seconds=2)).isoformat(), "ended_at": (T0 + timedelta(seconds=6)).isoformat(),
+    })
+    return session, root
+
+def test_finishing_a_session_stores_its_path_and_late_spans_update_it(client, db):
+    session, root = _session_with_spans(client)
+    assert client.get(f"/agents/sessions/{session['id']}/critical-path").json()["materialized"] is False
+
+    client.put(f"/agents/sessions/{session['id']}", json={"title": "cp", "status": "completed"})
+    stored = db.get(AgentSession, session["id"])
+    assert stored.critical_path_ms == 10000
+    # A late span extending the root's child chain is folded in by the write, not by the next read
+    client.post("/agents/spans", json={
+        "session_id": session["id"], "parent_id": root["id"], "span_type": "tool", "name": "late",
+        "started_at": (T0 + timedelta(seconds=1)).isoformat(), "ended_at": (T0 + timedelta(seconds=9)).isoformat(),
+    })
+    db.expire_all()
+    spans = {s.name: s.self_time_ms for s in db.execute(select(AgentSpan).where(AgentSpan.session_id == session["id"])).scalars()}
+    assert spans["root"] == 2000
+    body = client.get(f"/agents/sessions/{session['id']}/critical-path").json()
+    assert body["materialized"] is True
+    assert [s["span_name"] for s in body["spans"]] == ["root", "late"]
+
+def test_reads_compute_missing_paths_without_writing(client, db):
+    session, _ = _session_with_spans(client, status="completed")
+    db.execute(update(AgentSession).where(AgentSession.id == session["id"]).values(critical_path_ms=None))
+    db.commit()
+    body = client.get(f"/agents/sessions/{session['id']}/critical-path").json()
+    assert body["materialized"] is False
+    assert body["critical_path_ms"] == 10000
+    analysis = client.get(f"/agents/sessions/{session['id']}/analysis").json()
+    assert analysis["critical_path"]["total_ms"] == 10000
+    assert analysis["critical_path"]["top_spans"][0]["span_name"] == "root"
+    db.expire_all()
+    assert db.get(AgentSession, session["id"]).critical_path_ms is None
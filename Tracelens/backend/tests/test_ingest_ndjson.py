@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+import pytest
+from sqlalchemy import func, select
+
+from app.models import AgentSession, AgentSpan, LLMTrace
+from app.routers import ingest as ndjson
+
+def _trace(**fields):
+    return dict({"type": "trace", "model": "gpt-4o", "provider": "openai", "latency_ms": 100.0, "tokens": 10}, **fields)
+
+def _body(*records) -> bytes:
+    return b"".join(json.dumps(record).encode() + b"\n" for record in records)
+
+def _count(db, model) -> int:
+    return db.execute(select(func.count()).select_from(model)).scalar()
+
+def test_mixed_records_with_historical_timestamps(client, db):
+    session_id = client.post("/agents/sessions", json={"title": "backfill"}).json()["id"]
+    body = _body(
+        {"type": "session", "title": "old", "started_at": "2024-01-01T00:00:00", "ended_at": "2024-01-01T00:05:00"},
+        {"type": "span", "session_id": session_id, "span_type": "agent", "name": "Root", "created_at": "2024-01-01T00:00:01"},
+        _trace(session_id=session_id, created_at="2024-01-01T00:00:02"),
+    )
+    result = client.post("/ingest/ndjson", content=body).json()
+    assert result["accepted"] == {"session": 1, "span": 1, "trace": 1}
+    assert result["rejected"] == 0 and result["lines"] == 3
+    old = db.execute(select(AgentSession).where(AgentSession.title == "old")).scalar_one()
+    assert str(old.started_at) == "2024-01-01 00:00:00" and str(old.ended_at) == "2024-01-01 00:05:00"
+    assert str(db.execute(select(LLMTrace.created_at)).scalar()) == "2024-01-01 00:00:02"
+
+def test_invalid_lines_are_reported_and_skipped(client, db):
+    body = _body(_trace(), {"type": "trace", "model": "gpt-4o"}, {"type": "bogus"}) + b"not json\n\n" + _body(_trace())
+    result = client.post("/ingest/ndjson", content=body).json()
+    assert result["accepted"]["trace"] == 2
+    assert result["rejected"] == 3
+    assert [error["line"] for error in result["errors"]] == [2, 3, 4]
+    assert result["lines"] == 6
+    assert _count(db, LLMTrace) == 2
+
+def test_default_type_for_lines_without_one(client, db):
+    record = {"model": "gpt-4o", "provider": "openai", "latency_ms": 1.0, "tokens": 1}
+    result = client.post("/ingest/ndjson?type=trace", content=_body(record, record)).json()
+    assert result["accepted"]["trace"] == 2
+
+def test_rows_are_written_in_chunks(client, db, monkeypatch):
+    monkeypatch.setattr(ndjson, "CHUNK_ROWS", 3)
+    result = client.post("/ingest/ndjson", content=_body(*(_trace(latency_ms=float(i)) for i in range(10)))).json()
+    assert result["accepted"]["trace"] == 10
+    assert _count(db, LLMTrace) == 10
+
+@pytest.mark.parametrize("chunked", [False, True])
+def test_over_long_lines_are_rejected(client, db, monkeypatch, chunked):
+    monkeypatch.setattr(ndjson, "MAX_LINE_BYTES", 200)
+    long_line = json.dumps(_trace(error_message="x" * 500)).encode() + b"\n"
+    body = _body(_trace()) + long_line + _body(_trace())
+    # One request chunk holding the whole body, or 7-byte chunks so the long line spans many of them
+    content = [body[i:i + 7] for i in range(0, len(body), 7)] if chunked else body
+    result = client.post("/ingest/ndjson", content=iter(content) if chunked else content).json()
+    assert result["accepted"]["trace"] == 2
+    assert result["errors"] == [{"line": 2, "error": "line exceeds 200 bytes"}]
+    assert result["lines"] == 3
+
+def test_line_splitter_keeps_lines_across_chunks():
+    lines = ndjson._LineSplitter(10)
+    out = lines.feed(b"ab") + lines.feed(b"c\nde") + lines.feed(b"f\n0123456789x") + lines.feed(b"yz\nlast")
+    assert out == [b"abc", b"def", None]
+    assert lines.close() == [b"last"]
+
+def test_chunks_are_written_off_the_event_loop(client, db, monkeypatch):
+    loops = []
+    schema, build_row, insert_rows, ts_field = ndjson.RECORD_TYPES["trace"]
+
+    def recording(session, rows):
+        try:
+            loops.append(asyncio.get_running_loop())
+        except RuntimeError:
+            loops.append(None)
+        return insert_rows(session, rows)
+
+    monkeypatch.setitem(ndjson.RECORD_TYPES, "trace", (schema, build_row, recording, ts_field))
+    monkeypatch.setattr(ndjson, "CHUNK_ROWS", 2)
+    result = client.post("/ingest/ndjson", content=_body(*(_trace() for _ in range(5)))).json()
+    assert result["accepted"]["trace"] == 5
+    assert loops == [None] * 3
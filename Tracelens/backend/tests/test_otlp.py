@@ -0,0 +1,130 @@
+import base64
+import gzip
+import json
+
+import pytest
+from sqlalchemy import select
+
+from app.models import AgentSession, AgentSpan, LLMTrace
+
+TRACE_ID = "5b8efff798038103d269b633813fc60c"
+START = 1_709_294_400_000_000_000  # 2024-03-01T12:00:00Z in nanoseconds
+
+def _attrs(**values):
+    kinds = {str: "stringValue", int: "intValue", float: "doubleValue", bool: "boolValue"}
+    return [{"key": key.replace("__", "."), "value": {kinds[type(value)]: value}} for key, value in values.items()]
+
+def _span(span_id, name, parent=None, start_ms=0, end_ms=1000, status=None, **attrs):
+    span = {
+        "traceId": TRACE_ID, "spanId": span_id, "name": name,
+        "startTimeUnixNano": str(START + start_ms * 1_000_000), "endTimeUnixNano": str(START + end_ms * 1_000_000),
+        "attributes": _attrs(**attrs),
+    }
+    if parent:
+        span["parentSpanId"] = parent
+    if status:
+        span["status"] = status
+    return span
+
+def _export(*spans):
+    return {"resourceSpans": [{
+        "resource": {"attributes": _attrs(service__name="support-bot")},
+        "scopeSpans": [{"spans": list(spans)}],
+    }]}
+
+def _post(client, body, **headers):
+    return client.post("/v1/traces", content=json.dumps(body).encode(),
+                       headers=dict({"content-type": "application/json"}, **headers))
+
+CHAT = dict(gen_ai__operation__name="chat", gen_ai__provider__name="openai", gen_ai__request__model="gpt-4o",
+            gen_ai__usage__input_tokens=120, gen_ai__usage__output_tokens=30, enduser__id="u-1")
+
+def test_export_becomes_a_session_of_linked_spans_and_llm_traces(client, db):
+    # The child arrives before its parent
+    body = _export(
+        _span("00000000000000b1", "chat gpt-4o", parent="00000000000000a1", start_ms=100, end_ms=600, **CHAT),
+        _span("00000000000000a1", "answer ticket", gen_ai__operation__name="invoke_agent"),
+    )
+    response = _post(client, body)
+    assert response.status_code == 200 and response.json() == {}
+
+    session = db.execute(select(AgentSession)).scalar_one()
+    assert (session.title, session.status, session.user_id) == ("answer ticket", "completed", "u-1")
+    spans = {span.name: span for span in db.execute(select(AgentSpan)).scalars()}
+    root, chat = spans["answer ticket"], spans["chat gpt-4o"]
+    assert (root.span_type, chat.span_type) == ("agent", "llm_call")
+    assert chat.parent_id == root.id and root.parent_id is None
+    assert chat.latency_ms == 500.0 and chat.tokens_used == 150
+    trace = db.execute(select(LLMTrace)).scalar_one()
+    assert (trace.model, trace.provider, trace.tokens, trace.input_tokens) == ("gpt-4o", "openai", 150, 120)
+    assert (trace.session_id, trace.span_id) == (session.id, chat.id)
+
+def test_later_exports_join_the_trace_session_and_parents(client, db):
+    _post(client, _export(_span("00000000000000a1", "root")))
+    _post(client, _export(_span("00000000000000c1", "lookup", parent="00000000000000a1",
+                                gen_ai__operation__name="execute_tool", gen_ai__tool__name="search")))
+    db.expire_all()
+    assert len(db.execute(select(AgentSession)).scalars().all()) == 1
+    spans = {span.name: span for span in db.execute(select(AgentSpan)).scalars()}
+    assert spans["lookup"].parent_id == spans["root"].id
+    assert spans["lookup"].session_id == spans["root"].session_id
+    assert spans["lookup"].tool_calls == {"tool_name": "search", "call_id": None}
+
+def test_root_exported_after_its_children_links_them_and_finishes_the_session(client, db):
+    _post(client, _export(_span("00000000000000b1", "chat gpt-4o", parent="00000000000000a1",
+                                start_ms=100, end_ms=600, **CHAT)))
+    session = db.execute(select(AgentSession)).scalar_one()
+    assert (session.title, session.status, session.ended_at) == ("support-bot", "running", None)
+
+    _post(client, _export(_span("00000000000000a1", "answer ticket", gen_ai__operation__name="invoke_agent")))
+    db.expire_all()
+    session = db.execute(select(AgentSession)).scalar_one()
+    assert (session.title, session.status) == ("answer ticket", "completed")
+    assert session.ended_at is not None and session.critical_path_ms == 1000.0
+    spans = {span.name: span for span in db.execute(select(AgentSpan)).scalars()}
+    assert spans["chat gpt-4o"].parent_id == spans["answer ticket"].id
+    assert spans["answer ticket"].session_id == session.id
+
+def test_prompt_payloads_are_not_copied_into_metadata(client, db):
+    messages = json.dumps([{"role": "user", "content": "x" * 20_000}])
+    _post(client, _export(_span("00000000000000a1", "chat gpt-4o", gen_ai__input__messages=messages,
+                                gen_ai__output__messages="answer", **CHAT)))
+    span = db.execute(select(AgentSpan)).scalar_one()
+    assert len(json.dumps(span.metadata_)) < 1000
+    assert not {"gen_ai.input.messages", "gen_ai.output.messages"} & span.metadata_["attributes"].keys()
+    body = client.get(f"/agents/spans/{span.id}").json()
+    assert (body["prompt"], body["output"]) == (messages, "answer")
+
+def test_failed_spans_and_rejections(client, db):
+    failed = _span("00000000000000a1", "root", status={"code": 2, "message": "timeout"})
+    invalid = {"traceId": TRACE_ID, "name": "no span id", "startTimeUnixNano": str(START)}
+    response = _post(client, _export(failed, invalid))
+    assert response.json()["partialSuccess"]["rejectedSpans"] == 1
+    span = db.execute(select(AgentSpan)).scalar_one()
+    assert (span.status, span.error) == ("failure", "timeout")
+    assert db.execute(select(AgentSession.status)).scalar() == "failed"
+
+def test_gzip_and_malformed_bodies(client, db):
+    body = gzip.compress(json.dumps(_export(_span("00000000000000a1", "root"))).encode())
+    response = client.post("/v1/traces", content=body,
+                           headers={"content-type": "application/json", "content-encoding": "gzip"})
+    assert response.status_code == 200
+    assert db.execute(select(AgentSpan.name)).scalar() == "root"
+    assert client.post("/v1/traces", content=b"{not json", headers={"content-type": "application/json"}).status_code == 400
+    assert client.post("/v1/traces", content=b"\x00\x01", headers={"content-type": "application/json",
+                                                                      "content-encoding": "gzip"}).status_code == 400
+
+def test_protobuf_export(client, db):
+    trace_service = pytest.importorskip("opentelemetry.proto.collector.trace.v1.trace_service_pb2")
+    from google.protobuf.json_format import ParseDict
+
+    message = _export(_span("00000000000000a1", "root"))
+    for span in message["resourceSpans"][0]["scopeSpans"][0]["spans"]:
+        # The protobuf JSON mapping carries bytes as base64
+        for key in ("traceId", "spanId"):
+            span[key] = base64.b64encode(bytes.fromhex(span[key])).decode()
+    request = ParseDict(message, trace_service.ExportTraceServiceRequest())
+    response = client.post("/v1/traces", content=request.SerializeToString(),
+                           headers={"content-type": "application/x-protobuf"})
+    assert response.status_code == 200 and response.headers["content-type"] == "application/x-protobuf"
+    assert db.execute(select(AgentSpan.trace_id)).scalar() == TRACE_ID
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+
+from app.ingest import insert_trace_rows
+from app.pagination import NEXT_CURSOR_HEADER, decode_cursor, encode_cursor
+
+NOW = datetime(2024, 3, 1, 12, 0, 0)
+
+def _traces(db, count, start=NOW, model="gpt-4o"):
+    # Pairs share a timestamp, so pages have to break ties by id
+    rows = [{"model": model, "provider": "openai", "latency_ms": 1.0, "tokens": 1,
+             "created_at": start + timedelta(seconds=i // 2)} for i in range(count)]
+    ids = insert_trace_rows(db, rows)
+    db.commit()
+    return ids
+
+def _pages(client, params):
+    pages, cursor = [], None
+    while True:
+        response = client.get("/traces", params=dict(params, **({"cursor": cursor} if cursor else {})))
+        pages.append([trace["id"] for trace in response.json()])
+        cursor = response.headers.get(NEXT_CURSOR_HEADER)
+        if cursor is None:
+            return pages
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(NOW, 42)) == (NOW, 42)
+
+def test_pages_are_newest_first_without_gaps_or_repeats(client, db):
+    ids = _traces(db, 7)
+    pages = _pages(client, {"limit": 3})
+    assert [len(page) for page in pages] == [3, 3, 1]
+    assert sum(pages, []) == sorted(ids, key=lambda i: (ids.index(i) // 2, i), reverse=True)
+
+def test_rows_inserted_while_paging_do_not_shift_later_pages(client, db):
+    _traces(db, 6)
+    first = client.get("/traces", params={"limit": 2})
+    _traces(db, 4, start=NOW + timedelta(hours=1))
+    rest = client.get("/traces", params={"limit": 10, "cursor": first.headers[NEXT_CURSOR_HEADER]}).json()
+    ids = [trace["id"] for trace in first.json()] + [trace["id"] for trace in rest]
+    assert len(ids) == len(set(ids)) == 6
+
+def test_filters_apply_to_every_page(client, db):
+    _traces(db, 3, model="a")
+    wanted = _traces(db, 3, model="b")
+    assert sorted(sum(_pages(client, {"limit": 2, "model": "b"}), [])) == sorted(wanted)
+
+def test_offset_and_invalid_cursor(client, db):
+    ids = _traces(db, 4)
+    newest_first = [trace["id"] for trace in client.get("/traces").json()]
+    assert [trace["id"] for trace in client.get("/traces", params={"offset": 1, "limit": 2}).json()] == newest_first[1:3]
+    assert sorted(newest_first) == sorted(ids)
+    assert client.get("/traces", params={"cursor": "not-a-cursor"}).status_code == 400
@@ -0,0 +1,93 @@
+import asyncio
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import func, select
+
+from app import partitions, retention
+from app.database import ReadSessionLocal
+from app.ingest import insert_session_rows, insert_trace_rows
+from app.models import LLMTrace, SchedulerLease
+
+NOW = datetime.utcnow().replace(microsecond=0)
+
+@pytest.fixture
+def daily(monkeypatch):
+    monkeypatch.setattr(partitions, "PERIOD", "day")
+
+def _trace(created_at, session_id=None):
+    return {"model": "gpt-4o", "provider": "openai", "latency_ms": 50.0, "tokens": 5, "cost_usd": 0.1,
+            "status": "success", "session_id": session_id, "created_at": created_at}
+
+def _archived(db, session_id=None, days=5, count=3):
+    """Traces `days` old moved into their partition file, plus one recent trace left in the main table."""
+    rows = [_trace(NOW - timedelta(days=days, minutes=i), session_id) for i in range(count)]
+    insert_trace_rows(db, rows + [_trace(NOW, session_id)])
+    db.commit()
+    moved = partitions.archive(db, NOW)
+    db.expire_all()
+    return moved
+
+def test_session_analysis_pages_over_archived_traces(client, db, daily):
+    session_id = insert_session_rows(db, [{"title": "s", "status": "completed", "started_at": NOW - timedelta(days=6)}])[0]
+    db.commit()
+    assert sum(_archived(db, session_id).values()) == 3
+
+    first = client.get(f"/agents/sessions/{session_id}/analysis", params={"limit": 3})
+    assert first.json()["token_analysis"]["llm_calls"] == 4
+    rest = client.get(f"/agents/sessions/{session_id}/analysis",
+                      params={"limit": 3, "cursor": first.headers["X-Next-Cursor"]})
+    ids = [t["id"] for t in first.json()["llm_traces"] + rest.json()["llm_traces"]]
+    assert len(set(ids)) == 4
+    assert "X-Next-Cursor" not in rest.headers
+
+def test_closed_periods_move_into_files_and_stay_readable(db, daily):
+    moved = _archived(db, days=5)
+    assert sum(moved.values()) == 3
+    assert db.execute(select(func.count()).select_from(LLMTrace)).scalar() == 1
+    assert db.execute(select(func.count()).select_from(partitions.all_traces(db))).scalar() == 4
+    (partition,) = partitions.catalog(db)
+    assert partition.range_start <= NOW - timedelta(days=5) < partition.range_end
+    with ReadSessionLocal() as read:
+        assert read.execute(select(func.count()).select_from(LLMTrace)).scalar() == 4
+        # The read connection's view already covers the files
+        assert partitions.all_traces(read) is LLMTrace.__table__
+        assert read.execute(select(func.count()).select_from(partitions.all_traces(read))).scalar() == 4
+    # Nothing left to move
+    assert partitions.archive(db, NOW) == {}
+
+def test_retention_drops_expired_partitions_whole(db, daily):
+    _archived(db, days=retention.POLICIES[1].days + 5)
+    path = partitions.catalog(db)[0].path
+    report = retention.run(db, now=NOW)
+    assert report["tables"]["llm_traces"]["rows"] == 3
+    assert partitions.catalog(db) == []
+    assert not os.path.exists(path)
+    assert db.execute(select(func.count()).select_from(partitions.all_traces(db))).scalar() == 1
+
+def test_stop_waits_for_the_running_maintenance(db, run, monkeypatch):
+    started, finished = threading.Event(), []
+
+    def slow_maintenance():
+        started.set()
+        time.sleep(0.2)
+        finished.append(True)
+        return {}
+
+    monkeypatch.setattr(partitions, "run_once", slow_maintenance)
+    job = partitions.PartitionJob(enabled=True, interval_seconds=60)
+
+    async def scenario():
+        await job.start()
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        await job.stop()
+        return bool(finished)
+
+    assert run(scenario()) is True
+    db.expire_all()
+    lease = db.execute(select(SchedulerLease).where(SchedulerLease.name == partitions.LEASE_NAME)).scalar_one()
+    assert lease.expires_at <= datetime.utcnow()
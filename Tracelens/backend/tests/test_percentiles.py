@@ -0,0 +1,66 @@
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import event, insert
+
+from app import percentiles
+from app.database import engine
+from app.models import LLMTrace
+from app.routers.metrics import compute_summary
+
+def _percentile_cont(values, q):
+    values = sorted(values)
+    rank = q * (len(values) - 1)
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (rank - lower) * (values[upper] - values[lower])
+
+def _store(db, latencies):
+    if latencies:
+        db.execute(insert(LLMTrace), [{"model": "m", "provider": "p", "latency_ms": v, "tokens": 1} for v in latencies])
+    db.commit()
+
+@pytest.mark.parametrize("n", [1, 2, 3, 20, 997])
+def test_matches_percentile_cont(db, n):
+    latencies = [round(random.uniform(1, 5000), 3) for _ in range(n)]
+    _store(db, latencies)
+    quantiles = (0.0, 0.5, 0.95, 0.99, 1.0)
+    result = percentiles.ordered_percentiles(db, LLMTrace.latency_ms, [], n, quantiles)
+    assert result == pytest.approx([_percentile_cont(latencies, q) for q in quantiles])
+
+def test_filters_apply(db):
+    _store(db, [10.0, 20.0, 30.0, 1000.0])
+    result = percentiles.ordered_percentiles(db, LLMTrace.latency_ms, [LLMTrace.latency_ms < 100], 3, (0.5,))
+    assert result == [20.0]
+
+def test_no_rows(db):
+    assert percentiles.ordered_percentiles(db, LLMTrace.latency_ms, [], 0, (0.95, 0.99)) == [None, None]
+
+def test_one_query_for_all_quantiles(db):
+    _store(db, [float(i) for i in range(100)])
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        percentiles.ordered_percentiles(db, LLMTrace.latency_ms, [], 100, (0.5, 0.95, 0.99))
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    assert len(statements) == 1
+
+def test_summary_percentiles_skip_traces_without_latency(db):
+    now = datetime.utcnow().replace(second=30, microsecond=0)
+    latencies = [float(i) for i in range(1, 21)]
+    rows = [{"model": "m", "provider": "p", "latency_ms": v, "tokens": 1, "created_at": now} for v in latencies]
+    db.execute(insert(LLMTrace), rows + [{"model": "m", "provider": "p", "latency_ms": None, "tokens": 1,
+                                          "created_at": now} for _ in range(20)])
+    db.commit()
+
+    # An unaligned window is aggregated from the traces themselves
+    summary = compute_summary(db, since=now - timedelta(seconds=1), until=now + timedelta(seconds=1))
+    assert summary.total_requests == 40
+    assert summary.p95_latency_ms == pytest.approx(_percentile_cont(latencies, 0.95))
+    assert summary.p99_latency_ms == pytest.approx(_percentile_cont(latencies, 0.99))
@@ -0,0 +1,153 @@
+""" Query-plan regression tests for the read endpoints.
+
+Each test seeds a few rows through the API, issues one request, captures every
+SELECT the app runs for it and EXPLAINs that statement on the test database.
+A plan that reads a table with a full scan rather than through an index fails
+the test, unless the table is listed in FULL_SCAN_OK; on SQLite, a scan of a
+whole index does too, unless the index is listed in INDEX_SCAN_OK.
+
+On PostgreSQL (TEST_DATABASE_URL=postgresql+psycopg://...) sequential scans
+are disabled for the EXPLAIN session, so a Seq Scan in the plan means no
+usable index exists whatever the table size.
+"""
+import re
+from typing import Any, Dict, List, Tuple
+
+import pytest
+from sqlalchemy import event
+
+from app.database import Base, async_engine, async_read_engine, engine, read_engine
+
+# "{session_id}" and "{root_span_id}" are filled in from the seeded rows
+CHECKS = [
+    "/metrics/summary",
+    "/metrics/summary?since={since}&until={until}",
+    "/metrics/timeseries?metric_name=latency_ms&hours=6",
+    "/metrics/timeseries?metric_name=latency_ms&aggregation=p95&hours=6&step=90s",
+    "/metrics/models/summary",
+    "/traces?limit=1",
+    "/traces?limit=1&status=failure",
+    "/traces?limit=1&model=gpt-4o&provider=openai",
+    "/agents/sessions?limit=1",
+    "/agents/sessions?limit=1&status=running",
+    "/agents/sessions/summary",
+    "/agents/sessions/{session_id}",
+    "/agents/sessions/{session_id}/spans",
+    "/agents/sessions/{session_id}/spans/tree",
+    "/agents/sessions/{session_id}/spans/tree?max_depth=1&fields=summary",
+    "/agents/spans/{root_span_id}/subtree?max_depth=2",
+    "/agents/sessions/{session_id}/analysis",
+    "/agents/sessions/{session_id}/analysis?top=1&limit=1",
+    "/agents/sessions/{session_id}/critical-path",
+    "/agents/sessions/{session_id}/trace",
+    "/alerts?limit=1",
+    "/alerts?limit=1&severity=high",
+    "/alerts/summary",
+    "/alerts/thresholds",
+]
+
+# Tables that may be read in full, and why
+FULL_SCAN_OK = {
+    "alert_thresholds": "a handful of rules, always read whole",
+    "latency_sketch_deltas": "all-time percentiles read every delta not compacted yet, a few minutes' worth",
+    "llm_trace_rollups_hour": "the all-time models summary aggregates every hourly rollup row",
+    "llm_trace_rollups_minute": "the all-time summary aggregates rollups outside the recent window",
+}
+
+# Indexes that may be walked from one end, and why
+INDEX_SCAN_OK = {
+    # A single-column index ends in the rowid too, so SQLite may walk it or the keyset one
+    **dict.fromkeys(
+        ("ix_llm_traces_created_at", "ix_llm_traces_created_at_id", "ix_agent_sessions_started_at",
+         "ix_agent_sessions_started_at_id", "ix_alerts_created_at", "ix_alerts_created_at_id"),
+        "first page of a listing: newest first, stops after LIMIT rows",
+    ),
+    "ix_alerts_severity_acknowledged": "the alerts summary counts every alert by severity without reading the table",
+}
+
+_SQLITE_FULL_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)(?:\s|$)")
+_SQLITE_SCAN_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+def _seed(client) -> Dict[str, Any]:
+    session = client.post("/agents/sessions", json={"title": "query plans", "user_id": "plans"}).json()
+    span = client.post("/agents/spans", json={"session_id": session["id"], "span_type": "agent", "name": "Root"}).json()
+    client.post("/agents/spans", json={"session_id": session["id"], "parent_id": span["id"], "span_type": "tool", "name": "Tool"})
+    for status in ("success", "failure", "success"):
+        client.post("/traces", json={
+            "model": "gpt-4o", "provider": "openai", "latency_ms": 120.0, "tokens": 50,
+            "status": status, "session_id": session["id"],
+        })
+    client.post("/alerts", json={"severity": "high", "title": "plans", "metric": 1.0, "threshold": 0.5,
+                                 "alert_type": "latency", "metric_name": "avg_latency_ms"})
+    return {"session_id": session["id"], "root_span_id": span["id"], "since": "2020-01-01T00:00:00", "until": "2100-01-01T00:00:00"}
+
+def _explain(statement: str, parameters) -> Tuple[List[str], List[str]]:
+    """(plan lines, tables read with a full scan) for one captured statement."""
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        if engine.dialect.name == "postgresql":
+            cursor.execute("SET enable_seqscan = off")
+            cursor.execute("EXPLAIN (FORMAT JSON) " + statement, parameters)
+            plan = cursor.fetchone()[0][0]["Plan"]
+            lines, scans = [], []
+            stack = [(plan, 0)]
+            while stack:
+                node, depth = stack.pop()
+                relation = node.get("Relation Name")
+                index = node.get("Index Name")
+                lines.append("  " * depth + node["Node Type"] + (f" on {relation}" if relation else "")
+                             + (f" using {index}" if index else ""))
+                if node["Node Type"] == "Seq Scan":
+                    scans.append(relation)
+                stack.extend((child, depth + 1) for child in reversed(node.get("Plans", [])))
+            return lines, scans
+        cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+        lines = [row[3] for row in cursor.fetchall()]
+        scans = []
+        for line in lines:
+            scan, index = _SQLITE_FULL_SCAN.match(line), _SQLITE_SCAN_INDEX.search(line)
+            if scan and not (index and index.group(1) in INDEX_SCAN_OK):
+                scans.append(scan.group(1))
+        return lines, scans
+    finally:
+        raw.rollback()
+        raw.close()
+
+@pytest.fixture
+def captured():
+    """SELECT statements run on any engine while the test holds the list."""
+    statements: List[Tuple[str, Any]] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(("SELECT", "WITH")):
+            statements.append((statement, parameters))
+
+    # Routes query through the async engines; EXPLAIN runs on the sync one
+    targets = {engine, read_engine, async_engine.sync_engine, async_read_engine.sync_engine}
+    for target in targets:
+        event.listen(target, "before_cursor_execute", capture)
+    yield statements
+    for target in targets:
+        event.remove(target, "before_cursor_execute", capture)
+
+@pytest.mark.parametrize("path", CHECKS)
+def test_endpoint_uses_indexed_plans(client, captured, path):
+    url = path.format(**_seed(client))
+    captured.clear()
+    response = client.get(url)
+    assert response.status_code == 200, response.text
+    # Follow the cursor of paginated listings as well
+    next_cursor = response.headers.get("x-next-cursor")
+    if next_cursor:
+        assert client.get(url, params={"cursor": next_cursor}).status_code == 200
+    assert captured, "no queries captured"
+
+    bad = []
+    for statement, parameters in list(captured):
+        lines, scans = _explain(statement, parameters)
+        # CTEs and subqueries show up as scans too; only tables count
+        scans = [table for table in scans if table in Base.metadata.tables and table not in FULL_SCAN_OK]
+        if scans:
+            bad.append(f"full scan of {', '.join(scans)}: {' '.join(statement.split())}\n    " + "\n    ".join(lines))
+    assert not bad, "\n".join(bad)
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select, update
+
+from app import blobs, retention
+from app.ingest import insert_trace_rows
+from app.models import Blob, LLMTrace, SchedulerLease
+
+NOW = datetime(2024, 3, 1, 12, 0, 0)
+PAYLOAD = {"prompt": "You are a helpful assistant. " * 40}
+
+def _trace(created_at, metadata=None):
+    return {"model": "gpt-4o", "provider": "openai", "latency_ms": 50.0, "tokens": 5, "cost_usd": 0.1,
+            "status": "success", "metadata": metadata, "created_at": created_at}
+
+def _count(db, model) -> int:
+    db.expire_all()
+    return db.execute(select(func.count()).select_from(model)).scalar()
+
+def _age_blobs(db, seconds):
+    db.execute(update(Blob).values(used_at=datetime.utcnow() - timedelta(seconds=seconds)))
+    db.commit()
+
+def test_expired_rows_are_deleted_in_chunks(db):
+    insert_trace_rows(db, [_trace(NOW - timedelta(days=30)) for _ in range(5)] + [_trace(NOW)])
+    db.commit()
+    report = retention.run(db, now=NOW, chunk_size=2)
+    assert report["tables"]["llm_traces"]["rows"] == 5
+    assert _count(db, LLMTrace) == 1
+
+def test_unreferenced_blob_is_deleted_with_its_last_row(db):
+    insert_trace_rows(db, [_trace(NOW - timedelta(days=30), PAYLOAD)])
+    db.commit()
+    _age_blobs(db, blobs.REUSE_GRACE_SECONDS + 60)
+    report = retention.run(db, now=NOW)
+    assert report["blobs"]["rows"] == 1
+    assert _count(db, Blob) == 0
+
+def test_recently_used_blob_is_spared_then_swept(db):
+    # A writer reused the payload while retention removed its last reference
+    insert_trace_rows(db, [_trace(NOW - timedelta(days=30), PAYLOAD)])
+    db.commit()
+    retention.run(db, now=NOW)
+    assert _count(db, LLMTrace) == 0 and _count(db, Blob) == 1
+
+    _age_blobs(db, blobs.REUSE_GRACE_SECONDS + 60)
+    report = retention.run(db, now=NOW)
+    assert report["blobs"]["rows"] == 1
+    assert _count(db, Blob) == 0
+
+def test_reused_blob_is_marked_used(db):
+    insert_trace_rows(db, [_trace(NOW, PAYLOAD)])
+    db.commit()
+    _age_blobs(db, blobs.REUSE_GRACE_SECONDS + 60)
+    before = datetime.utcnow()
+    insert_trace_rows(db, [_trace(NOW, PAYLOAD)])
+    db.commit()
+    db.expire_all()
+    assert _count(db, Blob) == 1
+    assert db.execute(select(Blob.used_at)).scalar() >= before - timedelta(seconds=1)
+
+def test_stop_waits_for_the_running_pass(db, run, monkeypatch):
+    started, finished = threading.Event(), []
+
+    def slow_run(stop):
+        started.set()
+        stop.wait(5)
+        time.sleep(0.2)  # the current chunk
+        finished.append(True)
+        return {}
+
+    monkeypatch.setattr(retention, "run_once", slow_run)
+    job = retention.RetentionJob(enabled=True, interval_seconds=60)
+
+    async def scenario():
+        await job.start()
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        await job.stop()
+        return bool(finished)
+
+    assert run(scenario()) is True
+    db.expire_all()
+    lease = db.execute(select(SchedulerLease).where(SchedulerLease.name == retention.LEASE_NAME)).scalar_one()
+    assert lease.expires_at <= datetime.utcnow()
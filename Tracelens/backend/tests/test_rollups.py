@@ -0,0 +1,171 @@
+import asyncio
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import delete, func, select
+
+from app import rollups
+from app.ingest import insert_trace_rows
+from app.models import LatencySketch, LatencySketchDelta, LLMTrace, SchedulerLease, TraceRollupHour, TraceRollupMinute
+from app.sketch import DDSketch
+
+BASE = datetime(2024, 3, 1, 10, 0, 0)
+
+def _row(created_at, latency=100.0, model="gpt-4o", status="success", **fields):
+    return dict({
+        "model": model, "provider": "openai", "latency_ms": latency, "tokens": 10, "input_tokens": 4,
+        "output_tokens": 6, "cost_usd": 0.01, "status": status, "created_at": created_at,
+    }, **fields)
+
+def _ingest(db, rows):
+    insert_trace_rows(db, rows)
+    db.commit()
+
+def _rollups(db, model):
+    columns = [model.bucket, model.model, model.provider, model.status, model.request_count, model.latency_sum,
+               model.latency_min, model.latency_max, model.tokens_sum, model.cost_sum]
+    return sorted(tuple(row) for row in db.execute(select(*columns)))
+
+def _sketches(db):
+    rollups.compact_all()
+    db.expire_all()
+    rows = db.execute(select(LatencySketch.granularity, LatencySketch.bucket, LatencySketch.model, LatencySketch.sketch))
+    merged = {}
+    for granularity, bucket, model, blob in rows:
+        merged.setdefault((granularity, bucket, model), DDSketch(rollups.SKETCH_RELATIVE_ACCURACY)).merge(DDSketch.from_bytes(blob))
+    return {key: (sketch.count, round(sketch.quantile(0.5), 6)) for key, sketch in merged.items()}
+
+def _sample():
+    rows = []
+    for i in range(200):
+        ts = BASE + timedelta(minutes=7 * i, seconds=i % 60)  # spans about a day, crossing midnight
+        rows.append(_row(ts, latency=50.0 + i, model=("gpt-4o", "claude")[i % 2], status=("success", "failure")[i % 5 == 0]))
+    return rows
+
+def test_ingest_maintains_minute_and_hour_rollups(db):
+    rows = _sample()
+    _ingest(db, rows[:120])
+    _ingest(db, rows[120:])
+    assert db.execute(select(func.sum(TraceRollupMinute.request_count))).scalar() == 200
+    assert db.execute(select(func.sum(TraceRollupHour.request_count))).scalar() == 200
+    hour = rollups.truncate(BASE, 3600)
+    expected = [r for r in rows if rollups.truncate(r["created_at"], 3600) == hour and r["model"] == "gpt-4o" and r["status"] == "success"]
+    stored = db.execute(select(TraceRollupHour).where(
+        TraceRollupHour.bucket == hour, TraceRollupHour.model == "gpt-4o", TraceRollupHour.status == "success")).scalar_one()
+    assert stored.request_count == len(expected)
+    assert stored.latency_sum == pytest.approx(sum(r["latency_ms"] for r in expected))
+    assert stored.latency_min == min(r["latency_ms"] for r in expected)
+    assert stored.latency_max == max(r["latency_ms"] for r in expected)
+
+def test_rebuild_reproduces_ingest_rollups(db):
+    _ingest(db, _sample())
+    before = (_rollups(db, TraceRollupMinute), _rollups(db, TraceRollupHour), _sketches(db))
+    assert rollups.rebuild(db, chunk_size=17) == 200
+    assert (_rollups(db, TraceRollupMinute), _rollups(db, TraceRollupHour), _sketches(db)) == before
+
+def test_rebuild_restores_rollups_for_rows_written_outside_the_ingest_path(db):
+    _ingest(db, _sample()[:10])
+    db.execute(LLMTrace.__table__.insert(), [_row(BASE + timedelta(seconds=5), latency=999.0)])
+    db.commit()
+    rollups.rebuild(db)
+    assert db.execute(select(func.sum(TraceRollupMinute.request_count))).scalar() == 11
+    assert db.execute(select(func.max(TraceRollupMinute.latency_max))).scalar() == 999.0
+
+def test_rebuild_keeps_history_older_than_the_oldest_trace(db):
+    old = BASE - timedelta(days=30)
+    _ingest(db, [_row(old), _row(BASE)])
+    # Retention removed the old raw row; its rollups are the only record left
+    db.execute(delete(LLMTrace).where(LLMTrace.created_at == old))
+    db.commit()
+    rollups.rebuild(db)
+    buckets = set(db.execute(select(TraceRollupHour.bucket)).scalars())
+    assert buckets == {rollups.truncate(old, 3600), rollups.truncate(BASE, 3600)}
+
+def test_merged_sketch_tiles_ranges_with_coarse_buckets(db):
+    rows = _sample()
+    _ingest(db, rows)
+    since, until = BASE + timedelta(minutes=30), BASE + timedelta(hours=20)
+    sketch = rollups.merged_sketch(db, since, until)
+    inside = sorted(r["latency_ms"] for r in rows if since <= r["created_at"] < until)
+    assert sketch.count == len(inside)
+    exact = inside[int(0.95 * (len(inside) - 1))]
+    assert sketch.quantile(0.95) == pytest.approx(exact, rel=0.02)
+    assert rollups.merged_sketch(db, since + timedelta(seconds=1), until) is None
+
+def test_summary_window_bounds_match_between_raw_and_rollup_paths(client, db, monkeypatch):
+    hour = rollups.truncate(BASE, 3600)
+    _ingest(db, [_row(hour - timedelta(seconds=1)), _row(hour), _row(hour + timedelta(minutes=30)),
+                 _row(hour + timedelta(hours=1))])
+    params = {"since": hour.isoformat(), "until": (hour + timedelta(hours=1)).isoformat()}
+    from_rollups = client.get("/metrics/summary", params=params).json()
+    monkeypatch.setattr(rollups, "ENABLED", False)
+    from_raw = client.get("/metrics/summary", params=params).json()
+    assert from_rollups["total_requests"] == from_raw["total_requests"] == 2
+
+def test_timeseries_raw_and_rollup_paths_cover_whole_buckets(client, db, monkeypatch):
+    hour = rollups.truncate(BASE, 3600)
+    _ingest(db, [_row(hour + timedelta(minutes=m)) for m in (0, 20, 40, 59)])
+    params = {"metric_name": "requests", "aggregation": "count", "step": "1h",
+              "since": hour.isoformat(), "until": (hour + timedelta(minutes=30)).isoformat()}
+    from_rollups = client.get("/metrics/timeseries", params=params).json()["data_points"]
+    monkeypatch.setattr(rollups, "ENABLED", False)
+    from_raw = client.get("/metrics/timeseries", params=params).json()["data_points"]
+    assert [p["value"] for p in from_rollups] == [p["value"] for p in from_raw] == [4.0]
+
+def test_ingest_appends_sketch_deltas_that_reads_merge_before_compaction(db):
+    rows = _sample()
+    _ingest(db, rows[:120])
+    _ingest(db, rows[120:])
+    assert db.execute(select(func.count(LatencySketch.id))).scalar() == 0
+    assert db.execute(select(func.sum(LatencySketchDelta.request_count))).scalar() == 200
+    day = rollups.truncate(BASE, 86400)
+    pending = rollups.merged_sketch(db, day, day + timedelta(days=2))
+    pending_series = rollups.sketch_series(db, day, day + timedelta(days=2), "hour")
+
+    assert rollups.compact_sketches(db, limit=7) == 7
+    assert rollups.compact_all() > 0
+    db.expire_all()
+    assert db.execute(select(func.count(LatencySketchDelta.id))).scalar() == 0
+    compacted = rollups.merged_sketch(db, day, day + timedelta(days=2))
+    assert compacted.count == pending.count == 200
+    assert compacted.quantile(0.95) == pending.quantile(0.95)
+    series = rollups.sketch_series(db, day, day + timedelta(days=2), "hour")
+    assert {b: s.count for b, s in series.items()} == {b: s.count for b, s in pending_series.items()}
+    for granularity in rollups.SKETCH_GRANULARITIES:
+        counts = db.execute(select(func.sum(LatencySketch.request_count)).where(LatencySketch.granularity == granularity))
+        assert counts.scalar() == 200
+
+def test_compaction_merges_into_existing_sketches(db):
+    _ingest(db, [_row(BASE, latency=10.0)])
+    rollups.compact_all()
+    _ingest(db, [_row(BASE + timedelta(seconds=30), latency=20.0)])
+    rollups.compact_all()
+    db.expire_all()
+    stored = db.execute(select(LatencySketch).where(LatencySketch.granularity == "minute")).scalars().all()
+    assert [(s.bucket, s.request_count) for s in stored] == [(BASE, 2)]
+
+def test_compaction_stop_waits_for_the_running_pass(db, run, monkeypatch):
+    started, finished = threading.Event(), []
+
+    def slow_compaction():
+        started.set()
+        time.sleep(0.2)
+        finished.append(True)
+        return 0
+
+    monkeypatch.setattr(rollups, "compact_all", slow_compaction)
+    job = rollups.SketchCompactionJob(enabled=True, interval_seconds=60)
+
+    async def scenario():
+        await job.start()
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        await job.stop()
+        return bool(finished)
+
+    assert run(scenario()) is True
+    db.expire_all()
+    lease = db.execute(select(SchedulerLease).where(SchedulerLease.name == rollups.LEASE_NAME)).scalar_one()
+    assert lease.expires_at <= datetime.utcnow()
@@ -0,0 +1,74 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event, update
+
+from app import session_totals
+from app.database import engine
+from app.ingest import insert_session_rows, insert_span_rows, insert_trace_rows
+from app.models import AgentSession
+
+NOW = datetime(2024, 3, 1, 12, 0, 0)
+
+def _sessions(db, n=2, status="running"):
+    ids = insert_session_rows(db, [{"title": f"s{i}", "status": status, "started_at": NOW} for i in range(n)])
+    db.commit()
+    return ids
+
+def _span(session_id, latency=100.0, tokens=10, cost=0.5):
+    return {"session_id": session_id, "span_type": "tool", "name": "t", "status": "success",
+            "latency_ms": latency, "tokens_used": tokens, "cost_usd": cost, "created_at": NOW, "started_at": NOW}
+
+def _trace(session_id, cost=0.25):
+    return {"model": "gpt-4o", "provider": "openai", "latency_ms": 50.0, "tokens": 5, "cost_usd": cost,
+            "status": "success", "session_id": session_id, "created_at": NOW}
+
+def _totals(db, session_id):
+    db.expire_all()
+    s = db.get(AgentSession, session_id)
+    return s.total_latency_ms, s.total_tokens, s.total_cost_usd
+
+def test_spans_and_traces_add_to_their_sessions(db):
+    first, second = _sessions(db)
+    insert_span_rows(db, [_span(first), _span(first, latency=50.0), _span(second, tokens=0, cost=0.0)])
+    insert_trace_rows(db, [_trace(first), _trace(None)])
+    db.commit()
+    assert _totals(db, first) == (150.0, 20, pytest.approx(1.25))
+    assert _totals(db, second) == (100.0, 0, 0.0)
+
+def test_session_rows_are_updated_last_in_the_transaction(db):
+    first, second = _sessions(db)
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(" ".join(statement.split()).upper())
+
+    event.listen(engine, "before_cursor_execute", capture)
+    try:
+        insert_span_rows(db, [_span(second)])
+        insert_trace_rows(db, [_trace(first)])
+        db.commit()
+    finally:
+        event.remove(engine, "before_cursor_execute", capture)
+    writes = [s for s in statements if s.startswith(("INSERT", "UPDATE"))]
+    session_updates = [i for i, s in enumerate(writes) if s.startswith("UPDATE AGENT_SESSIONS")]
+    assert session_updates == [len(writes) - 1]
+    assert any(s.startswith("INSERT INTO LLM_TRACE_ROLLUPS_MINUTE") for s in writes[:session_updates[0]])
+
+def test_rolled_back_rows_do_not_count(db):
+    first, = _sessions(db, 1)
+    insert_span_rows(db, [_span(first)])
+    db.rollback()
+    insert_trace_rows(db, [_trace(first)])
+    db.commit()
+    assert _totals(db, first) == (0.0, 0, 0.25)
+
+def test_repair_recomputes_drifted_totals(db):
+    first, second = _sessions(db)
+    insert_span_rows(db, [_span(first), _span(second)])
+    insert_trace_rows(db, [_trace(first)])
+    db.commit()
+    db.execute(update(AgentSession).where(AgentSession.id == first).values(total_latency_ms=1.0, total_cost_usd=None))
+    db.commit()
+    assert session_totals.repair(db, chunk_size=1) == (2, 1)
+    assert _totals(db, first) == (100.0, 10, pytest.approx(0.75))
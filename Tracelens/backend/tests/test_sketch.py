@@ -0,0 +1,45 @@
+import random
+
+import pytest
+
+from app.sketch import DDSketch
+
+def _values(n=2000, seed=7):
+    rng = random.Random(seed)
+    return [rng.lognormvariate(5, 1.5) for _ in range(n)]
+
+def test_round_trip_keeps_bins_and_bounds():
+    # Values below 1 have negative bin indexes; zeros go to the zero bucket
+    sketch = DDSketch.of(_values() + [0.0, 0.0, 0.004, 0.5])
+    decoded = DDSketch.from_bytes(sketch.to_bytes())
+    assert decoded.bins == sketch.bins
+    assert decoded.zero_count == 2
+    assert (decoded.count, decoded.min, decoded.max) == (sketch.count, sketch.min, sketch.max)
+    assert decoded.relative_accuracy == sketch.relative_accuracy
+    for q in (0.0, 0.5, 0.95, 0.99, 1.0):
+        assert decoded.quantile(q) == sketch.quantile(q)
+
+def test_empty_sketch_round_trip():
+    decoded = DDSketch.from_bytes(DDSketch(0.02).to_bytes())
+    assert decoded.count == 0 and decoded.quantile(0.5) is None
+    assert decoded.relative_accuracy == 0.02
+
+def test_unknown_version_is_rejected():
+    data = bytearray(DDSketch.of([1.0]).to_bytes())
+    data[0] = 99
+    with pytest.raises(ValueError):
+        DDSketch.from_bytes(bytes(data))
+
+@pytest.mark.parametrize("q", [0.5, 0.9, 0.95, 0.99])
+def test_quantiles_are_within_relative_accuracy(q):
+    values = sorted(_values())
+    exact = values[int(q * (len(values) - 1))]
+    assert DDSketch.of(values).quantile(q) == pytest.approx(exact, rel=0.01)
+
+def test_merge_equals_the_sketch_of_all_values():
+    values = _values()
+    merged = DDSketch.of(values[:700])
+    merged.merge(DDSketch.of(values[700:]))
+    whole = DDSketch.of(values)
+    assert merged.bins == pytest.approx(whole.bins)
+    assert (merged.count, merged.min, merged.max) == (whole.count, whole.min, whole.max)
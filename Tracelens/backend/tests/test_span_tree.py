@@ -0,0 +1,68 @@
+import json
+
+import pytest
+from sqlalchemy import select
+
+from app import span_tree
+from app.models import AgentSpan
+
+PROMPT = "Summarize the following document. " * 20
+
+@pytest.fixture
+def tree(client):
+    """root -> (a -> a1 -> a2, b); a carries a prompt large enough to be stored as a blob."""
+    session_id = client.post("/agents/sessions", json={"title": "tree"}).json()["id"]
+
+    def span(name, parent=None, **fields):
+        body = dict({"session_id": session_id, "parent_id": parent, "span_type": "tool", "name": name}, **fields)
+        return client.post("/agents/spans", json=body).json()["id"]
+
+    root = span("root")
+    a = span("a", root, prompt=PROMPT)
+    a1 = span("a1", a)
+    a2 = span("a2", a1)
+    b = span("b", root)
+    return session_id, {"root": root, "a": a, "a1": a1, "a2": a2, "b": b}
+
+def _names(nodes):
+    return [(node["name"], _names(node["children"])) for node in nodes]
+
+def test_full_tree_with_payloads_from_blobs(client, db, tree):
+    session_id, ids = tree
+    assert db.execute(select(AgentSpan.prompt_blob).where(AgentSpan.id == ids["a"])).scalar() is not None
+    roots = client.get(f"/agents/sessions/{session_id}/spans/tree").json()
+    assert _names(roots) == [("root", [("a", [("a1", [("a2", [])])]), ("b", [])])]
+    assert roots[0]["children"][0]["prompt"] == PROMPT
+    assert roots[0]["child_count"] == 2
+
+def test_summary_fields_leave_out_payloads(client, tree):
+    session_id, _ = tree
+    root = client.get(f"/agents/sessions/{session_id}/spans/tree", params={"fields": "summary"}).json()[0]
+    assert "prompt" not in root["children"][0] and "prompt_blob" not in root["children"][0]
+    assert client.get(f"/agents/sessions/{session_id}/spans/tree", params={"fields": "name,bogus"}).status_code == 400
+
+def test_depth_limited_tree_reports_children_left_out(client, tree):
+    session_id, ids = tree
+    roots = client.get(f"/agents/sessions/{session_id}/spans/tree",
+                       params={"max_depth": 1, "fields": "name"}).json()
+    assert _names(roots) == [("root", [("a", []), ("b", [])])]
+    a, b = roots[0]["children"]
+    assert (a["child_count"], b["child_count"]) == (1, 0)
+
+    node = client.get(f"/agents/spans/{ids['a']}/subtree", params={"max_depth": 1, "fields": "name"}).json()
+    assert _names([node]) == [("a", [("a1", [])])]
+    assert node["children"][0]["child_count"] == 1
+    assert client.get("/agents/spans/999999/subtree").status_code == 404
+
+def test_deep_trees_encode_without_recursion():
+    depth = 5000
+    root = node = {"id": 0, "children": []}
+    for i in range(1, depth):
+        child = {"id": i, "children": []}
+        node["children"].append(child)
+        node = child
+    encoded = span_tree.to_json([root])
+    assert encoded.count('"children":[') == depth
+    assert encoded.startswith('[{"id": 0,"children":[{"id": 1,') and encoded.endswith("]}" * depth + "]")
+    assert json.loads(span_tree.to_json([{"id": 1, "children": [{"id": 2, "children": []}]}])) == \
+        [{"id": 1, "children": [{"id": 2, "children": []}]}]
@@ -0,0 +1,134 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select
+
+from app.ingest import insert_session_rows, span_row, trace_row
+from app.models import AgentSpan, LLMTrace
+from app.schemas import AgentSpanCreate, LLMTraceCreate
+from app.write_buffer import SPAN, TRACE, BufferClosed, WriteBuffer, _write_batch
+
+def _row(i: int = 0):
+    return trace_row(LLMTraceCreate(model="gpt-4o", provider="openai", latency_ms=100.0 + i, tokens=10))
+
+def _count(db) -> int:
+    return db.execute(select(func.count(LLMTrace.id))).scalar()
+
+def test_flush_mode_returns_ids_in_submission_order(db, run):
+    buffer = WriteBuffer(enabled=True, max_rows=50, max_delay_ms=5)
+
+    async def scenario():
+        await buffer.start()
+        ids = await asyncio.gather(*(buffer.submit(TRACE, _row(i)) for i in range(20)))
+        await buffer.stop()
+        return ids
+
+    ids = run(scenario())
+    assert len(set(ids)) == 20
+    latencies = dict(db.execute(select(LLMTrace.id, LLMTrace.latency_ms)).all())
+    assert [latencies[i] for i in ids] == [100.0 + i for i in range(20)]
+
+def test_stop_flushes_rows_of_producers_blocked_on_a_full_queue(db, run):
+    buffer = WriteBuffer(enabled=True, max_rows=2, max_delay_ms=1, max_pending=1)
+
+    async def scenario():
+        await buffer.start()
+        producers = [asyncio.create_task(buffer.submit(TRACE, _row(i))) for i in range(10)]
+        await asyncio.sleep(0)  # all but the first wait for room in the queue
+        await asyncio.wait_for(buffer.stop(), 10)
+        return await asyncio.wait_for(asyncio.gather(*producers), 10)
+
+    ids = run(scenario())
+    assert None not in ids and len(set(ids)) == 10
+    assert _count(db) == 10
+
+def test_enqueue_mode_flushes_blocked_producers_on_stop(db, run):
+    buffer = WriteBuffer(enabled=True, max_rows=2, max_delay_ms=1, max_pending=1, durability="enqueue")
+
+    async def scenario():
+        await buffer.start()
+        producers = [asyncio.create_task(buffer.submit(TRACE, _row(i))) for i in range(10)]
+        await asyncio.sleep(0)
+        await asyncio.wait_for(buffer.stop(), 10)
+        return await asyncio.wait_for(asyncio.gather(*producers), 10)
+
+    assert run(scenario()) == [None] * 10
+    assert _count(db) == 10
+
+def test_submit_after_stop_is_rejected(run):
+    buffer = WriteBuffer(enabled=True)
+
+    async def scenario():
+        await buffer.start()
+        await buffer.stop()
+        await buffer.submit(TRACE, _row())
+
+    with pytest.raises(BufferClosed):
+        run(scenario())
+
+def test_bad_row_fails_alone(db, run):
+    buffer = WriteBuffer(enabled=True, max_rows=10, max_delay_ms=20)
+    bad = dict(_row(), created_at=None)  # cannot be bucketed into rollups
+
+    async def scenario():
+        await buffer.start()
+        results = await asyncio.gather(buffer.submit(TRACE, _row(1)), buffer.submit(TRACE, bad),
+                                       buffer.submit(TRACE, _row(2)), return_exceptions=True)
+        await buffer.stop()
+        return results
+
+    good_one, failed, good_two = run(scenario())
+    assert isinstance(good_one, int) and isinstance(good_two, int)
+    assert isinstance(failed, Exception)
+    assert _count(db) == 2
+
+def test_mixed_batches_map_ids_to_submission_positions(db):
+    session_id = insert_session_rows(db, [{"title": "s", "status": "running", "started_at": datetime.utcnow()}])[0]
+    db.commit()
+
+    def batch(tag):
+        span = lambda name: span_row(AgentSpanCreate(session_id=session_id, span_type="llm", name=f"{tag}-{name}"))
+        return [(TRACE, _row(1)), (SPAN, span("a")), (TRACE, _row(2)), (SPAN, span("b"))]
+
+    def written(results):
+        return [db.get(LLMTrace if kind == TRACE else AgentSpan, new_id) for (kind, _), new_id in zip(rows, results)]
+
+    rows = batch("one-commit")
+    objects = written(_write_batch(db, rows))
+    assert [objects[0].latency_ms, objects[1].name, objects[2].latency_ms, objects[3].name] == [
+        101.0, "one-commit-a", 102.0, "one-commit-b"]
+
+    # A bad row makes the batch fall back to one commit per row, still in submission order
+    rows = batch("row-by-row") + [(TRACE, dict(_row(), created_at=None))]
+    results = _write_batch(db, rows)
+    assert isinstance(results[-1], Exception)
+    objects = written(results[:-1])
+    assert [objects[0].latency_ms, objects[1].name, objects[2].latency_ms, objects[3].name] == [
+        101.0, "row-by-row-a", 102.0, "row-by-row-b"]
+    assert objects[0].id < objects[2].id and objects[1].id < objects[3].id
+
+def test_flush_runs_off_the_event_loop(db, run, monkeypatch):
+    from app import write_buffer
+    loops = []
+    write_batch = write_buffer._write_batch
+
+    def recording(session, rows):
+        try:
+            loops.append(asyncio.get_running_loop())
+        except RuntimeError:
+            loops.append(None)
+        return write_batch(session, rows)
+
+    monkeypatch.setattr(write_buffer, "_write_batch", recording)
+    buffer = WriteBuffer(enabled=True, max_rows=10, max_delay_ms=1)
+
+    async def scenario():
+        await buffer.start()
+        new_id = await buffer.submit(TRACE, _row())
+        await buffer.stop()
+        return new_id
+
+    assert run(scenario()) is not None
+    assert loops and loops == [None] * len(loops)
+    assert _count(db) == 1
@@ -107,6 +107,63 @@ export const deleteAlertThreshold = async (id: number) => (await api.delete(`/al
 
 export const checkThresholds = async () => (await api.post("/alerts/check-thresholds")).data;
 
+// Incremental totals pushed over /metrics/ws as "metrics_delta" messages
+type TraceTotals = {
+  requests: number; success_count: number; failure_count: number; latency_sum_ms: number;
+  tokens: number; input_tokens: number; output_tokens: number; cost_usd: number;
+};
+export type MetricsDelta = {
+  traces?: TraceTotals & { models: (TraceTotals & { model: string; provider: string })[] };
+  spans?: number; sessions?: number; alerts?: number;
+};
+
+// Percentiles and requests/min are left as-is until the next full "metrics_update"
+export const applyMetricsDelta = (s: MetricsSummary, delta: MetricsDelta): MetricsSummary => {
+  const d = delta.traces;
+  if (!d || !d.requests) return s;
+  const total = s.total_requests + d.requests;
+  const tokens = s.total_tokens + d.tokens;
+  const cost = s.total_cost_usd + d.cost_usd;
+  const success = s.success_rate_pct / 100 * s.total_requests + d.success_count;
+  const failure = s.failure_rate_pct / 100 * s.total_requests + d.failure_count;
+  return {
+    ...s,
+    total_requests: total,
+    avg_latency_ms: (s.avg_latency_ms * s.total_requests + d.latency_sum_ms) / total,
+    total_tokens: tokens,
+    total_cost_usd: cost,
+    success_rate_pct: success / total * 100,
+    failure_rate_pct: failure / total * 100,
+    error_rate_pct: failure / total * 100,
+    total_input_tokens: s.total_input_tokens + d.input_tokens,
+    total_output_tokens: s.total_output_tokens + d.output_tokens,
+    avg_tokens_per_request: tokens / total,
+    cost_per_token: tokens ? cost / tokens : 0,
+  };
+};
+
+export const applyModelsDelta = (models: ModelSummary[], delta: MetricsDelta): ModelSummary[] => {
+  if (!delta.traces) return models;
+  const next = models.map(m => ({ ...m }));
+  for (const d of delta.traces.models) {
+    let m = next.find(x => x.model === d.model && x.provider === d.provider);
+    if (!m) {
+      m = { model: d.model, provider: d.provider, total_requests: 0, avg_latency_ms: 0, total_tokens: 0,
+            total_cost_usd: 0, success_count: 0, failure_count: 0, success_rate_pct: 0 };
+      next.push(m);
+    }
+    const total = m.total_requests + d.requests;
+    m.avg_latency_ms = (m.avg_latency_ms * m.total_requests + d.latency_sum_ms) / total;
+    m.total_requests = total;
+    m.total_tokens += d.tokens;
+    m.total_cost_usd += d.cost_usd;
+    m.success_count += d.success_count;
+    m.failure_count += d.failure_count;
+    m.success_rate_pct = m.success_count / total * 100;
+  }
+  return next;
+};
+
 // WebSocket connections
 export const createMetricsWebSocket = () => new WebSocket(`${BASE_URL.replace('http', 'ws')}/metrics/ws`);
 export const createAlertsWebSocket = () => new WebSocket(`${BASE_URL.replace('http', 'ws')}/alerts/ws`);
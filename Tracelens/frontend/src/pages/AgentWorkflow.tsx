@@ -60,7 +60,10 @@ export default function AgentWorkflow() {
     
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
-      if (data.type === "new_alert") {
+      if (data.type === "ping") {
+        // Server keepalive; unanswered pings close the connection
+        ws.send(JSON.stringify({ type: "pong" }));
+      } else if (data.type === "new_alert") {
         // Handle new alert notification
         console.log("New alert:", data.data);
       }
@@ -71,7 +71,10 @@ export default function Alerts() {
     
     ws.onmessage = (event) => {
       const data = JSON.parse(event.data);
-      if (data.type === "new_alert") {
+      if (data.type === "ping") {
+        // Server keepalive; unanswered pings close the connection
+        ws.send(JSON.stringify({ type: "pong" }));
+      } else if (data.type === "new_alert") {
         // Add new alert to the list
         setAlerts(prev => [data.data, ...prev]);
         // Update summary
@@ -2,7 +2,7 @@ import KPI from "../components/KPI";
 import TracesTable from "../components/TracesTable";
 import MockDataToggle from "../components/MockDataToggle";
 import { useEffect, useState } from "react";
-import { fetchSummary, fetchTraces, fetchTimeSeries, fetchModelsSummary, MetricsSummary, Trace, ModelSummary, createMetricsWebSocket } from "../lib/api";
+import { fetchSummary, fetchTraces, fetchTimeSeries, fetchModelsSummary, MetricsSummary, Trace, ModelSummary, createMetricsWebSocket, applyMetricsDelta, applyModelsDelta } from "../lib/api";
 import { LineChart, Line, CartesianGrid, XAxis, YAxis, Tooltip, ResponsiveContainer, BarChart, Bar, PieChart, Pie, Cell } from "recharts";
 import { 
   mockMetricsSummary, 
@@ -83,6 +83,9 @@ export default function Dashboard() {
       const data = JSON.parse(event.data);
       if (data.type === "metrics_update") {
         setSummary(data.data);
+      } else if (data.type === "metrics_delta" && !useMockData) {
+        setSummary(prev => prev ? applyMetricsDelta(prev, data.data) : prev);
+        setModelsSummary(prev => applyModelsDelta(prev, data.data));
       }
     };
     